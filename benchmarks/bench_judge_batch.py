@@ -0,0 +1,103 @@
+"""
+Judge micro-batching benchmark against the local stand-in endpoint.
+
+Many groups fire debounce timers at random (exponential inter-arrival per
+group); every timer calls LLMService.judge_interruption. Compares:
+  - per-group: one HTTP request per judge call
+  - batched:   MicroBatcher with the given max wait / batch size
+and reports HTTP requests, throughput and judge latency percentiles.
+
+Usage:
+    python -m benchmarks.bench_judge_batch [groups] [seconds] [max_wait_ms] [batch_size]
+"""
+import asyncio
+import contextlib
+import io
+import random
+import statistics
+import sys
+import time
+
+import openai
+
+from benchmarks.standin_server import StandinServer
+from services.judge_cache import judge_cache
+from services.llm import LLMService
+from services.llm_scheduler import llm_scheduler
+
+
+async def load(llm: LLMService, groups: int, seconds: float, mean_interval: float, seed: int):
+    """
+    Open loop: timers fire on schedule whether or not earlier judges finished.
+    """
+    rng = random.Random(seed)
+    latencies = []
+
+    async def judge(g: int, n: int):
+        context = {
+            "recent_messages": [f"user{g}: message {n} in group {g}"],
+            "latest_message": f"message {n} in group {g}",
+            "time_since_last_user_message": 10.0,
+            "time_since_last_group_message": 10.0,
+            "is_at_mentioned": False,
+        }
+        start = time.perf_counter()
+        await llm.judge_interruption(context)
+        latencies.append(time.perf_counter() - start)
+
+    async def group(g: int, pending: list):
+        elapsed = rng.expovariate(1 / mean_interval)
+        n = 0
+        while elapsed < seconds:
+            await asyncio.sleep(max(0.0, start + elapsed - time.perf_counter()))
+            n += 1
+            pending.append(asyncio.create_task(judge(g, n)))
+            elapsed += rng.expovariate(1 / mean_interval)
+
+    pending = []
+    start = time.perf_counter()
+    await asyncio.gather(*(group(g, pending) for g in range(groups)))
+    await asyncio.gather(*pending)
+    return latencies, time.perf_counter() - start
+
+
+def report(name: str, latencies, wall: float, server: StandinServer):
+    q = statistics.quantiles(latencies, n=100)
+    print(f"{name:10s} judged {len(latencies):5d}, all done after {wall:5.1f}s ({len(latencies) / wall:6.1f}/s), "
+          f"http requests {server.stats['requests']:5d}, "
+          f"latency p50 {q[49] * 1000:6.0f} ms  p95 {q[94] * 1000:6.0f} ms  max {max(latencies) * 1000:6.0f} ms")
+
+
+async def main():
+    groups = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    max_wait = (float(sys.argv[3]) if len(sys.argv) > 3 else 150) / 1000
+    batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    mean_interval = 2.0
+
+    server = StandinServer().start()
+    # Let the client use every slot the stand-in has
+    llm_scheduler.default_concurrency = 8
+    print(f"groups: {groups}, {seconds:.0f}s, one judge per group every ~{mean_interval:.0f}s; "
+          f"stand-in: {server.base_latency * 1000:.0f} ms + {server.per_item * 1000:.0f} ms/item, 8 concurrent")
+
+    for name, batching in (("per-group", False), ("batched", True)):
+        llm = LLMService()
+        llm.client = openai.AsyncOpenAI(api_key="standin", base_url=server.base_url, max_retries=0)
+        if batching:
+            llm.enable_judge_batching(max_wait, batch_size)
+        server.reset_stats()
+        # Same seed, same contexts: do not let the decision cache answer the second run
+        judge_cache._decisions.clear()
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, wall = await load(llm, groups, seconds, mean_interval, seed=1)
+        report(name, latencies, wall, server)
+        if batching:
+            print(f"{'':10s} batches {llm.judge_batcher.stats['batches']}, largest {llm.judge_batcher.stats['max_batch']}, "
+                  f"fallbacks {llm.judge_stats['fallbacks']} (max wait {max_wait * 1000:.0f} ms, size {batch_size})")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
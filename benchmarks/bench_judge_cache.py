@@ -0,0 +1,94 @@
+"""
+Judge decision cache benchmark.
+
+Replays a synthetic spammy group (stickers, 复读 chains, short reactions and
+some real chat) through the debounce logic of the core plugin and counts judge
+calls:
+  - uncached: one call per fired debounce timer
+  - cached:   calls left after the fingerprint cache (TTL from [cache])
+
+Usage:
+    python -m benchmarks.bench_judge_cache [messages] [seed] [window]
+"""
+import random
+import sys
+
+from config import settings
+from services.cache import LRUCache, MISSING
+from services.judge_cache import fingerprint
+from services.topic import MessageRing
+
+DEBOUNCE = 3.0
+USERS = [f"群友{i}" for i in range(12)]
+STICKERS = ["[图片]", "[表情/图片]", "[表情]"]
+REACTIONS = ["哈哈哈", "哈哈哈哈哈哈", "草", "笑死", "6", "？", "确实", "+1"]
+CHAINS = ["666", "草", "好耶", "来了来了", "？？？"]
+
+
+def traffic(n: int, rng: random.Random):
+    """(timestamp, user, content) of a group that is mostly noise."""
+    now = 0.0
+    i = 0
+    while i < n:
+        kind = rng.random()
+        if kind < 0.3:
+            # 复读 chain: everyone repeats the same thing
+            content = rng.choice(CHAINS)
+            for _ in range(rng.randint(3, 8)):
+                now += rng.uniform(0.5, 6)
+                yield now, rng.choice(USERS), content
+                i += 1
+        elif kind < 0.6:
+            now += rng.uniform(1, 8)
+            yield now, rng.choice(USERS), rng.choice(STICKERS)
+            i += 1
+        elif kind < 0.85:
+            now += rng.uniform(1, 8)
+            yield now, rng.choice(USERS), rng.choice(REACTIONS)
+            i += 1
+        else:
+            now += rng.uniform(2, 20)
+            yield now, rng.choice(USERS), f"正经话题第{i}条"
+            i += 1
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 42)
+    ttl = settings.get("cache", "judge_ttl_seconds", 120)
+    window = int(sys.argv[3]) if len(sys.argv) > 3 else settings.get("cache", "judge_window", 3)
+
+    clock = [0.0]
+    cache = LRUCache(settings.get("cache", "judge_max_entries", 1024), ttl, clock=lambda: clock[0])
+    ring = MessageRing(200)
+    events = list(traffic(n, rng))
+    fired = calls = 0
+    for idx, (ts, user, content) in enumerate(events):
+        ring.append(user, user, content, ts)
+        next_ts = events[idx + 1][0] if idx + 1 < len(events) else float("inf")
+        if next_ts - ts < DEBOUNCE:
+            continue  # debounce cancelled by the next message
+        # Timer fires: the judge sees the context as of this message
+        clock[0] = ts + DEBOUNCE
+        prev = ring[-2].timestamp if len(ring) > 1 else ts
+        last_user = ring.last_seen(user) if ring[-1].user_prev_ts is None else ring[-1].user_prev_ts
+        context = {
+            "recent_messages": ring.lines(10),
+            "latest_message": content,
+            "time_since_last_group_message": ts - prev,
+            "time_since_last_user_message": ts - last_user if last_user else 9999.0,
+            "is_at_mentioned": False,
+        }
+        fired += 1
+        key = fingerprint(context, ["柒槿年"], window)
+        if cache.get(key) is MISSING:
+            calls += 1
+            cache.put(key, {"should_intervene": False})
+
+    print(f"messages: {len(events)}, debounce timers fired: {fired}, ttl: {ttl}s, window: {window}")
+    print(f"judge calls uncached: {fired}")
+    print(f"judge calls cached  : {calls}  ({(1 - calls / fired) * 100:.1f}% saved)")
+
+
+if __name__ == "__main__":
+    main()
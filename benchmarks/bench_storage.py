@@ -0,0 +1,72 @@
+"""
+Storage throughput benchmark.
+
+Replays the storage calls made by TopicManager.handle_message for every incoming
+group message and reports messages/second for:
+  - legacy:     a fresh sqlite3 connection per operation, default PRAGMAs
+  - persistent: the long-lived, tuned per-thread connection used by Storage
+
+Usage:
+    python -m benchmarks.bench_storage [messages] [groups]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from services.storage import Storage
+
+
+class LegacyStorage(Storage):
+    """
+    Reproduces the old behaviour: connect() per operation, no PRAGMA tuning.
+    The connection is dropped (and closed) as soon as the operation returns.
+    """
+
+    def _conn(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path)
+
+
+def run(storage: Storage, n_messages: int, n_groups: int) -> float:
+    topics = {}
+    for g in range(n_groups):
+        gid = f"group_{g}"
+        topics[gid] = storage.create_topic(gid, time.time())
+        storage.add_memory(f"user_{g}", gid, f"user_{g} likes benchmarks")
+
+    start = time.perf_counter()
+    for i in range(n_messages):
+        gid = f"group_{i % n_groups}"
+        uid = f"user_{i % (n_groups * 4)}"
+        now = time.time()
+        # Same sequence of calls as handle_message + _build_context
+        storage.update_user(gid, uid, uid, now)
+        storage.add_message(topics[gid], uid, f"message {i}", now, uid)
+        storage.get_recent_topics(gid, limit=5)
+        storage.get_user(gid, uid)
+        storage.get_memories(uid, limit=20)
+    elapsed = time.perf_counter() - start
+    return n_messages / elapsed
+
+
+def main():
+    n_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_groups = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = LegacyStorage(os.path.join(tmp, "legacy.db"))
+        legacy_rate = run(legacy, n_messages, n_groups)
+
+        persistent = Storage(os.path.join(tmp, "persistent.db"))
+        persistent_rate = run(persistent, n_messages, n_groups)
+        persistent.close()
+
+    print(f"messages: {n_messages}, groups: {n_groups}")
+    print(f"legacy     (connect per op): {legacy_rate:10.1f} msg/s")
+    print(f"persistent (tuned, reused) : {persistent_rate:10.1f} msg/s")
+    print(f"speedup: {persistent_rate / legacy_rate:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
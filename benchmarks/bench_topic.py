@@ -0,0 +1,89 @@
+"""
+In-memory topic message benchmark.
+
+Fills one topic with N messages and measures, for the per-message work done
+by TopicManager._build_context (time since the group's / the speaker's last
+message, last 10 rendered lines):
+  - legacy: unbounded list of dicts, reverse scan + re-render every call
+  - ring:   MessageRing (bounded deque of records, last-seen index, pre-rendered lines)
+
+Usage:
+    python -m benchmarks.bench_topic [messages] [users] [capacity]
+"""
+import sys
+import time
+import tracemalloc
+
+from services.topic import MessageRing
+
+
+def legacy_context(messages, user_id, now):
+    time_since_last_user = 9999.0
+    time_since_last_group = now - messages[-2]["timestamp"]
+    for msg in reversed(messages[:-1]):
+        if msg["user_id"] == user_id:
+            time_since_last_user = now - msg["timestamp"]
+            break
+    recent = [f"{m.get('nickname') or m['user_id']}: {m['content']}" for m in messages[-10:]]
+    return time_since_last_group, time_since_last_user, recent
+
+
+def ring_context(messages, user_id, now):
+    time_since_last_user = 9999.0
+    time_since_last_group = now - messages[-2].timestamp
+    last = messages[-1]
+    prev = last.user_prev_ts if last.user_id == user_id else messages.last_seen(user_id)
+    if prev is not None:
+        time_since_last_user = now - prev
+    return time_since_last_group, time_since_last_user, messages.lines(10)
+
+
+def fill_legacy(n, n_users):
+    messages = []
+    for i in range(n):
+        uid = f"user_{i % n_users}"
+        messages.append({"user_id": uid, "nickname": f"nick_{uid}", "content": f"message number {i}", "timestamp": float(i)})
+    return messages
+
+
+def fill_ring(n, n_users, capacity):
+    ring = MessageRing(capacity)
+    for i in range(n):
+        uid = f"user_{i % n_users}"
+        ring.append(uid, f"nick_{uid}", f"message number {i}", float(i))
+    return ring
+
+
+def measure(fill, context, speaker, *args):
+    tracemalloc.start()
+    messages = fill(*args)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = 2000
+    now = float(args[0])
+    start = time.perf_counter()
+    for _ in range(calls):
+        context(messages, speaker, now)
+    per_call = (time.perf_counter() - start) / calls
+    return size, per_call
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    n_users = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    capacity = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    # Worst case for the reverse scan: a user who has not spoken for a while
+    speaker = "user_lurker"
+
+    legacy_mem, legacy_t = measure(fill_legacy, legacy_context, speaker, n, n_users)
+    ring_mem, ring_t = measure(fill_ring, ring_context, speaker, n, n_users, capacity)
+
+    print(f"messages: {n}, users: {n_users}, ring capacity: {capacity}")
+    print(f"legacy (list of dicts): {legacy_mem / 1024:10.1f} KiB  {legacy_t * 1e6:8.1f} us/call")
+    print(f"ring   (MessageRing)  : {ring_mem / 1024:10.1f} KiB  {ring_t * 1e6:8.1f} us/call")
+    print(f"memory: {legacy_mem / ring_mem:.1f}x smaller, latency: {legacy_t / ring_t:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""
+End-to-end load test: group chat traffic replayed through QJinEraPlugin.handle
+against the local stand-in endpoint (benchmarks/standin_server.py), with the
+real topic manager, caches, scheduler and write-behind storage on a
+throwaway database.
+
+Traffic is either synthetic (N groups, each a Poisson stream of M msgs/s
+with reply bursts, stickers, name and @ mentions) or replayed from a JSONL
+file / a bot database (original timing, sped up by --speed).
+
+Reports judge / chat / other LLM calls, end-to-end reply latency (message
+received -> first reply sent, including debounce and typing delay),
+share of prompt tokens the stand-in served from its prompt cache,
+group pipeline jobs and queue depth, event-loop lag and database write rate; with --speculate, also the
+speculative chat generation hit rate and latency saved per reply.
+
+Usage:
+    python -m benchmarks.load_test [--groups 50] [--rate 0.2] [--seconds 60]
+    python -m benchmarks.load_test --replay chat.jsonl --speed 10
+    python -m benchmarks.load_test --from-db qjinera.db --speed 10
+JSONL lines: {"group_id", "user_id", "nickname", "content", "timestamp"}
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+import tomli
+
+from benchmarks.standin_server import StandinServer
+from config import settings
+
+BOT_ID = 10000
+
+# (offset seconds, group_id, user_id, nickname, content, @-mention)
+Message = Tuple[float, str, str, str, str, bool]
+
+PHRASES = [
+    "今天好累啊", "有人打游戏吗", "笑死", "这也太离谱了吧", "刚下班", "明天要考试了",
+    "甲方又改需求了，一坨", "晚饭吃什么", "轻松搞定 😎", "哈哈哈哈哈", "？", "确实",
+    "我去，翻车了", "有没有人推荐个耳机", "周末去爬山吗", "好耶",
+]
+
+
+def synthetic_traffic(groups: int, rate: float, seconds: float, seed: int) -> List[Message]:
+    rng = random.Random(seed)
+    messages: List[Message] = []
+    for g in range(groups):
+        group_id = f"load{g}"
+        users = [f"{g}_{u}" for u in range(6)]
+        t = rng.expovariate(rate)
+        speaker = rng.choice(users)
+        while t < seconds:
+            # Same speaker again (often a fast follow-up) or someone else
+            if rng.random() > 0.3:
+                speaker = rng.choice(users)
+            roll = rng.random()
+            mention = False
+            if roll < 0.03:
+                content, mention = f"[CQ:at,qq={BOT_ID}] 你怎么看", True
+            elif roll < 0.08:
+                content = f"柒槿年，{rng.choice(PHRASES)}"
+            elif roll < 0.18:
+                content = "[CQ:image,file=sticker.gif]"
+            else:
+                content = rng.choice(PHRASES)
+            messages.append((t, group_id, speaker, f"user{speaker}", content, mention))
+            gap = rng.uniform(0.5, 1.5) if rng.random() < 0.2 else rng.expovariate(rate)
+            t += gap
+    messages.sort(key=lambda m: m[0])
+    return messages
+
+
+def recorded_traffic(rows: List[Dict], speed: float, seconds: float) -> List[Message]:
+    rows = sorted(rows, key=lambda r: r["timestamp"])
+    if not rows:
+        return []
+    start = rows[0]["timestamp"]
+    messages = []
+    for r in rows:
+        offset = (r["timestamp"] - start) / speed
+        if offset >= seconds:
+            break
+        content = str(r["content"])
+        messages.append((offset, str(r["group_id"]), str(r["user_id"]), r.get("nickname") or "", content,
+                         f"[CQ:at,qq={BOT_ID}]" in content))
+    return messages
+
+
+def load_jsonl(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_db(path: str, limit: int) -> List[Dict]:
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            """
+            SELECT t.group_id, m.user_id, m.nickname, m.content, m.timestamp
+            FROM messages m JOIN topics t ON t.id = m.topic_id
+            WHERE m.user_id != 'bot'
+            ORDER BY m.timestamp DESC LIMIT ?
+            """,
+            (limit,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [dict(r) for r in rows]
+
+
+def configure(args, server: StandinServer, workdir: str):
+    """
+    Point the services at the stand-in and a throwaway database. Must run
+    before the services are imported (they read settings at import time).
+    """
+    if not settings.get("prompts"):
+        # No config.toml: the example config gives realistic prompt sizes
+        with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.config.toml"), "rb") as f:
+            settings._config_data = tomli.load(f)
+    data = settings._config_data
+    data.setdefault("llm", {}).update({
+        "api_key": "standin", "api_base": server.base_url, "proxy": "",
+        "judge_model": "standin-judge", "chat_model": "standin-chat",
+        "chat_streaming": not args.no_streaming,
+    })
+    data.setdefault("storage", {}).update({"database_file": os.path.join(workdir, "load.db"), "data_dir": workdir})
+    data.setdefault("topic", {})["debounce_seconds"] = args.debounce
+    data.setdefault("llm_scheduler", {})["max_concurrency"] = args.concurrency
+    data.setdefault("bot", {})["name"] = "柒槿年"
+    data.setdefault("speculation", {})["enabled"] = args.speculate
+
+
+def percentiles(samples: List[float]) -> str:
+    if len(samples) < 2:
+        return "n/a"
+    q = statistics.quantiles(samples, n=100, method="inclusive")
+    return f"p50 {q[49] * 1000:7.0f} ms  p95 {q[94] * 1000:7.0f} ms  p99 {q[98] * 1000:7.0f} ms  max {max(samples) * 1000:7.0f} ms"
+
+
+async def run(args, traffic: List[Message], server: StandinServer):
+    from alicebot.adapter.cqhttp.event import GroupMessageEvent
+    from plugins.core import QJinEraPlugin
+    from services.group_pipeline import group_pipeline
+    from services.judge_cache import judge_cache
+    from services.memory_extraction import memory_extractor
+    from services.prefilter import prefilter
+    from services.speculation import speculator
+    from services.storage import async_storage, storage
+
+    arrivals: Dict[int, float] = {}
+    replied = set()
+    reply_latencies: List[float] = []
+    replies = itertools.count()
+
+    class ReplayEvent(GroupMessageEvent):
+        async def reply(self, message, at_sender=False):
+            next(replies)
+            if self.message_id not in replied:
+                replied.add(self.message_id)
+                reply_latencies.append(time.perf_counter() - arrivals[self.message_id])
+
+    lag: List[float] = []
+    depth = {"queued": 0, "max_depth": 0, "jobs_running": 0}
+    running = True
+
+    async def monitor_lag(interval: float = 0.05):
+        while running:
+            before = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag.append(time.perf_counter() - before - interval)
+            for key, value in group_pipeline.gauges().items():
+                if key in depth:
+                    depth[key] = max(depth[key], value)
+
+    handlers = []
+    message_ids = itertools.count(1)
+
+    def deliver(group_id: str, user_id: str, nickname: str, content: str, mention: bool):
+        event = ReplayEvent.model_construct(
+            message_id=next(message_ids), group_id=group_id, user_id=user_id, self_id=BOT_ID,
+            message=content, raw_message=content, time=int(time.time()), to_me=mention,
+            sender=SimpleNamespace(nickname=nickname),
+        )
+        arrivals[event.message_id] = time.perf_counter()
+        plugin = object.__new__(QJinEraPlugin)
+        plugin.event = event
+        # AliceBot runs every event's handler concurrently
+        handlers.append(asyncio.create_task(plugin.handle()))
+
+    committed_before = async_storage.stats["committed"]
+    monitor = asyncio.create_task(monitor_lag())
+    start = time.perf_counter()
+    for offset, group_id, user_id, nickname, content, mention in traffic:
+        await asyncio.sleep(max(0.0, start + offset - time.perf_counter()))
+        deliver(group_id, user_id, nickname, content, mention)
+    sent_for = time.perf_counter() - start
+
+    # Drain: pending debounces, judges and replies
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline:
+        if not group_pipeline.busy() and all(t.done() for t in handlers):
+            break
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - start
+    running = False
+    await monitor
+    await async_storage.flush()
+    committed = async_storage.stats["committed"] - committed_before
+
+    calls = await async_storage.call(
+        lambda: storage._conn().execute(
+            "SELECT kind, queue_ms + latency_ms, outcome, path, prompt_tokens, cached_tokens FROM llm_calls"
+        ).fetchall()
+    )
+    await async_storage.close()
+    return {
+        "messages": len(traffic), "sent_for": sent_for, "wall": wall, "replies": next(replies),
+        "reply_latencies": reply_latencies, "lag": lag, "committed": committed, "calls": calls,
+        "prefilter": dict(prefilter.stats), "judge_cache": dict(judge_cache.stats),
+        "speculation": speculator.report() if speculator.enabled else None,
+        "pipeline": dict(group_pipeline.stats, **{f"peak_{k}": v for k, v in depth.items()}),
+        "extraction": dict(memory_extractor.stats, **{f"batch_{k}": v for k, v in memory_extractor.batch_stats().items()}),
+    }
+
+
+def report(args, result, server: StandinServer):
+    print(f"traffic: {result['messages']} messages in {result['sent_for']:.1f}s "
+          f"({result['messages'] / max(result['sent_for'], 1e-9):.1f} msg/s), drained after {result['wall']:.1f}s")
+    print(f"stand-in: {server.stats['requests']} requests, by kind {server.stats['by_kind']}, "
+          f"{server.stats['errors']} errors / {server.stats['rate_limited']} rate limited injected")
+
+    by_kind: Dict[str, List] = {}
+    for kind, ms, outcome, path, prompt, cached in result["calls"]:
+        by_kind.setdefault(kind, []).append((ms, outcome, path, prompt, cached))
+    print("LLM calls (client side):")
+    for kind, rows in sorted(by_kind.items(), key=lambda kv: -len(kv[1])):
+        cancelled = sum(1 for row in rows if row[1] == "cancelled")
+        failed = sum(1 for row in rows if row[1] not in ("ok", "cancelled"))
+        non_primary = sum(1 for row in rows if row[2] != "primary")
+        cached = sum(row[4] or 0 for row in rows) / max(1, sum(row[3] or 0 for row in rows))
+        print(f"  {kind:16s} {len(rows):6d} calls, {failed:4d} failed, {cancelled:4d} cancelled, "
+              f"{non_primary:4d} hedge/fallback, {cached:4.0%} prompt cached  "
+              f"{percentiles([row[0] / 1000 for row in rows])}")
+    print(f"  judge calls avoided: pre-filter {result['prefilter']['avoided']}, "
+          f"cache hits {result['judge_cache']['hits']} + joined {result['judge_cache']['joined']}")
+
+    pipe = result["pipeline"]
+    print(f"group pipeline: {pipe['workers_started']} workers, {pipe['judge_jobs']} judge jobs "
+          f"({pipe['superseded']} superseded by newer messages, {pipe['preempted']} by mentions), "
+          f"{pipe['mention_jobs']} mention replies ({pipe['dropped_mentions']} dropped); peak queue "
+          f"{pipe['peak_queued']} total / {pipe['peak_max_depth']} in one group, {pipe['peak_jobs_running']} jobs running")
+    ext = result["extraction"]
+    print(f"  memory extraction: {ext['requested']} requested, {ext['coalesced']} coalesced, "
+          f"{ext['skipped']} without new messages, {ext['runs']} users extracted in {ext['batch_batches']} batches "
+          f"(largest {ext['batch_max_batch']})")
+    spec = result["speculation"]
+    if spec:
+        print(f"  speculative chat: {spec['started']} started, {spec['hits']} hits / {spec['misses']} misses "
+              f"({spec['hit_rate']:.0%}), {spec['cancelled']} cancelled, {spec['over_budget']} over budget; "
+              f"saved {spec['avg_saved_ms']:.0f} ms per hit, ~{spec['wasted_tokens']} tokens wasted")
+
+    print(f"replies: {result['replies']} messages sent, {len(result['reply_latencies'])} triggering messages answered")
+    print(f"  end-to-end (received -> first reply)  {percentiles(result['reply_latencies'])}")
+    print(f"event-loop lag                          {percentiles(result['lag'])}")
+    print(f"db writes: {result['committed']} committed, {result['committed'] / result['wall']:.0f}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=0.2, help="messages/s per group (synthetic)")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--replay", help="JSONL file of recorded messages")
+    parser.add_argument("--from-db", help="replay the latest messages of a bot database")
+    parser.add_argument("--limit", type=int, default=20000, help="messages read from --from-db")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up")
+    parser.add_argument("--debounce", type=float, default=3.0)
+    parser.add_argument("--concurrency", type=int, default=8, help="client-side concurrent requests per model")
+    parser.add_argument("--drain", type=float, default=60, help="max seconds to wait for pending replies")
+    parser.add_argument("--no-streaming", action="store_true")
+    parser.add_argument("--speculate", action="store_true", help="start chat generation alongside likely-yes judges")
+    parser.add_argument("--seed", type=int, default=1)
+    # Stand-in endpoint
+    parser.add_argument("--latency", type=float, default=0.4, help="median judge latency (s)")
+    parser.add_argument("--chat-latency", type=float, default=1.5, help="median chat latency (s)")
+    parser.add_argument("--distribution", default="lognormal", choices=("fixed", "lognormal", "exponential"))
+    parser.add_argument("--server-concurrency", type=int, default=16)
+    parser.add_argument("--intervene-rate", type=float, default=0.15)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.replay:
+        traffic = recorded_traffic(load_jsonl(args.replay), args.speed, args.seconds)
+    elif args.from_db:
+        traffic = recorded_traffic(load_db(args.from_db, args.limit), args.speed, args.seconds)
+    else:
+        traffic = synthetic_traffic(args.groups, args.rate, args.seconds, args.seed)
+    if not traffic:
+        sys.exit("no traffic to replay")
+    args.groups = len({m[1] for m in traffic})
+
+    server = StandinServer(
+        base_latency=args.latency, chat_latency=args.chat_latency, distribution=args.distribution,
+        max_concurrency=args.server_concurrency, intervene_rate=args.intervene_rate,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, seed=args.seed,
+    ).start()
+    print(f"{args.groups} groups, {len(traffic)} messages; stand-in {args.distribution} "
+          f"judge {args.latency * 1000:.0f} ms / chat {args.chat_latency * 1000:.0f} ms, "
+          f"{args.server_concurrency} concurrent; debounce {args.debounce}s")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        configure(args, server, workdir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = asyncio.run(run(args, traffic, server))
+    report(args, result, server)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Answers /chat/completions with canned JSON after a simulated delay, serving
+at most `max_concurrency` requests at a time (later ones queue, like a
+rate-limited provider). The request kind is recognized from its content:
+  - judge:       {"should_intervene": ...} (always true when the bot's name
+                 is in the latest message, else with `intervene_rate`)
+  - judge_batch: ({"requests": [...]}) one decision per id
+  - chat:        {"messages": [...], "summary": ...} (also proactive)
+  - extraction_batch: ({"users": [...]}) empty facts per id
+  - extraction / profiler / summary: matching minimal answers
+The delay is `latency + per_item * items`, where `latency` is drawn from
+the chosen distribution around `base_latency` (`chat_latency` for chat).
+Supports stream=True (SSE chunks), token usage, and injected 500 / 429
+errors with `error_rate` / `rate_limit_rate`. Like providers with prompt
+caching, a request whose leading messages (at least `cache_min_tokens`)
+were sent before reports them as usage.prompt_tokens_details.cached_tokens.
+
+Usage:
+    python -m benchmarks.standin_server [port]
+"""
+import hashlib
+import json
+import math
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Tuple
+
+from services.tokens import estimate_tokens
+
+DISTRIBUTIONS = ("fixed", "lognormal", "exponential")
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int = 0, base_latency: float = 0.4, per_item: float = 0.03, max_concurrency: int = 8,
+                 chat_latency: float = None, distribution: str = "fixed", sigma: float = 0.5,
+                 intervene_rate: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 stream_chunks: int = 8, cache_min_tokens: int = 1024, seed: int = None):
+        super().__init__(("127.0.0.1", port), StandinHandler)
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError(f"distribution must be one of {DISTRIBUTIONS}")
+        self.base_latency = base_latency
+        self.chat_latency = chat_latency if chat_latency is not None else base_latency
+        self.per_item = per_item
+        self.distribution = distribution
+        # lognormal: spread around the median (base latency)
+        self.sigma = sigma
+        self.intervene_rate = intervene_rate
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.stream_chunks = stream_chunks
+        self.cache_min_tokens = cache_min_tokens
+        self.prefixes = set()
+        self.slots = threading.Semaphore(max_concurrency)
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/"
+
+    def start(self) -> "StandinServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {"requests": 0, "items": 0, "streamed": 0, "errors": 0, "rate_limited": 0,
+                          "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0, "by_kind": {}}
+
+    def random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+
+    def latency(self, kind: str, items: int) -> float:
+        median = self.chat_latency if kind == "chat" else self.base_latency
+        with self.rng_lock:
+            if self.distribution == "lognormal":
+                base = self.rng.lognormvariate(math.log(median), self.sigma) if median > 0 else 0.0
+            elif self.distribution == "exponential":
+                base = self.rng.expovariate(1 / median) if median > 0 else 0.0
+            else:
+                base = median
+        return base + self.per_item * items
+
+    def cached_tokens(self, messages) -> int:
+        """
+        Tokens of the longest leading run of messages seen in an earlier
+        request (everything but the last message is remembered).
+        """
+        digest = hashlib.sha256()
+        prefixes = []
+        tokens = 0
+        for message in messages[:-1]:
+            digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+            tokens += estimate_tokens(message.get("content") or "")
+            prefixes.append((digest.hexdigest(), tokens))
+        with self.stats_lock:
+            cached = max((t for key, t in prefixes if key in self.prefixes), default=0)
+            self.prefixes.update(key for key, _ in prefixes)
+        return cached if cached >= self.cache_min_tokens else 0
+
+
+def decision(server: StandinServer, context) -> dict:
+    latest = str(context.get("latest_message", "")) if isinstance(context, dict) else ""
+    return {
+        "should_intervene": "柒槿年" in latest or (server.intervene_rate > 0 and server.random() < server.intervene_rate),
+        "trigger_level": "none",
+        "reason": "stand-in",
+        "has_significant_info": False,
+    }
+
+
+def answer(server: StandinServer, user_content: str) -> Tuple[str, int, Any]:
+    """
+    (kind, items, answer) for a request.
+    """
+    try:
+        payload = json.loads(user_content)
+    except ValueError:
+        payload = None
+
+    if isinstance(payload, dict) and "requests" in payload:
+        decisions = [dict(decision(server, r.get("context")), id=r.get("id")) for r in payload["requests"]]
+        return "judge_batch", len(payload["requests"]), {"decisions": decisions}
+    if isinstance(payload, dict) and "users" in payload:
+        results = [{"id": u.get("id"), "facts": []} for u in payload["users"]]
+        return "extraction_batch", len(payload["users"]), {"results": results}
+    if isinstance(payload, dict) and "topics" in payload:
+        summaries = [{"id": t.get("id"), "summary": "stand-in summary"} for t in payload["topics"]]
+        return "summary", len(payload["topics"]), {"summaries": summaries}
+    if (isinstance(payload, dict) and payload.get("should_return_summary")) or user_content == "请开始你的表演":
+        count = 1 + int(server.random() * 3)
+        messages = [f"stand-in reply {i + 1}" for i in range(count)]
+        return "chat", 1, {"messages": messages, "summary": "stand-in summary"}
+    if user_content.startswith("Recent User Messages:"):
+        return "extraction", 1, {"facts": []}
+    if user_content.startswith("Current Profile:"):
+        return "profiler", 1, "stand-in profile"
+    return "judge", 1, decision(server, payload)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    server: StandinServer
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        try:
+            self._respond()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the request (timeout, or a newer message cancelled it)
+            pass
+
+    def _respond(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        messages = body.get("messages") or [{}]
+        user_content = messages[-1].get("content") or ""
+        kind, items, result = answer(self.server, user_content)
+        content = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+        stream = bool(body.get("stream"))
+
+        roll = self.server.random()
+        failure = None
+        if roll < self.server.rate_limit_rate:
+            failure = (429, "rate_limit_exceeded", "rate_limited")
+        elif roll < self.server.rate_limit_rate + self.server.error_rate:
+            failure = (500, "server_error", "errors")
+
+        prompt_tokens = sum(estimate_tokens(m.get("content") or "") for m in messages)
+        cached_tokens = 0 if failure else self.server.cached_tokens(messages)
+        completion_tokens = estimate_tokens(content)
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+        with self.server.slots:
+            delay = self.server.latency(kind, items)
+            if failure:
+                time.sleep(delay * 0.1)
+            elif not stream:
+                time.sleep(delay)
+            else:
+                self._stream(body, content, delay, usage)
+
+        with self.server.stats_lock:
+            stats = self.server.stats
+            stats["requests"] += 1
+            if failure:
+                stats[failure[2]] += 1
+            else:
+                stats["items"] += items
+                stats["streamed"] += stream
+                stats["prompt_tokens"] += prompt_tokens
+                stats["cached_tokens"] += cached_tokens
+                stats["completion_tokens"] += completion_tokens
+                stats["by_kind"][kind] = stats["by_kind"].get(kind, 0) + 1
+
+        if failure:
+            self._send_json(failure[0], {"error": {"message": "stand-in injected error", "type": failure[1]}})
+        elif not stream:
+            self._send_json(200, {
+                "id": "chatcmpl-standin",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "standin"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+    def _send_json(self, status: int, payload: Dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, body: Dict, content: str, delay: float, usage: Dict):
+        """
+        Server-sent events: about a third of `delay` before the first chunk,
+        the rest spread over `stream_chunks` chunks (plus a usage chunk if
+        stream_options.include_usage is set).
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        time.sleep(delay / 3)
+        n = max(1, self.server.stream_chunks)
+        size = max(1, math.ceil(len(content) / n))
+        pieces = [content[i:i + size] for i in range(0, len(content), size)]
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(delay * 2 / 3 / len(pieces))
+            self._event({"index": 0, "delta": {"content": piece}, "finish_reason": None}, body)
+        self._event({"index": 0, "delta": {}, "finish_reason": "stop"}, body)
+        if (body.get("stream_options") or {}).get("include_usage"):
+            self._event(None, body, usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _event(self, choice: Dict, body: Dict, usage: Dict = None):
+        chunk = {
+            "id": "chatcmpl-standin",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "standin"),
+            "choices": [choice] if choice else [],
+        }
+        if usage:
+            chunk["usage"] = usage
+        self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    server = StandinServer(int(sys.argv[1]) if len(sys.argv) > 1 else 8088)
+    print(f"Stand-in endpoint on {server.base_url}")
+    server.serve_forever()
@@ -3,6 +3,7 @@ import sqlite3
 import pandas as pd
 import time
 import os
+from services.search import build_match_query
 
 # --- Page Config ---
 st.set_page_config(
@@ -141,6 +142,90 @@ def get_metrics():
         if conn: conn.close()
         return 0, 0, "0%"
 
+def get_llm_calls(hours: int = 24) -> pd.DataFrame:
+    """
+    Per-call LLM telemetry (llm_calls) of the last `hours` hours.
+    """
+    conn = get_connection()
+    if not conn:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(
+            """
+            SELECT started_at, model, kind, queue_ms, latency_ms, prompt_tokens, completion_tokens, outcome, retries, path,
+                   cached_tokens
+            FROM llm_calls WHERE started_at > ?
+            """,
+            conn, params=(time.time() - hours * 3600,)
+        )
+    except Exception:
+        return pd.DataFrame()
+    finally:
+        conn.close()
+
+# Outcomes that are real failures; "cancelled" (superseded) and "shed"
+# (dropped before sending) are the scheduler working as designed
+FAILED_OUTCOMES = ("error", "timeout", "parse_error", "partial")
+
+def latency_table(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Latency percentiles (queue wait + request), failures (of the calls that
+    ran to the end), cancelled and shed calls, retries, how responses were
+    served (hedge / fallback), tokens and the share of prompt tokens served
+    from the provider's prompt cache per call kind.
+    """
+    dropped = df["outcome"].isin(["cancelled", "shed"])
+    df = df.assign(total_ms=df["queue_ms"] + df["latency_ms"],
+                   failed=df["outcome"].isin(FAILED_OUTCOMES).where(~dropped))
+    grouped = df.groupby("kind")
+    return pd.DataFrame({
+        "调用": grouped.size(),
+        "p50 (ms)": grouped["total_ms"].quantile(0.5),
+        "p95 (ms)": grouped["total_ms"].quantile(0.95),
+        "p99 (ms)": grouped["total_ms"].quantile(0.99),
+        "排队 p95 (ms)": grouped["queue_ms"].quantile(0.95),
+        "失败率": grouped["failed"].mean().fillna(0).map(lambda r: f"{r * 100:.1f}%"),
+        "取消": grouped["outcome"].apply(lambda o: (o == "cancelled").sum()),
+        "丢弃": grouped["outcome"].apply(lambda o: (o == "shed").sum()),
+        "重试": grouped["retries"].sum(),
+        "对冲": grouped["path"].apply(lambda p: (p == "hedge").sum()),
+        "降级": grouped["path"].apply(lambda p: (p == "fallback").sum()),
+        "Tokens": grouped["prompt_tokens"].sum() + grouped["completion_tokens"].sum(),
+        "缓存命中": (grouped["cached_tokens"].sum() / grouped["prompt_tokens"].sum().clip(lower=1)).map(lambda r: f"{r * 100:.0f}%"),
+    }).round(0).sort_values("调用", ascending=False)
+
+def tokens_per_hour(df: pd.DataFrame) -> pd.DataFrame:
+    hour = pd.to_datetime(df["started_at"], unit="s").dt.floor("h")
+    tokens = df["prompt_tokens"] + df["completion_tokens"]
+    return tokens.groupby([hour, df["kind"]]).sum().unstack(fill_value=0)
+
+def search_history(query: str, limit: int = 50):
+    """
+    Full-text search over all messages, newest first (FTS5, stays fast on large DBs).
+    """
+    match = build_match_query(query, mode="AND")
+    if not match:
+        return pd.DataFrame()
+    conn = get_connection()
+    if not conn:
+        return pd.DataFrame()
+    try:
+        return pd.read_sql_query(
+            """
+            SELECT t.group_id as '群', m.nickname as '昵称', m.content as '内容',
+                   datetime(m.timestamp, 'unixepoch', 'localtime') as '时间'
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN topics t ON t.id = m.topic_id
+            WHERE messages_fts MATCH ?
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+            """,
+            conn, params=(match, limit)
+        )
+    finally:
+        conn.close()
+
 # --- Header ---
 st.title("🌸 柒槿年 (QJinEra) · 赛博大脑")
 st.caption(f"Last updated: {time.strftime('%H:%M:%S')}")
@@ -168,6 +253,29 @@ m1.metric("🧠 今日思考 (Decisions)", total_d, delta="Today")
 m2.metric("💬 活跃话题 (24h)", active_t)
 m3.metric("⚡ 插话率 (Intervention Rate)", rate)
 
+# --- History Search ---
+search_query = st.text_input("🔍 搜索聊天记录 (Search History)", placeholder="输入关键词，例如：菠萝披萨")
+if search_query:
+    try:
+        df_search = search_history(search_query)
+        if df_search.empty:
+            st.caption("没有找到相关消息")
+        else:
+            st.dataframe(df_search, hide_index=True, use_container_width=True)
+    except Exception as e:
+        st.warning(f"Search error: {e}")
+
+# --- LLM Telemetry ---
+with st.expander("📈 模型调用 (LLM Calls, 24h)", expanded=False):
+    df_calls = get_llm_calls(24)
+    if df_calls.empty:
+        st.caption("暂无调用记录")
+    else:
+        st.caption("延迟 = 排队 + 请求 (含重试)；对冲 / 降级 = 由对冲请求 / 备用模型返回的次数；缓存命中 = 命中服务商提示词缓存的输入 token 比例")
+        st.dataframe(latency_table(df_calls), use_container_width=True)
+        st.caption("每小时 Token 用量 (按调用类型)")
+        st.bar_chart(tokens_per_hour(df_calls))
+
 st.markdown("---")
 
 # --- Main Layout ---
@@ -1,18 +1,45 @@
+import asyncio
 from alicebot import Bot
 from config import settings
+from services.memory import memory_compactor
+from services.retention import retention_manager
+from services.storage import async_storage
+from services.sweeper import topic_sweeper
+from services.topic import topic_manager
 
 async def main():
     
     cqhttp_config = settings.get("adapter.cqhttp")
     
     bot = Bot()
+    background_tasks: list[asyncio.Task] = []
+
+    @bot.bot_run_hook
+    async def on_bot_run(_bot: Bot):
+        # Background flusher for the write-behind storage queue
+        async_storage.start()
+        # Restore still-active topics for all groups before events arrive
+        await topic_manager.warm_start()
+        # Periodic maintenance jobs
+        background_tasks.append(asyncio.create_task(memory_compactor.run_forever()))
+        background_tasks.append(asyncio.create_task(retention_manager.run_forever()))
+        background_tasks.append(asyncio.create_task(topic_manager.evict_forever()))
+        background_tasks.append(asyncio.create_task(topic_sweeper.run_forever()))
+
+    @bot.bot_exit_hook
+    async def on_bot_exit(_bot: Bot):
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        # Make sure every queued write is committed before the process exits
+        await async_storage.close()
     
     print(f"Starting {settings.get('bot', 'name')} ({settings.get('bot', 'english_name')})...")
 
     await bot.run_async()
 
 if __name__ == "__main__":
-    import asyncio
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
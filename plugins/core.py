@@ -3,15 +3,18 @@ from alicebot.adapter.cqhttp.event import GroupMessageEvent
 import asyncio
 import random
 import re
+import time
+from typing import Optional
+from services.group_pipeline import group_pipeline
 from services.topic import topic_manager
 from services.llm import llm_service
+from services.memory_extraction import memory_extractor
+from services.prefilter import prefilter
+from services.speculation import speculator
+from services.storage import async_storage
 from config import settings
 
 class QJinEraPlugin(Plugin):
-    # Class-level dictionary to store debounce tasks
-    # Key: group_id, Value: asyncio.Task
-    _debounce_tasks: dict[str, asyncio.Task] = {}
-
     async def handle(self) -> None:
         event = self.event
         if not isinstance(event, GroupMessageEvent):
@@ -19,8 +22,17 @@ class QJinEraPlugin(Plugin):
 
         print(f"[CorePlugin] Handling event: {event.message_id} from user {event.user_id}")
 
+        # Each group is served by one worker (services/group_pipeline.py):
+        # messages are accepted in arrival order, debounced, and judged /
+        # answered one job at a time
+        group_pipeline.post(str(event.group_id), event, self)
+
+    async def accept(self, group_id: str, event) -> Optional[dict]:
+        """
+        Record a message. Returns the context to reply with if the bot was
+        mentioned, None if the message goes through debounce and the judge.
+        """
         user_id = str(event.user_id)
-        group_id = str(event.group_id)
         
         # [修改] 预处理消息，防止图片被过滤为空字符串
         raw_message = str(event.message)
@@ -38,9 +50,6 @@ class QJinEraPlugin(Plugin):
         if hasattr(event, "sender") and hasattr(event.sender, "nickname"):
             nickname = event.sender.nickname
 
-        # 1. Topic Management & Context Building (Always update immediately)
-        context = topic_manager.handle_message(group_id, user_id, content, nickname)
-        
         # Check if mentioned
         # 1. Check event.to_me (AliceBot standard)
         # 2. Check if message contains [CQ:at,qq=self_id]
@@ -52,132 +61,144 @@ class QJinEraPlugin(Plugin):
             if self_id:
                 if f"[CQ:at,qq={self_id}]" in str(event.message):
                      is_mentioned = True
+
+        # 1. Topic Management (Always update immediately). The context is
+        # only needed to reply right away; the judge re-fetches its own
+        context = await topic_manager.handle_message(group_id, user_id, content, nickname,
+                                                     build_context=is_mentioned)
         
         if is_mentioned:
             context["is_at_mentioned"] = True
-            # If mentioned, cancel any pending debounce task for this group to avoid double reply
-            if group_id in self._debounce_tasks:
-                self._debounce_tasks[group_id].cancel()
-                print(f"[CorePlugin] Mentioned! Cancelled pending debounce for group {group_id}")
-            
             print(f"[CorePlugin] Bot was mentioned. Intervening directly.")
-            # [新增] 直接 @ 时强制触发记忆提取
-            asyncio.create_task(self.update_user_profile(group_id, user_id))
-            
-            await self.process_chat(context, event)
-            return
+            # [新增] 直接 @ 时强制触发记忆提取 (coalesced per user)
+            memory_extractor.request(group_id, user_id)
+            return context
 
-        # 2. Debounce for Judge
-        # Cancel existing task for this group
-        if group_id in self._debounce_tasks:
-            self._debounce_tasks[group_id].cancel()
-            
-        # Schedule new task
-        # Use the current event for replying (it's the latest one)
-        debounce_time = settings.get("topic", "debounce_seconds", 3.0)
-        task = asyncio.create_task(self.debounce_and_judge(group_id, event, debounce_time))
-        self._debounce_tasks[group_id] = task
-        
-        # Note: Memory update is now triggered by the Judge model inside debounce_and_judge
+        # 2. Debounce for Judge (the worker calls judge_and_reply once the group is quiet)
+        # Note: Memory update is triggered by the Judge model inside judge_and_reply
+        return None
 
-    async def debounce_and_judge(self, group_id: str, event, delay: float):
+    async def reply(self, group_id: str, context: dict, event):
+        await self.process_chat(context, event)
+
+    async def judge_and_reply(self, group_id: str, event):
+        speculation = None
         try:
-            await asyncio.sleep(delay)
-            
             # Get fresh context (re-fetch because new messages might have arrived)
-            context = topic_manager.get_latest_context(group_id)
+            context = await topic_manager.get_latest_context(group_id)
             if not context:
                 return
 
-            print(f"[CorePlugin] Debounce finished. Asking Judge Model...")
-            judge_result = await llm_service.judge_interruption(context)
+            # Clear-cut cases are decided by local rules without a judge call
+            judge_result = prefilter.check(context)
+            if judge_result:
+                judge_model = f"prefilter:{judge_result['rule']}"
+                print(f"[CorePlugin] Pre-filter '{judge_result['rule']}' decided: {judge_result['reason']} "
+                      f"(judge calls avoided: {prefilter.stats['avoided']})")
+            else:
+                print(f"[CorePlugin] Debounce finished. Asking Judge Model...")
+                # Likely replies start generating now, overlapped with the judge
+                speculation = speculator.start(group_id, context)
+                judge_model = settings.get("llm", "judge_model", "unknown")
+                # Not worth sending once the group has moved on (a newer message
+                # will be judged on its own)
+                asked_at = topic_manager.group_last_activity.get(group_id)
+                judge_result = await llm_service.judge_interruption(
+                    context, stale=lambda: topic_manager.group_last_activity.get(group_id) != asked_at, group_id=group_id
+                )
             
-            # [新增] 核心修改：将思考过程写入数据库
+            # [新增] 核心修改：将思考过程写入数据库 (queued, committed in the background)
             try:
-                from services.storage import storage
-                storage.add_decision_log(
+                async_storage.add_decision_log(
                     group_id=group_id,
-                    judge_model=settings.get("llm", "judge_model", "unknown"),
+                    judge_model=judge_model,
                     result=judge_result,
                     context_summary=context.get("topic_summary", "")
                 )
             except Exception as e:
                 print(f"[CorePlugin] Log Error: {e}")
+            speculator.note_decision(group_id, judge_result)
 
             # 1. Memory Extraction Trigger
             # If the Judge thinks there's significant info, trigger the extractor
             if judge_result.get("has_significant_info", False):
                 user_id = str(event.user_id) # Use the ID from the event that triggered this
                 print(f"[CorePlugin] Judge detected significant info. Triggering memory extraction for {user_id}...")
-                asyncio.create_task(self.update_user_profile(group_id, user_id))
+                memory_extractor.request(group_id, user_id)
 
             # 2. Intervention Decision
             should_intervene = judge_result.get("should_intervene", False)
             print(f"[CorePlugin] Judge Result: {should_intervene}")
             
+            # A speculative reply is either taken over by process_chat or dropped
+            speculated, speculation = speculation, None
+            if speculated is not None:
+                if should_intervene:
+                    speculator.hit(speculated)
+                else:
+                    speculator.miss(speculated)
+                    speculated = None
+
             if should_intervene:
-                await self.process_chat(context, event)
+                await self.process_chat(context, event, speculated)
                 
         except asyncio.CancelledError:
-            # This is expected when a new message arrives before the timer expires
+            # This is expected when a new message arrives while judging
             pass
         except Exception as e:
-            print(f"[CorePlugin] Error in debounce task: {e}")
+            print(f"[CorePlugin] Error in judge task: {e}")
+        finally:
+            # Cancelled (or failed) before the judge answered
+            if speculation is not None:
+                speculator.miss(speculation, cancelled=True)
 
-    async def process_chat(self, context: dict, event):
+    async def process_chat(self, context: dict, event, speculation=None):
         print(f"[CorePlugin] Generating Chat Response...")
         # 3. Generate Chat Response
         context["should_return_summary"] = True 
         
-        chat_result = await llm_service.generate_chat(context)
-        messages = chat_result.get("messages", [])
-        summary = chat_result.get("summary")
+        # Messages are sent while the rest of the reply is still being
+        # generated; the typing delay overlaps with generation
+        group_id = str(event.group_id)
+        outbox: asyncio.Queue = asyncio.Queue()
+        started = speculation.started if speculation else time.monotonic()
+        sender = asyncio.create_task(self.send_messages(outbox, event, started))
+        try:
+            if speculation:
+                # Already generating since before the judge answered
+                speculation.attach(outbox.put_nowait)
+                chat_result = await speculation.task
+            else:
+                chat_result = await llm_service.generate_chat(context, on_message=outbox.put_nowait, group_id=group_id)
+        except BaseException:
+            # Cancelled (a newer job took over) or failed: stop speaking
+            sender.cancel()
+            raise
+        outbox.put_nowait(None)
         
+        summary = chat_result.get("summary")
         if summary:
-            topic_manager.update_summary(str(event.group_id), summary)
-            
-        for msg in messages:
-            # Simulate typing delay
+            topic_manager.update_summary(group_id, summary)
+        
+        await sender
+
+    async def send_messages(self, outbox: asyncio.Queue, event, started: float):
+        group_id = str(event.group_id)
+        bot_id = str(getattr(event, "self_id", "bot"))
+        last_sent = started
+        while True:
+            msg = await outbox.get()
+            if msg is None:
+                return
+            # Simulate typing delay, counted from the previous message (or the
+            # start of generation), so time spent generating counts as typing
             delay = random.uniform(0.3, 1.2) + (len(msg) * 0.05)
-            await asyncio.sleep(delay)
+            await asyncio.sleep(max(0.0, last_sent + delay - time.monotonic()))
             await event.reply(msg)
+            last_sent = time.monotonic()
             
             # Record bot's own message
-            bot_id = str(getattr(event, "self_id", "bot"))
-            topic_manager.add_bot_message(str(event.group_id), msg, bot_id, "柒槿年")
-
-    async def update_user_profile(self, group_id: str, user_id: str):
-        try:
-            from services.storage import storage
-            
-            # Check if user exists (to ensure basic record)
-            user = storage.get_user(group_id, user_id)
-            if not user:
-                return
-
-            # Get recent messages from this user in this group
-            topic = topic_manager.get_current_topic(group_id)
-            if not topic:
-                return
-                
-            user_msgs = [m["content"] for m in topic["messages"] if m["user_id"] == user_id]
-            if len(user_msgs) < 2: # Reduce threshold to capture facts quickly
-                return
-
-            print(f"[CorePlugin] Extracting memories for user {user_id}...")
-            
-            # Extract new facts
-            new_facts = await llm_service.extract_memories(user_msgs[-10:])
-            
-            if new_facts:
-                print(f"[CorePlugin] Found {len(new_facts)} new memories for {user_id}")
-                for fact in new_facts:
-                    storage.add_memory(user_id, group_id, fact)
-                    print(f"  + Memory: {fact}")
-                
-        except Exception as e:
-            print(f"[CorePlugin] Error updating user profile: {e}")
-
+            await topic_manager.add_bot_message(group_id, msg, bot_id, "柒槿年")
 
     async def rule(self) -> bool:
         return isinstance(self.event, GroupMessageEvent)
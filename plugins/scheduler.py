@@ -64,7 +64,7 @@ class SchedulerPlugin(Plugin):
                         print(f"[Scheduler] Group {group_id} is inactive (> {threshold_minutes}m). Triggering proactive message.")
                         
                         # Generate topic
-                        result = await llm_service.generate_proactive_topic()
+                        result = await llm_service.generate_proactive_topic(group_id)
                         messages = result.get("messages", [])
                         
                         if messages:
@@ -88,7 +88,7 @@ class SchedulerPlugin(Plugin):
                                     bot_id = "bot" 
                                     # In AliceBot CQHTTP, adapter usually has bot info after connect
                                     
-                                    topic_manager.add_bot_message(group_id, msg, bot_id, "柒槿年")
+                                    await topic_manager.add_bot_message(group_id, msg, bot_id, "柒槿年")
                                     
                                     await asyncio.sleep(2) # Delay
                                     
@@ -0,0 +1,58 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+
+class MicroBatcher:
+    """
+    Collects items submitted within `max_wait` seconds (or until `max_size`
+    are queued) and hands them to `handler` in one call. `handler` returns
+    one result per item, in order; each submitter gets its own result back.
+    If the handler raises, every submitter of that batch gets the exception.
+    """
+
+    def __init__(self, handler: Callable[[List[Any]], Awaitable[List[Any]]], max_wait: float, max_size: int):
+        self._handler = handler
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self._queue: List[Tuple[Any, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.stats = {"items": 0, "batches": 0, "max_batch": 0}
+
+    async def submit(self, item: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((item, future))
+        self.stats["items"] += 1
+        if len(self._queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if not batch:
+            return
+        self.stats["batches"] += 1
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        task = asyncio.create_task(self._run(batch))
+        # Keep a reference until done so the task is not garbage collected
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[Any, asyncio.Future]]):
+        try:
+            results = await self._handler([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            # Submitters may have been cancelled meanwhile
+            if not future.done():
+                future.set_result(result)
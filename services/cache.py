@@ -0,0 +1,173 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+from config import settings
+from services.storage import async_storage
+
+# Returned by LRUCache.get for absent/expired keys (None is a cacheable value)
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Size-bounded LRU with an optional time-to-live per entry.
+    """
+
+    def __init__(self, max_entries: int, ttl: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        # key -> (expires_at, value)
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key: Hashable) -> Any:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return MISSING
+        expires_at, value = entry
+        if expires_at < self._clock():
+            del self._entries[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return value
+
+    def peek(self, key: Hashable) -> Any:
+        """
+        Like get, without touching LRU order or counters.
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < self._clock():
+            return MISSING
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, keep_expiry: bool = False):
+        expires_at = self._clock() + self.ttl if self.ttl else float("inf")
+        if keep_expiry and key in self._entries:
+            expires_at = self._entries[key][0]
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def pop(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.peek(key) is not MISSING
+
+    def hit_rate(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+
+class ContextCache:
+    """
+    In-process cache for the slow-changing inputs of TopicManager._build_context:
+    a group's recent summarized topics and user profiles. (Full-text topic
+    matches are not cached: the query includes the sliding window of recent
+    messages, so it practically never repeats.)
+
+    Entries are dropped as soon as the AsyncStorage write that changes them
+    is committed (update_topic_summary, update_user, update_user_description)
+    and expire after `context_ttl_seconds` regardless, as a safety net.
+    Per-group / per-user generation counters stop a read that raced with such
+    a write from caching the pre-write result.
+    """
+
+    def __init__(self):
+        max_entries = settings.get("cache", "context_max_entries", 2048)
+        ttl = settings.get("cache", "context_ttl_seconds", 300)
+        self.recent_topics = LRUCache(max_entries, ttl)
+        self.profiles = LRUCache(max_entries, ttl)
+        # topic_id -> group_id, so a summary update knows which group to drop
+        self._topic_groups = LRUCache(max_entries * 4)
+        self._group_generations: Dict[str, int] = {}
+        self._user_generations: Dict[Tuple[str, str], int] = {}
+
+    def note_topic(self, topic_id: int, group_id: str):
+        self._topic_groups.put(topic_id, group_id)
+
+    # Invalidation (AsyncStorage listeners)
+    def invalidate_group(self, group_id: str):
+        self._group_generations[group_id] = self._group_generations.get(group_id, 0) + 1
+        self.recent_topics.pop(group_id)
+
+    def on_topic_summary(self, topic_id: int, *_):
+        group_id = self._topic_groups.peek(topic_id)
+        if group_id is MISSING:
+            # Unknown topic: cannot tell which group, drop every group
+            for group_id in list(self._group_generations):
+                self.invalidate_group(group_id)
+            self.recent_topics.clear()
+            return
+        self.invalidate_group(group_id)
+
+    def invalidate_user(self, group_id: str, user_id: str, *_):
+        key = (group_id, user_id)
+        self._user_generations[key] = self._user_generations.get(key, 0) + 1
+        self.profiles.pop(key)
+
+    def on_user_activity(self, group_id: str, user_id: str, nickname: str, timestamp: float):
+        # Write through instead of dropping: this runs for every message
+        key = (group_id, user_id)
+        profile = self.profiles.peek(key)
+        if profile is MISSING or profile is None:
+            # Not cached, or cached as "no such user" before the insert landed
+            self.invalidate_user(group_id, user_id)
+            return
+        profile = dict(profile, nickname=nickname, last_active_time=timestamp,
+                       interaction_count=profile["interaction_count"] + 1)
+        self.profiles.put(key, profile, keep_expiry=True)
+
+    # Cached reads
+    async def get_recent_topics(self, group_id: str, limit: int = 5) -> List[Dict]:
+        # Cached as (limit fetched with, topics): a shorter list is complete
+        # when the group has fewer topics than that limit
+        cached = self.recent_topics.get(group_id)
+        if cached is not MISSING:
+            fetched_limit, topics = cached
+            if fetched_limit >= limit or len(topics) >= limit:
+                return topics[:limit]
+        generation = self._group_generations.get(group_id, 0)
+        topics = await async_storage.get_recent_topics(group_id, limit)
+        if self._group_generations.get(group_id, 0) == generation:
+            self.recent_topics.put(group_id, (limit, topics))
+        return topics
+
+    async def get_user(self, group_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        key = (group_id, user_id)
+        cached = self.profiles.get(key)
+        if cached is not MISSING:
+            return cached
+        generation = self._user_generations.get(key, 0)
+        profile = await async_storage.get_user(group_id, user_id)
+        if self._user_generations.get(key, 0) == generation:
+            self.profiles.put(key, profile)
+        return profile
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: dict(cache.stats, size=len(cache))
+            for name, cache in (
+                ("recent_topics", self.recent_topics),
+                ("profiles", self.profiles),
+            )
+        }
+
+
+context_cache = ContextCache()
+async_storage.add_listener("update_topic_summary", context_cache.on_topic_summary)
+async_storage.add_listener("update_user_description", context_cache.invalidate_user)
+async_storage.add_listener("update_user", context_cache.on_user_activity)
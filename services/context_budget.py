@@ -0,0 +1,102 @@
+import json
+from typing import Any, Dict, List, Tuple
+from config import settings
+from services.tokens import estimate_tokens, truncate_tokens
+
+_MEMORY_HEADER = "User Memories:"
+
+# What gives way first when a context is over budget: (section, items kept).
+# Memories and past topics are ranked best first, so they lose their tail;
+# recent messages lose the oldest lines.
+_DROP_ORDER: Tuple[Tuple[str, int], ...] = (
+    ("user_memories", 5),
+    ("past_topics", 2),
+    ("recent_messages", 5),
+    ("user_memories", 0),
+    ("past_topics", 0),
+    ("recent_messages", 2),
+)
+
+
+class ContextBudget:
+    """
+    Keeps the context dict sent to the judge and the writer within a token
+    budget per model ([context] max_tokens, overridable per model).
+
+    Single long items are truncated first (messages, profile, topic summary),
+    then whole items are dropped in _DROP_ORDER until the estimate fits.
+    Persona, latest message and the time fields are never dropped.
+    """
+
+    def __init__(self):
+        self.default_budget = settings.get("context", "max_tokens", 3000)
+        # {model: max_tokens}
+        self.model_budgets: Dict[str, int] = settings.get("context", "models", {})
+        self.max_message_tokens = settings.get("context", "max_message_tokens", 150)
+        self.max_profile_tokens = settings.get("context", "max_profile_tokens", 200)
+        self.max_summary_tokens = settings.get("context", "max_summary_tokens", 200)
+        self.stats = {"fitted": 0, "trimmed": 0, "dropped": 0}
+
+    def budget_for(self, model: str) -> int:
+        return self.model_budgets.get(model, self.default_budget)
+
+    @staticmethod
+    def count(context: Dict[str, Any]) -> int:
+        return estimate_tokens(json.dumps(context, ensure_ascii=False))
+
+    def fit(self, context: Dict[str, Any], model: str) -> Dict[str, Any]:
+        """
+        A copy of `context` that fits the budget of `model`.
+        """
+        budget = self.budget_for(model)
+        ctx = dict(context)
+        self.stats["fitted"] += 1
+
+        ctx["recent_messages"] = [truncate_tokens(line, self.max_message_tokens)
+                                  for line in ctx.get("recent_messages") or []]
+        ctx["latest_message"] = truncate_tokens(ctx.get("latest_message") or "", self.max_message_tokens)
+        ctx["user_profile"] = truncate_tokens(ctx.get("user_profile") or "", self.max_profile_tokens)
+        if ctx.get("topic_summary"):
+            ctx["topic_summary"] = truncate_tokens(ctx["topic_summary"], self.max_summary_tokens)
+
+        total = self.count(ctx)
+        if total <= budget:
+            return ctx
+
+        sections: Dict[str, List[str]] = {
+            "recent_messages": ctx["recent_messages"],
+            "past_topics": ctx["past_topics"].split("\n") if ctx.get("past_topics") else [],
+            "user_memories": ctx["user_memories"].split("\n")[1:] if ctx.get("user_memories") else [],
+        }
+        before = total
+        dropped = 0
+        while True:
+            # Per-item costs are estimates: recount after each pass and go on
+            # while over budget and something can still be dropped
+            dropped_now = 0
+            for name, keep in _DROP_ORDER:
+                items = sections[name]
+                while total > budget and len(items) > keep:
+                    item = items.pop(0) if name == "recent_messages" else items.pop()
+                    # +1 for the separator / quotes around it
+                    total -= estimate_tokens(item) + 1
+                    dropped_now += 1
+                if total <= budget:
+                    break
+            dropped += dropped_now
+
+            ctx["recent_messages"] = sections["recent_messages"]
+            ctx["past_topics"] = "\n".join(sections["past_topics"])
+            memories = sections["user_memories"]
+            ctx["user_memories"] = "\n".join([_MEMORY_HEADER] + memories) if memories else ""
+            total = self.count(ctx)
+            if total <= budget or not dropped_now:
+                break
+
+        self.stats["trimmed"] += 1
+        self.stats["dropped"] += dropped
+        print(f"[Context] {model}: ~{before} -> ~{total} tokens (budget {budget}), dropped {dropped} items")
+        return ctx
+
+
+context_budget = ContextBudget()
@@ -0,0 +1,205 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Protocol, Tuple
+from config import settings
+
+
+class GroupHandler(Protocol):
+    """
+    What the pipeline calls back into (QJinEraPlugin).
+    """
+
+    async def accept(self, group_id: str, event) -> Optional[Dict[str, Any]]:
+        """
+        Record one message, in arrival order. Returns the context to reply
+        with at once (the bot was mentioned), or None to debounce.
+        """
+
+    async def judge_and_reply(self, group_id: str, event):
+        """
+        The group has been quiet for the debounce time: judge, maybe reply.
+        """
+
+    async def reply(self, group_id: str, context: Dict[str, Any], event):
+        """
+        Answer a mention.
+        """
+
+
+class GroupWorker:
+    """
+    The long-lived worker of one group. Messages are accepted strictly in
+    arrival order; every message pushes the debounce deadline back. At most
+    one job (judge + reply, or a mention reply) runs at a time:
+    - a newer message supersedes (cancels) a running judge job, as the
+      judge would be deciding on an outdated conversation;
+    - a mention cancels the pending / running judge job and is answered
+      next; mentions queue behind a running mention reply.
+    The worker exits after `idle_seconds` without work.
+    """
+
+    def __init__(self, pipeline: "GroupPipeline", group_id: str):
+        self.pipeline = pipeline
+        self.group_id = group_id
+        self.inbox: Deque[Tuple[Any, GroupHandler]] = deque()
+        self.mentions: Deque[Tuple[GroupHandler, Dict[str, Any], Any]] = deque()
+        self.deadline: Optional[float] = None
+        self.latest: Optional[Tuple[GroupHandler, Any]] = None
+        self.job: Optional[asyncio.Task] = None
+        self.job_kind: Optional[str] = None
+        self.wake = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def depth(self) -> int:
+        """
+        Messages not yet accepted plus mentions waiting for their reply.
+        """
+        return len(self.inbox) + len(self.mentions)
+
+    def busy(self) -> bool:
+        return bool(self.inbox or self.mentions or self.deadline is not None or self.job is not None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                self.wake.clear()
+                while self.inbox:
+                    event, handler = self.inbox.popleft()
+                    await self._accept(event, handler)
+                self._start_job(loop.time())
+
+                if self.job is not None:
+                    timeout = None
+                elif self.deadline is not None:
+                    timeout = max(0.0, self.deadline - loop.time())
+                else:
+                    timeout = self.pipeline.idle_seconds
+                try:
+                    await asyncio.wait_for(self.wake.wait(), timeout)
+                except asyncio.TimeoutError:
+                    if not self.busy():
+                        return
+        finally:
+            if self.job is not None:
+                self.job.cancel()
+            if self.pipeline._workers.get(self.group_id) is self:
+                del self.pipeline._workers[self.group_id]
+
+    async def _accept(self, event, handler: GroupHandler):
+        try:
+            context = await handler.accept(self.group_id, event)
+        except Exception as e:
+            print(f"[GroupPipeline] Error accepting message in group {self.group_id}: {e}")
+            return
+        if context is None:
+            self.deadline = asyncio.get_running_loop().time() + self.pipeline.debounce
+            self.latest = (handler, event)
+            self._cancel_judge("superseded")
+            return
+
+        # Mentioned: reply instead of the pending judge (avoids a double reply)
+        if self.deadline is not None or self.job_kind == "judge":
+            print(f"[GroupPipeline] Mentioned! Dropped pending judge for group {self.group_id}")
+        self.deadline = None
+        self.latest = None
+        self._cancel_judge("preempted")
+        self.mentions.append((handler, context, event))
+        if len(self.mentions) > self.pipeline.max_pending_mentions:
+            self.mentions.popleft()
+            self.pipeline.stats["dropped_mentions"] += 1
+            print(f"[GroupPipeline] Too many pending mentions in group {self.group_id}, dropped the oldest")
+
+    def _cancel_judge(self, reason: str):
+        if self.job_kind == "judge" and self.job is not None and not self.job.done():
+            self.job.cancel()
+            self.pipeline.stats[reason] += 1
+
+    def _start_job(self, now: float):
+        if self.job is not None:
+            if not self.job.done():
+                return
+            self.job = self.job_kind = None
+        if self.mentions:
+            handler, context, event = self.mentions.popleft()
+            self._run_job("mention", handler.reply(self.group_id, context, event))
+        elif self.deadline is not None and now >= self.deadline:
+            handler, event = self.latest
+            self.deadline = self.latest = None
+            self._run_job("judge", handler.judge_and_reply(self.group_id, event))
+
+    def _run_job(self, kind: str, coro):
+        self.pipeline.stats[f"{kind}_jobs"] += 1
+        self.job_kind = kind
+        self.job = asyncio.create_task(self.pipeline._limited(coro))
+        self.job.add_done_callback(lambda job: self._job_done(job, coro))
+
+    def _job_done(self, job: asyncio.Task, coro):
+        # Cancelled before it got a slot: the job never started
+        coro.close()
+        if not job.cancelled() and job.exception() is not None:
+            print(f"[GroupPipeline] Job failed in group {self.group_id}: {job.exception()!r}")
+        self.wake.set()
+
+
+class GroupPipeline:
+    """
+    Serves every group with one long-lived GroupWorker fed by an inbound
+    queue, instead of a new debounce task per message.
+
+    Fairness: a group never has more than one job (judge or reply) in flight
+    and at most `max_pending_mentions` waiting, however fast it floods, and
+    jobs of all groups share `max_concurrent_jobs` slots handed out in
+    arrival order, so waiting groups are served round-robin. Model requests
+    are then ordered by the LLM scheduler's priorities.
+    """
+
+    def __init__(self):
+        self.debounce = settings.get("topic", "debounce_seconds", 3.0)
+        self.idle_seconds = settings.get("pipeline", "idle_seconds", 600)
+        self.max_pending_mentions = settings.get("pipeline", "max_pending_mentions", 3)
+        max_jobs = settings.get("pipeline", "max_concurrent_jobs", 64)
+        self._slots = asyncio.Semaphore(max_jobs) if max_jobs > 0 else None
+        self._workers: Dict[str, GroupWorker] = {}
+        self.stats = {"messages": 0, "judge_jobs": 0, "mention_jobs": 0, "superseded": 0, "preempted": 0,
+                      "dropped_mentions": 0, "workers_started": 0}
+
+    def post(self, group_id: str, event, handler: GroupHandler):
+        """
+        Queue a message for its group's worker (started if needed). Returns at once.
+        """
+        worker = self._workers.get(group_id)
+        if worker is None:
+            worker = self._workers[group_id] = GroupWorker(self, group_id)
+            self.stats["workers_started"] += 1
+        self.stats["messages"] += 1
+        worker.inbox.append((event, handler))
+        worker.wake.set()
+
+    async def _limited(self, coro):
+        if self._slots is None:
+            return await coro
+        async with self._slots:
+            return await coro
+
+    def depth(self, group_id: str) -> int:
+        worker = self._workers.get(group_id)
+        return worker.depth() if worker else 0
+
+    def busy(self) -> bool:
+        """
+        Whether any group still has messages, a debounce or a job pending.
+        """
+        return any(w.busy() for w in self._workers.values())
+
+    def gauges(self) -> Dict[str, int]:
+        depths = [w.depth() for w in self._workers.values()]
+        return {
+            "workers": len(self._workers),
+            "queued": sum(depths),
+            "max_depth": max(depths, default=0),
+            "jobs_running": sum(1 for w in self._workers.values() if w.job is not None),
+        }
+
+
+group_pipeline = GroupPipeline()
@@ -0,0 +1,73 @@
+import json
+from typing import List, Optional
+
+
+class JSONArrayStreamer:
+    """
+    Pulls the string items of one top-level array field out of a JSON object
+    while it is still streaming in, e.g. the "messages" of
+    {"messages": ["a", "b"], "summary": "..."}: feed() returns "a" as soon as
+    its closing quote arrives.
+
+    Only tracks what it needs (nesting, strings, keys of the top-level
+    object); anything before the first "{" (such as a code fence) is ignored.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.items: List[str] = []
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._buf: List[str] = []
+        self._expect_key = False
+        # Key of the top-level field currently being read
+        self._field: Optional[str] = None
+
+    def feed(self, text: str) -> List[str]:
+        completed = []
+        for ch in text:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._string_done("".join(self._buf), completed)
+                    self._buf = []
+                    continue
+                self._buf.append(ch)
+                continue
+
+            if ch == '"':
+                if self._stack:
+                    self._in_string = True
+            elif ch == "{":
+                self._stack.append("{")
+                self._expect_key = True
+            elif ch == "[":
+                if self._stack:
+                    self._stack.append("[")
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                self._expect_key = False
+            elif ch == ",":
+                self._expect_key = bool(self._stack) and self._stack[-1] == "{"
+            elif ch == ":":
+                self._expect_key = False
+        return completed
+
+    def _string_done(self, raw: str, completed: List[str]):
+        try:
+            value = json.loads(f'"{raw}"', strict=False)
+        except ValueError:
+            value = raw
+        if self._stack[-1] == "{" and self._expect_key:
+            if len(self._stack) == 1:
+                self._field = value
+            self._expect_key = False
+        elif self._stack == ["{", "["] and self._field == self.key:
+            self.items.append(value)
+            completed.append(value)
@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import re
+import unicodedata
+from typing import Any, Awaitable, Callable, Dict, List, Sequence, Tuple
+from config import settings
+from services.cache import LRUCache, MISSING
+from services.tokens import estimate_tokens
+
+# Gap boundaries (seconds) the judge prompt actually distinguishes: < 2s is
+# "still typing", > 5s is "paragraph finished"
+_GAP_BUCKETS = (2.0, 5.0)
+
+# Image/sticker placeholders produced by the core plugin
+_PLACEHOLDER = re.compile(r"\[(?:图片|表情/图片|表情)\]")
+_SPACES = re.compile(r"\s+")
+# "哈哈哈哈哈" and "哈哈哈" mean the same to the judge
+_REPEATED_CHAR = re.compile(r"(.)\1{2,}")
+
+
+def bucket(seconds: float) -> int:
+    for i, bound in enumerate(_GAP_BUCKETS):
+        if seconds < bound:
+            return i
+    return len(_GAP_BUCKETS)
+
+
+def normalize_content(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    text = _PLACEHOLDER.sub("[img]", text)
+    text = _REPEATED_CHAR.sub(r"\1\1\1", text)
+    return _SPACES.sub(" ", text).strip()
+
+
+def canonical_window(lines: Sequence[str], bot_names: Sequence[str]) -> List[Tuple[str, str, int]]:
+    """
+    recent_messages as [(speaker role, normalized content, repeat bucket)].
+
+    Speakers are reduced to "bot", "self" (whoever sent the latest line) or
+    "other"; consecutive identical contents (复读) collapse into one entry
+    with a count of 1, 2 or 3+.
+    """
+    parsed = []
+    for line in lines:
+        name, sep, content = line.partition(": ")
+        if not sep:
+            name, content = "", line
+        parsed.append((name, normalize_content(content)))
+    latest_speaker = parsed[-1][0] if parsed else ""
+
+    window: List[Tuple[str, str, int]] = []
+    for name, content in parsed:
+        role = "bot" if name in bot_names else "self" if name == latest_speaker else "other"
+        if window and window[-1][1] == content:
+            prev_role, _, count = window[-1]
+            # A repeat chain keeps the bot marker if the bot took part
+            window[-1] = ("bot" if prev_role == "bot" else role, content, min(count + 1, 3))
+        else:
+            window.append((role, content, 1))
+    return window
+
+
+def fingerprint(context: Dict[str, Any], bot_names: Sequence[str], window: int = 3) -> str:
+    """
+    Canonical key of the judge-relevant part of a context: the last `window`
+    entries of the canonical recent window, the latest message, the mention
+    flag and the bucketed time gaps. The group gap is not among the judge's
+    documented inputs, so only "the group was silent for long" is kept of it.
+    """
+    parts = [
+        repr(canonical_window(context.get("recent_messages") or [], bot_names)[-window:]),
+        normalize_content(context.get("latest_message", "")),
+        "@" if context.get("is_at_mentioned") else "-",
+        str(bucket(context.get("time_since_last_user_message", 9999.0))),
+        "quiet" if context.get("time_since_last_group_message", 0) >= 300 else "",
+    ]
+    return hashlib.blake2b("\x1f".join(parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class JudgeCache:
+    """
+    Reuses judge decisions for effectively identical inputs.
+
+    Decisions are kept `judge_ttl_seconds` in an LRU of `judge_max_entries`.
+    A call for a key that is already being judged joins that call; the call
+    itself is shielded, so a debounce cancelled mid-flight still fills the
+    cache for the re-judge that follows.
+    """
+
+    def __init__(self):
+        self.bot_names = [
+            n for n in (settings.get("bot", "name"), settings.get("bot", "english_name"), "QJinEra", "bot") if n
+        ]
+        self._decisions = LRUCache(
+            settings.get("cache", "judge_max_entries", 1024),
+            settings.get("cache", "judge_ttl_seconds", 120)
+        )
+        self.window = settings.get("cache", "judge_window", 3)
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {"calls": 0, "hits": 0, "joined": 0, "saved_tokens": 0}
+
+    async def get_or_call(self, context: Dict[str, Any], prompt_tokens: int,
+                          call: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        key = fingerprint(context, self.bot_names, self.window)
+        cached = self._decisions.get(key)
+        if cached is not MISSING:
+            self.stats["hits"] += 1
+            self.stats["saved_tokens"] += prompt_tokens
+            return dict(cached)
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.stats["joined"] += 1
+            self.stats["saved_tokens"] += prompt_tokens
+        else:
+            self.stats["calls"] += 1
+            task = asyncio.create_task(call())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._store(key, t))
+        return dict(await asyncio.shield(task))
+
+    def _store(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        # {} means the call failed; do not pin a failure
+        if result:
+            self._decisions.put(key, result)
+
+    def hit_rate(self) -> float:
+        total = self.stats["calls"] + self.stats["hits"] + self.stats["joined"]
+        return (self.stats["hits"] + self.stats["joined"]) / total if total else 0.0
+
+    @staticmethod
+    def estimate_prompt_tokens(system_prompt: str, user_content: str) -> int:
+        return estimate_tokens(system_prompt or "") + estimate_tokens(user_content)
+
+
+judge_cache = JudgeCache()
@@ -1,7 +1,18 @@
+import asyncio
 import openai
 import json
-from typing import Dict, Any, List, Optional
+import time
+from typing import Callable, Dict, Any, List, Optional, Sequence, Tuple
 from config import settings
+from services.batching import MicroBatcher
+from services.context_budget import context_budget
+from services.json_stream import JSONArrayStreamer
+from services.judge_cache import judge_cache
+from services.llm_scheduler import LLMShed, Priority, llm_scheduler
+from services.llm_resilience import ResiliencePolicy, backoff_delay, is_retriable, is_timeout
+from services.prompt_layout import build_messages, prompt_layout
+from services.telemetry import LLMCall, telemetry
+from services.tokens import estimate_tokens
 
 class LLMService:
     def __init__(self):
@@ -12,73 +23,428 @@ class LLMService:
         self.client = openai.AsyncOpenAI(
             api_key=self.api_key,
             base_url=self.api_base,
+            # Retries and timeouts are handled per call kind (see _request)
+            max_retries=0,
             http_client=openai.DefaultAsyncHttpxClient(proxy=self.proxy) if self.proxy else None
         )
         
         self.judge_model = settings.get("llm", "judge_model", "gpt-3.5-turbo")
         self.chat_model = settings.get("llm", "chat_model", "gpt-4")
+        # Stream chat replies and hand over each message as soon as it is complete
+        self.chat_streaming = settings.get("llm", "chat_streaming", True)
 
-    async def _call_llm(self, model: str, system_prompt: str, user_content: str, json_mode: bool = True) -> Dict[str, Any]:
-        print(f"[{model}] Requesting...")
+        # Opt-in: judge requests from different groups arriving within
+        # judge_batch_max_wait_ms are sent as one request
+        self.judge_batcher: Optional[MicroBatcher] = None
+        if settings.get("llm", "judge_batching", False):
+            self.enable_judge_batching(
+                settings.get("llm", "judge_batch_max_wait_ms", 150) / 1000,
+                settings.get("llm", "judge_batch_size", 8)
+            )
+        self.judge_stats = {"batched_calls": 0, "single_calls": 0, "fallbacks": 0, "stale": 0}
+        self.resilience = ResiliencePolicy()
+        self.resilience_stats = {"retries": 0, "hedged": 0, "fallbacks": 0}
+        # Completion tokens assumed per request until the real usage is known
+        self.completion_estimate = settings.get("llm_scheduler", "completion_tokens_estimate", 300)
+
+    def enable_judge_batching(self, max_wait: float, max_size: int):
+        self.judge_batcher = MicroBatcher(self._judge_many, max_wait, max_size)
+
+    async def _call_llm(self, model: str, system_prompt: str, user_content: str, json_mode: bool = True,
+                        priority: Priority = Priority.JUDGE, stale: Optional[Callable[[], bool]] = None,
+                        kind: str = "judge", group_id: str = "", prefix: Sequence[str] = ()) -> Dict[str, Any]:
+        """
+        `prefix` holds user messages sent before `user_content` (the stable
+        context, see PromptLayout).
+        """
+        prompt_tokens = estimate_tokens(system_prompt or "") + sum(map(estimate_tokens, [*prefix, user_content]))
+        print(f"[{model}] Requesting {kind}... (~{prompt_tokens} prompt tokens)")
         
+        call = telemetry.start(model, kind, group_id, prompt_tokens)
+        request = {
+            "messages": build_messages(system_prompt, prefix, user_content),
+            "response_format": {"type": "json_object"} if json_mode else None
+        }
         try:
-            response = await self.client.chat.completions.create(
-                model=model,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                response_format={"type": "json_object"} if json_mode else None
-            )
+            response = await self._request(call, request, priority, stale)
             content = response.choices[0].message.content
-            print(f"[{model}] Response: {content}")
-            
-            if json_mode:
-                return json.loads(content)
-            return content
+            call.completion_tokens = estimate_tokens(content or "")
+            call.usage(response.usage)
+            print(f"[{call.model}] Response ({call.path}, {call.cached_tokens}/{call.prompt_tokens} cached): {content}")
+        except LLMShed as e:
+            print(f"[{model}] Dropped: {e}")
+            telemetry.finish(call, "shed")
+            return {}
+        except asyncio.CancelledError:
+            telemetry.finish(call, "cancelled")
+            raise
         except Exception as e:
-            print(f"LLM Call Error: {e}")
+            print(f"LLM Call Error: {e!r}")
+            telemetry.finish(call, "timeout" if is_timeout(e) else "error")
             return {}
 
-    async def judge_interruption(self, context: Dict[str, Any]) -> Dict[str, Any]:
+        if not json_mode:
+            telemetry.finish(call, "ok")
+            return content
+        try:
+            result = json.loads(content)
+        except (TypeError, ValueError) as e:
+            print(f"LLM JSON Error: {e}")
+            telemetry.finish(call, "parse_error")
+            return {}
+        telemetry.finish(call, "ok")
+        return result
+
+    async def _request(self, call: LLMCall, request: Dict[str, Any], priority: Priority,
+                       stale: Optional[Callable[[], bool]]):
+        """
+        Send `request` down the fallback chain of call.model: retriable errors
+        are retried with backoff, a timeout or a final error moves on to the
+        next model. call.model / call.path / call.retries say what served it.
+        """
+        policy = self.resilience
+        error: Optional[BaseException] = None
+        for index, model in enumerate(policy.chain(call.model)):
+            for attempt in range(policy.max_retries + 1):
+                try:
+                    response, hedged = await self._hedged(model, call, request, priority, stale)
+                except LLMShed:
+                    raise
+                except Exception as e:
+                    error = e
+                    if is_timeout(e) or not is_retriable(e) or attempt == policy.max_retries:
+                        print(f"[{model}] {call.kind} failed: {e!r}")
+                        break
+                    call.retries += 1
+                    self.resilience_stats["retries"] += 1
+                    await asyncio.sleep(backoff_delay(attempt, policy.backoff_base, policy.backoff_max))
+                    continue
+                call.model = model
+                call.path = "fallback" if index else "hedge" if hedged else "primary"
+                if index:
+                    self.resilience_stats["fallbacks"] += 1
+                return response
+        raise error
+
+    async def _hedged(self, model: str, call: LLMCall, request: Dict[str, Any], priority: Priority,
+                      stale: Optional[Callable[[], bool]]):
+        """
+        One attempt, hedged if the call kind is configured for it: a second
+        request goes out once the first is slower than the recent p95.
+        Returns (response, served by the hedge).
+        """
+        delay = self.resilience.hedge_delay(model, call.kind)
+        first = asyncio.create_task(self._send(model, call, request, priority, stale))
+        if delay is None:
+            return await first, False
+
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                print(f"[{model}] {call.kind} slower than {delay:.2f}s, hedging")
+                self.resilience_stats["hedged"] += 1
+                tasks.add(asyncio.create_task(self._send(model, call, request, priority, stale)))
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), task is not first
+                    error = task.exception()
+            raise error
+        finally:
+            # Cancel the loser and wait for it to unwind (frees its
+            # scheduler slot) before returning
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _send(self, model: str, call: LLMCall, request: Dict[str, Any], priority: Priority,
+                    stale: Optional[Callable[[], bool]]):
+        estimated = call.prompt_tokens + self.completion_estimate
+        # Waits for a slot: per-model concurrency, rate limits, priority
+        async with llm_scheduler.slot(model, priority, estimated, stale=stale):
+            call.sent()
+            started = time.monotonic()
+            response = await asyncio.wait_for(
+                self.client.chat.completions.create(model=model, **request),
+                self.resilience.timeout_for(call.kind)
+            )
+        self.resilience.latencies.add(model, call.kind, time.monotonic() - started)
+        if response.usage:
+            llm_scheduler.settle(model, estimated, response.usage.total_tokens)
+        return response
+
+    async def judge_interruption(self, context: Dict[str, Any], stale: Optional[Callable[[], bool]] = None,
+                                 group_id: str = "") -> Dict[str, Any]:
         """
         Call the small model to judge if the bot should intervene.
+        `stale()` returning True (e.g. the group got newer messages) drops the
+        call if it has not been sent yet; the result is then {}.
         """
         system_prompt = settings.get("prompts", "judge_system")
-        user_content = json.dumps(context, ensure_ascii=False)
-        return await self._call_llm(self.judge_model, system_prompt, user_content)
+        context = context_budget.fit(context, self.judge_model)
+        prefix, user_content = prompt_layout.split(context)
+        if self.judge_batcher:
+            call = lambda: self.judge_batcher.submit((context, stale, group_id))
+        else:
+            call = lambda: self._judge_one(system_prompt, user_content, stale, group_id, prefix)
+        # Identical (after normalization) inputs reuse the previous decision
+        return await judge_cache.get_or_call(
+            context,
+            judge_cache.estimate_prompt_tokens(system_prompt, "".join([*prefix, user_content])),
+            call
+        )
+
+    async def _judge_one(self, system_prompt: str, user_content: str,
+                         stale: Optional[Callable[[], bool]] = None, group_id: str = "",
+                         prefix: Sequence[str] = ()) -> Dict[str, Any]:
+        self.judge_stats["single_calls"] += 1
+        return await self._call_llm(self.judge_model, system_prompt, user_content, priority=Priority.JUDGE, stale=stale,
+                                    kind="judge", group_id=group_id, prefix=prefix)
 
-    async def generate_chat(self, context: Dict[str, Any]) -> Dict[str, Any]:
+    async def _judge_many(self, items: List[Tuple[Dict[str, Any], Optional[Callable[[], bool]], str]]) -> List[Dict[str, Any]]:
+        """
+        Judge several groups' contexts in one request; contexts the model did
+        not answer (or an unparsable reply) fall back to single calls.
+        `items` is [(context, stale, group_id)]; stale contexts are dropped up front.
+        """
+        results: List[Dict[str, Any]] = [{} for _ in items]
+        live = [i for i, (_, stale, _) in enumerate(items) if stale is None or not stale()]
+        self.judge_stats["stale"] += len(items) - len(live)
+        if not live:
+            return results
+        for i, decision in zip(live, await self._judge_batch([items[i][0] for i in live], [items[i][2] for i in live])):
+            results[i] = decision
+        return results
+
+    async def _judge_batch(self, contexts: List[Dict[str, Any]], group_ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        system_prompt = settings.get("prompts", "judge_system")
+        group_ids = group_ids or [""] * len(contexts)
+        singles = [prompt_layout.split(c) for c in contexts]
+        if len(contexts) == 1:
+            return [await self._judge_one(system_prompt, singles[0][1], group_id=group_ids[0], prefix=singles[0][0])]
+
+        batch_prompt = (system_prompt or "") + "\n" + settings.get("prompts", "judge_batch_system", "")
+        prefix, user_content = prompt_layout.split_batch(contexts)
+        self.judge_stats["batched_calls"] += 1
+        result = await self._call_llm(self.judge_model, batch_prompt, user_content, priority=Priority.JUDGE,
+                                      kind="judge_batch", prefix=prefix)
+
+        decisions: Dict[int, Dict[str, Any]] = {}
+        for item in result.get("decisions", []) if isinstance(result, dict) else []:
+            try:
+                index = int(item["id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= index < len(contexts) and "should_intervene" in item:
+                decisions[index] = {k: v for k, v in item.items() if k != "id"}
+
+        missing = [i for i in range(len(contexts)) if i not in decisions]
+        if missing:
+            self.judge_stats["fallbacks"] += len(missing)
+            print(f"[LLMService] Batched judge answered {len(decisions)}/{len(contexts)}, falling back to single calls")
+            for i, decision in zip(missing, await asyncio.gather(*(
+                self._judge_one(system_prompt, singles[i][1], group_id=group_ids[i], prefix=singles[i][0]) for i in missing
+            ))):
+                decisions[i] = decision
+        return [decisions[i] for i in range(len(contexts))]
+
+    async def generate_chat(self, context: Dict[str, Any],
+                            on_message: Optional[Callable[[str], None]] = None, group_id: str = "",
+                            priority: Optional[Priority] = None) -> Dict[str, Any]:
         """
         Call the large model to generate chat responses.
+        With `on_message`, every reply message is passed to it exactly once,
+        as soon as it is available (while the rest is still being generated
+        when streaming). It must not block.
+        `priority` overrides the scheduler priority (speculative generation
+        queues like a judge call, not like a confirmed reply).
         """
         system_prompt = settings.get("prompts", "chat_system")
-        user_content = json.dumps(context, ensure_ascii=False)
-        return await self._call_llm(self.chat_model, system_prompt, user_content)
+        prefix, user_content = prompt_layout.split(context_budget.fit(context, self.chat_model))
+        if priority is None:
+            priority = Priority.MENTION if context.get("is_at_mentioned") else Priority.REPLY
+        if on_message is None:
+            return await self._call_llm(self.chat_model, system_prompt, user_content, priority=priority,
+                                        kind="chat", group_id=group_id, prefix=prefix)
+
+        delivered = 0
+        result = None
+        if self.chat_streaming:
+            result, delivered = await self._stream_messages(self.chat_model, system_prompt, user_content, on_message,
+                                                            priority, group_id, prefix)
+        if result is None:
+            # Not streaming, or the stream failed before anything was delivered
+            result = await self._call_llm(self.chat_model, system_prompt, user_content, priority=priority,
+                                          kind="chat", group_id=group_id, prefix=prefix)
+        for message in result.get("messages", [])[delivered:]:
+            on_message(message)
+        return result
+
+    async def _stream_messages(self, model: str, system_prompt: str, user_content: str,
+                               on_message: Callable[[str], None], priority: Priority,
+                               group_id: str = "", prefix: Sequence[str] = ()) -> Tuple[Optional[Dict[str, Any]], int]:
+        """
+        Streamed JSON-mode call. Items of the "messages" array go to
+        `on_message` as they close. Returns (parsed result, messages delivered);
+        the result is None if the stream failed before delivering anything.
+        """
+        prompt_tokens = estimate_tokens(system_prompt or "") + sum(map(estimate_tokens, [*prefix, user_content]))
+        print(f"[{model}] Streaming... (~{prompt_tokens} prompt tokens)")
+        estimated = prompt_tokens + self.completion_estimate
+        streamer = JSONArrayStreamer("messages")
+        parts = []
+        call = telemetry.start(model, "chat_stream", group_id, prompt_tokens)
+        try:
+            async with llm_scheduler.slot(model, priority, estimated):
+                call.sent()
+                # Bounds the wait for the stream to open and between chunks
+                timeout = self.resilience.timeout_for("chat_stream")
+                stream = await asyncio.wait_for(self.client.chat.completions.create(
+                    model=model,
+                    messages=build_messages(system_prompt, prefix, user_content),
+                    response_format={"type": "json_object"},
+                    stream=True,
+                    # Usage (incl. cached prompt tokens) arrives on a final chunk
+                    stream_options={"include_usage": True}
+                ), timeout)
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                    except StopAsyncIteration:
+                        break
+                    # Providers that support include_usage report it on the last chunk
+                    call.usage(getattr(chunk, "usage", None))
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    parts.append(chunk.choices[0].delta.content)
+                    for message in streamer.feed(parts[-1]):
+                        on_message(message)
+        except LLMShed as e:
+            print(f"[{model}] Dropped: {e}")
+            telemetry.finish(call, "shed")
+            return {}, 0
+        except asyncio.CancelledError:
+            telemetry.finish(call, "cancelled")
+            raise
+        except Exception as e:
+            print(f"LLM Stream Error: {e}")
+            call.completion_tokens = call.completion_tokens or estimate_tokens("".join(parts))
+            if not streamer.items:
+                telemetry.finish(call, "timeout" if is_timeout(e) else "error")
+                return None, 0
+            # Keep what was already said
+            telemetry.finish(call, "partial")
+            return {"messages": list(streamer.items)}, len(streamer.items)
+
+        content = "".join(parts)
+        print(f"[{model}] Response ({call.cached_tokens}/{call.prompt_tokens} cached): {content}")
+        call.completion_tokens = call.completion_tokens or estimate_tokens(content)
+        llm_scheduler.settle(model, estimated, call.prompt_tokens + call.completion_tokens)
+        try:
+            result = json.loads(content)
+        except ValueError:
+            result = None
+        if not isinstance(result, dict):
+            telemetry.finish(call, "parse_error")
+            return {"messages": list(streamer.items)}, len(streamer.items)
+        telemetry.finish(call, "ok")
+        return result, len(streamer.items)
 
-    async def generate_proactive_topic(self) -> Dict[str, Any]:
+    async def generate_proactive_topic(self, group_id: str = "") -> Dict[str, Any]:
         """
         Call the model to generate a proactive topic.
         """
         system_prompt = settings.get("prompts", "proactive_system")
-        return await self._call_llm(self.chat_model, system_prompt, "请开始你的表演")
+        return await self._call_llm(self.chat_model, system_prompt, "请开始你的表演", priority=Priority.PROACTIVE,
+                                    kind="proactive", group_id=group_id)
 
-    async def analyze_user(self, current_profile: str, recent_messages: List[str]) -> str:
+    async def analyze_user(self, current_profile: str, recent_messages: List[str], group_id: str = "") -> str:
         """
         Call the model to update user profile.
         """
         system_prompt = settings.get("prompts", "profiler_system")
         user_content = f"Current Profile: {current_profile}\n\nRecent Messages:\n" + "\n".join(recent_messages)
-        return await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=False)
+        return await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=False,
+                                    priority=Priority.EXTRACTION, kind="profiler", group_id=group_id)
 
-    async def extract_memories(self, recent_messages: List[str]) -> List[str]:
+    async def extract_memories(self, recent_messages: List[str], group_id: str = "") -> List[str]:
         """
         Extract distinct facts/memories from user messages.
         """
+        return await self._extract_one(recent_messages, group_id) or []
+
+    async def _extract_one(self, recent_messages: List[str], group_id: str = "") -> Optional[List[str]]:
+        """
+        Facts from one user's messages; None if the call failed (as opposed
+        to finding nothing).
+        """
         system_prompt = settings.get("prompts", "memory_extractor_system")
         user_content = "Recent User Messages:\n" + "\n".join(recent_messages)
         
-        result = await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=True)
-        return result.get("facts", [])
+        result = await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=True,
+                                      priority=Priority.EXTRACTION, kind="extraction", group_id=group_id)
+        facts = result.get("facts") if isinstance(result, dict) else None
+        return [str(f) for f in facts if f] if isinstance(facts, list) else None
+
+    async def extract_memories_batch(self, users: List[List[str]], group_id: str = "") -> List[Optional[List[str]]]:
+        """
+        Extract facts for several users of one group in one call.
+        `users` is one list of recent messages per user; returns one list of
+        facts per user (None where extraction failed). Users the model did
+        not answer fall back to single calls.
+        """
+        if len(users) == 1:
+            return [await self._extract_one(users[0], group_id)]
+        system_prompt = (settings.get("prompts", "memory_extractor_system") or "") + "\n" + \
+            settings.get("prompts", "memory_extractor_batch_system", "")
+        user_content = json.dumps(
+            {"users": [{"id": str(i), "messages": messages} for i, messages in enumerate(users)]},
+            ensure_ascii=False
+        )
+        result = await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=True,
+                                      priority=Priority.EXTRACTION, kind="extraction_batch", group_id=group_id)
+
+        facts: Dict[int, List[str]] = {}
+        for item in result.get("results", []) if isinstance(result, dict) else []:
+            try:
+                index = int(item["id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            if 0 <= index < len(users) and isinstance(item.get("facts"), list):
+                facts[index] = [str(f) for f in item["facts"] if f]
+
+        missing = [i for i in range(len(users)) if i not in facts]
+        if missing:
+            print(f"[LLMService] Batched extraction answered {len(facts)}/{len(users)}, falling back to single calls")
+            for i, found in zip(missing, await asyncio.gather(*(self._extract_one(users[i], group_id) for i in missing))):
+                facts[i] = found
+        return [facts[i] for i in range(len(users))]
+
+    async def summarize_topics(self, topics: List[Dict[str, Any]]) -> Dict[int, str]:
+        """
+        Summarize several closed topics in one call.
+        `topics` is [{"id": int, "messages": ["nickname: content", ...]}].
+        Returns {topic_id: summary} for the topics the model answered.
+        """
+        system_prompt = settings.get("prompts", "topic_summarizer_system")
+        user_content = json.dumps({"topics": topics}, ensure_ascii=False)
+
+        result = await self._call_llm(self.judge_model, system_prompt, user_content, json_mode=True,
+                                      priority=Priority.BACKGROUND, kind="summary")
+        wanted = {t["id"] for t in topics}
+        summaries = {}
+        for item in result.get("summaries", []) if isinstance(result, dict) else []:
+            try:
+                topic_id = int(item["id"])
+                summary = str(item["summary"]).strip()
+            except (KeyError, TypeError, ValueError):
+                continue
+            if topic_id in wanted and summary:
+                summaries[topic_id] = summary
+        return summaries
 
 llm_service = LLMService()
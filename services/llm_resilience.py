@@ -0,0 +1,108 @@
+import asyncio
+import random
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+import openai
+from config import settings
+
+# Seconds one attempt of each call kind may take once it is sent
+# (for chat_stream: the wait for the stream to open and between chunks)
+DEFAULT_TIMEOUTS = {
+    "judge": 10,
+    "judge_batch": 20,
+    "chat": 45,
+    "chat_stream": 20,
+    "proactive": 45,
+    "extraction": 30,
+    "extraction_batch": 45,
+    "profiler": 30,
+    "summary": 60,
+}
+
+
+def is_retriable(e: BaseException) -> bool:
+    """
+    Transient upstream failures: connection problems, rate limits, 408/409 and 5xx.
+    """
+    if isinstance(e, (openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409) or e.status_code >= 500
+    return False
+
+
+def is_timeout(e: BaseException) -> bool:
+    return isinstance(e, (asyncio.TimeoutError, openai.APITimeoutError))
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Full-jitter exponential backoff before retry number `attempt` (0-based).
+    """
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class LatencyTracker:
+    """
+    Recent successful request latencies per (model, kind).
+    """
+
+    def __init__(self, window: int = 200):
+        self._samples: Dict[Tuple[str, str], Deque[float]] = {}
+        self.window = window
+
+    def add(self, model: str, kind: str, seconds: float):
+        samples = self._samples.get((model, kind))
+        if samples is None:
+            samples = self._samples[(model, kind)] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, model: str, kind: str, q: float, min_samples: int = 1) -> Optional[float]:
+        samples = self._samples.get((model, kind))
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+class ResiliencePolicy:
+    """
+    How LLMService copes with a slow or failing upstream ([llm_resilience]):
+
+    - every attempt has a timeout per call kind;
+    - retriable errors are retried up to `max_retries` times with jittered
+      exponential backoff;
+    - a timed-out or failed model gives way to the next one of its fallback
+      chain (`fallbacks`), e.g. chat_model -> judge_model;
+    - for `hedge_kinds`, a second request is sent once the first has taken
+      longer than the recent p95 latency, and the first answer wins.
+    """
+
+    def __init__(self):
+        self.timeouts = {
+            kind: settings.get("llm_resilience", f"timeout_{kind}_seconds", t) for kind, t in DEFAULT_TIMEOUTS.items()
+        }
+        self.max_retries = settings.get("llm_resilience", "max_retries", 2)
+        self.backoff_base = settings.get("llm_resilience", "backoff_base_ms", 300) / 1000
+        self.backoff_max = settings.get("llm_resilience", "backoff_max_ms", 3000) / 1000
+        # {model: [fallback model, ...]}
+        self.fallbacks: Dict[str, List[str]] = settings.get("llm_resilience", "fallbacks", {})
+        self.hedge_kinds = set(settings.get("llm_resilience", "hedge_kinds", []))
+        self.hedge_min_delay = settings.get("llm_resilience", "hedge_min_delay_ms", 500) / 1000
+        self.hedge_min_samples = settings.get("llm_resilience", "hedge_min_samples", 20)
+        self.latencies = LatencyTracker()
+
+    def timeout_for(self, kind: str) -> float:
+        return self.timeouts.get(kind, 60)
+
+    def chain(self, model: str) -> List[str]:
+        return [model] + [m for m in self.fallbacks.get(model, []) if m != model]
+
+    def hedge_delay(self, model: str, kind: str) -> Optional[float]:
+        """
+        Seconds after which to hedge, or None (not hedged / not enough samples yet).
+        """
+        if kind not in self.hedge_kinds:
+            return None
+        p95 = self.latencies.percentile(model, kind, 0.95, self.hedge_min_samples)
+        return None if p95 is None else max(p95, self.hedge_min_delay)
@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Callable, Deque, Dict, List, Optional
+from config import settings
+
+
+class Priority(IntEnum):
+    """
+    Lower value is served first.
+    """
+    MENTION = 0      # reply to an @-mention
+    REPLY = 1        # reply the judge decided on
+    JUDGE = 2
+    EXTRACTION = 3   # memory extraction / profiling
+    PROACTIVE = 4    # scheduler-initiated topics
+    BACKGROUND = 5   # topic summaries and other maintenance
+
+
+# Seconds a request may wait in the queue before it is dropped
+DEFAULT_DEADLINES = {
+    Priority.MENTION: 60,
+    Priority.REPLY: 30,
+    Priority.JUDGE: 15,
+    Priority.EXTRACTION: 120,
+    Priority.PROACTIVE: 60,
+    Priority.BACKGROUND: 600,
+}
+
+
+class LLMShed(Exception):
+    """
+    The request was dropped before it was sent (deadline passed or stale).
+    """
+
+
+class TokenBucket:
+    """
+    `per_minute` units per minute, bursting up to one minute's worth.
+    """
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = per_minute / 60
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # A request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        """
+        May go negative: the debt is paid back before the next request.
+        A negative amount refunds, up to a full bucket.
+        """
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class _Request:
+    __slots__ = ("priority", "tokens", "deadline", "stale", "future", "enqueued_at")
+
+    def __init__(self, priority: Priority, tokens: int, deadline: float, stale: Optional[Callable[[], bool]],
+                 future: asyncio.Future, enqueued_at: float):
+        self.priority = priority
+        self.tokens = tokens
+        self.deadline = deadline
+        self.stale = stale
+        self.future = future
+        self.enqueued_at = enqueued_at
+
+
+class _Lane:
+    """
+    Queue, concurrency cap and rate limits of one model.
+    """
+
+    def __init__(self, max_concurrency: int, rpm: float, tpm: float):
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.heap: List = []
+        self.in_flight = 0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class LLMScheduler:
+    """
+    Single gate in front of every LLM request.
+
+    Per model: at most `max_concurrency` requests in flight, request and token
+    rate limits (token buckets, per minute), and a priority queue. Queued
+    requests past their deadline, or whose `stale()` check returns True by the
+    time they would be sent, are dropped with LLMShed instead of being sent.
+    """
+
+    def __init__(self):
+        self.default_concurrency = settings.get("llm_scheduler", "max_concurrency", 4)
+        self.default_rpm = settings.get("llm_scheduler", "requests_per_minute", 0)
+        self.default_tpm = settings.get("llm_scheduler", "tokens_per_minute", 0)
+        # Per-model overrides: {model: {"max_concurrency", "requests_per_minute", "tokens_per_minute"}}
+        self.model_limits: Dict[str, Dict] = settings.get("llm_scheduler", "models", {})
+        self.deadlines = {
+            p: settings.get("llm_scheduler", f"deadline_{p.name.lower()}_seconds", d)
+            for p, d in DEFAULT_DEADLINES.items()
+        }
+        self._lanes: Dict[str, _Lane] = {}
+        self._seq = itertools.count()
+        self._waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=500) for p in Priority}
+        self.stats = {"granted": 0, "expired": 0, "stale": 0, "cancelled": 0}
+
+    def _lane(self, model: str) -> _Lane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            limits = self.model_limits.get(model, {})
+            lane = self._lanes[model] = _Lane(
+                limits.get("max_concurrency", self.default_concurrency),
+                limits.get("requests_per_minute", self.default_rpm),
+                limits.get("tokens_per_minute", self.default_tpm),
+            )
+        return lane
+
+    @asynccontextmanager
+    async def slot(self, model: str, priority: Priority, tokens: int = 0,
+                   deadline: Optional[float] = None, stale: Optional[Callable[[], bool]] = None):
+        """
+        async with llm_scheduler.slot(model, Priority.JUDGE, tokens=...):
+            ... send the request ...
+        `deadline` is seconds of queueing allowed (default per priority).
+        """
+        lane = self._lane(model)
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        request = _Request(priority, tokens, now + (deadline or self.deadlines[priority]), stale,
+                           loop.create_future(), now)
+        heapq.heappush(lane.heap, (priority, next(self._seq), request))
+        self._dispatch(lane)
+        try:
+            await request.future
+        except asyncio.CancelledError:
+            if request.future.done() and not request.future.cancelled() and request.future.exception() is None:
+                # Granted just as we were cancelled: give the slot back
+                self._release(lane)
+            else:
+                self.stats["cancelled"] += 1
+            raise
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def settle(self, model: str, estimated: int, actual: int):
+        """
+        Correct the token bucket once the real usage of a request is known
+        (an overestimate is refunded, never beyond the bucket's capacity).
+        """
+        lane = self._lane(model)
+        if lane.tokens and actual:
+            lane.tokens.take(actual - estimated)
+
+    def _release(self, lane: _Lane):
+        lane.in_flight -= 1
+        self._dispatch(lane)
+
+    def _dispatch(self, lane: _Lane):
+        if lane.timer is not None:
+            lane.timer.cancel()
+            lane.timer = None
+        now = time.monotonic()
+        while lane.heap and lane.in_flight < lane.max_concurrency:
+            _, _, request = lane.heap[0]
+            if request.future.done():
+                heapq.heappop(lane.heap)
+                continue
+            if now > request.deadline:
+                heapq.heappop(lane.heap)
+                self.stats["expired"] += 1
+                request.future.set_exception(LLMShed(f"{request.priority.name} request waited past its deadline"))
+                continue
+            if request.stale is not None and request.stale():
+                heapq.heappop(lane.heap)
+                self.stats["stale"] += 1
+                request.future.set_exception(LLMShed(f"{request.priority.name} request is stale"))
+                continue
+
+            wait = max(
+                lane.requests.wait_time(1) if lane.requests else 0.0,
+                lane.tokens.wait_time(request.tokens) if lane.tokens else 0.0,
+            )
+            if wait > 0:
+                lane.timer = asyncio.get_running_loop().call_later(wait, self._dispatch, lane)
+                return
+
+            heapq.heappop(lane.heap)
+            if lane.requests:
+                lane.requests.take(1)
+            if lane.tokens:
+                lane.tokens.take(request.tokens)
+            lane.in_flight += 1
+            self.stats["granted"] += 1
+            self._waits[request.priority].append(now - request.enqueued_at)
+            request.future.set_result(None)
+
+    def metrics(self) -> Dict:
+        """
+        Queue depth per model and priority, in-flight counts, and queue wait
+        times (over the last 500 grants of each priority).
+        """
+        lanes = {}
+        for model, lane in self._lanes.items():
+            depth = {p.name: 0 for p in Priority}
+            for _, _, request in lane.heap:
+                if not request.future.done():
+                    depth[request.priority.name] += 1
+            lanes[model] = {"in_flight": lane.in_flight, "queued": sum(depth.values()), "queued_by_priority": depth}
+        waits = {}
+        for priority, samples in self._waits.items():
+            if samples:
+                ordered = sorted(samples)
+                waits[priority.name] = {
+                    "count": len(ordered),
+                    "avg_ms": sum(ordered) / len(ordered) * 1000,
+                    "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+                    "max_ms": ordered[-1] * 1000,
+                }
+        return {"models": lanes, "wait": waits, **self.stats}
+
+
+llm_scheduler = LLMScheduler()
@@ -0,0 +1,218 @@
+import asyncio
+import hashlib
+import math
+import re
+import time
+import unicodedata
+from typing import Callable, Dict, List, Optional, Set
+from config import settings
+from services.storage import Storage, storage, async_storage
+
+# Verb/phrase variants the extractor uses interchangeably. Longest first so
+# "喜欢吃" is folded before "喜欢".
+_SYNONYMS = sorted({
+    "喜欢吃": "喜欢",
+    "爱吃": "喜欢",
+    "热爱": "喜欢",
+    "钟爱": "喜欢",
+    "很喜欢": "喜欢",
+    "特别喜欢": "喜欢",
+    "非常喜欢": "喜欢",
+    "讨厌": "不喜欢",
+    "不爱": "不喜欢",
+    "最近在": "在",
+    "正在": "在",
+    "目前在": "在",
+}.items(), key=lambda kv: -len(kv[0]))
+
+# Generic subjects the extractor prefixes facts with
+_SUBJECTS = ("用户", "该用户", "他", "她", "ta", "TA")
+
+_NON_WORD = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text: str, names: List[str] = ()) -> str:
+    """
+    Canonical form of a fact: NFKC, lower case, no punctuation/whitespace,
+    subject (user names, "用户") removed and common synonyms folded.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    for name in sorted(names, key=len, reverse=True):
+        text = text.replace(name.lower(), "")
+    text = _NON_WORD.sub("", text)
+    for subject in _SUBJECTS:
+        if text.startswith(subject.lower()):
+            text = text[len(subject):]
+            break
+    for phrase, canonical in _SYNONYMS:
+        text = text.replace(phrase, canonical)
+    return text
+
+
+def shingles(text: str, size: int = 2) -> Set[str]:
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def simhash(features: Set[str]) -> int:
+    """
+    64-bit simhash of a feature set, as a signed integer so it fits SQLite.
+    """
+    weights = [0] * 64
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hamming(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+
+class MemoryCompactor:
+    """
+    Folds near-duplicate memories and enforces a per-user cap.
+
+    Runs incrementally: each pass only looks at users who gained memories since
+    the last pass (tracked with a high-water mark in storage_meta), and within
+    a user only the new rows are compared against the already-compacted ones.
+    """
+
+    HWM_KEY = "memory_compaction_hwm"
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self.max_per_user = settings.get("memory", "max_per_user", 200)
+        self.similarity_threshold = settings.get("memory", "similarity_threshold", 0.6)
+        self.containment_threshold = settings.get("memory", "containment_threshold", 0.8)
+        self.half_life_days = settings.get("memory", "decay_half_life_days", 30)
+        self.interval = settings.get("memory", "compaction_interval_seconds", 300)
+        self.batch_size = settings.get("memory", "compaction_batch_size", 500)
+
+        self.stats = {"runs": 0, "users": 0, "merged": 0, "evicted": 0}
+
+        # Called with the list of users whose memories changed in a pass
+        self._listeners: List[Callable[[List[str]], None]] = []
+
+    def add_listener(self, callback: Callable[[List[str]], None]):
+        self._listeners.append(callback)
+
+    def is_duplicate(self, a: Set[str], b: Set[str], hash_a: int, hash_b: int) -> bool:
+        if not a or not b:
+            return False
+        if a == b:
+            return True
+        # Cheap reject: far apart in simhash space means far apart in shingles
+        if hamming(hash_a, hash_b) > 24:
+            return False
+        inter = len(a & b)
+        if inter / len(a | b) >= self.similarity_threshold:
+            return True
+        # One fact restating (most of) another, e.g. a more specific version
+        smaller = min(len(a), len(b))
+        return smaller >= 3 and inter / smaller >= self.containment_threshold
+
+    def score(self, row: Dict, now: float) -> float:
+        """
+        Retention score: frequency, decayed by time since last seen.
+        """
+        age_days = max(0.0, now - row["last_seen"]) / 86400
+        return (1 + math.log(row["hit_count"])) * 0.5 ** (age_days / self.half_life_days)
+
+    def compact_user(self, user_id: str, after_id: int = 0, now: Optional[float] = None) -> Dict[str, int]:
+        """
+        Compact one user's memories. Rows with id <= after_id are assumed to be
+        compacted already and are not compared against each other.
+        """
+        now = now or time.time()
+        names = self._storage.get_user_nicknames(user_id) + [user_id]
+        kept: List[Dict] = []
+        dirty: Dict[int, Dict] = {}
+        deletes: List[int] = []
+
+        for row in self._storage.get_memory_rows(user_id):
+            row["shingles"] = shingles(normalize(row["content"], names))
+            if row["simhash"] is None:
+                row["simhash"] = simhash(row["shingles"])
+                dirty[row["id"]] = row
+
+            match = None
+            if row["id"] > after_id:
+                for index, candidate in enumerate(kept):
+                    if self.is_duplicate(row["shingles"], candidate["shingles"], row["simhash"], candidate["simhash"]):
+                        match = candidate
+                        break
+
+            if match is None:
+                kept.append(row)
+                continue
+
+            # Keep the more informative wording, fold the other one into it
+            if len(row["content"]) > len(match["content"]):
+                kept[index] = row
+                survivor, folded = row, match
+            else:
+                survivor, folded = match, row
+            survivor["hit_count"] += folded["hit_count"]
+            survivor["last_seen"] = max(survivor["last_seen"], folded["last_seen"])
+            survivor["timestamp"] = min(survivor["timestamp"], folded["timestamp"])
+            dirty[survivor["id"]] = survivor
+            dirty.pop(folded["id"], None)
+            deletes.append(folded["id"])
+
+        merged = len(deletes)
+        evicted = 0
+        if len(kept) > self.max_per_user:
+            kept.sort(key=lambda r: self.score(r, now), reverse=True)
+            for row in kept[self.max_per_user:]:
+                dirty.pop(row["id"], None)
+                deletes.append(row["id"])
+            evicted = len(kept) - self.max_per_user
+
+        if dirty or deletes:
+            self._storage.apply_memory_compaction(list(dirty.values()), deletes)
+        return {"merged": merged, "evicted": evicted}
+
+    def compact_once(self) -> Dict[str, int]:
+        """
+        One incremental pass. Synchronous: run it on the database thread.
+        """
+        hwm = self._storage.get_meta(self.HWM_KEY, 0)
+        new_hwm, users = self._storage.get_memory_users_since(hwm, self.batch_size)
+        result = {"users": len(users), "merged": 0, "evicted": 0, "changed": []}
+        for user_id in users:
+            r = self.compact_user(user_id, after_id=hwm)
+            result["merged"] += r["merged"]
+            result["evicted"] += r["evicted"]
+            if r["merged"] or r["evicted"]:
+                result["changed"].append(user_id)
+        if new_hwm != hwm:
+            self._storage.set_meta(self.HWM_KEY, new_hwm)
+
+        self.stats["runs"] += 1
+        for key in ("users", "merged", "evicted"):
+            self.stats[key] += result[key]
+        return result
+
+    async def run_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                # Let queued add_memory writes land first
+                await async_storage.flush()
+                result = await async_storage.call(self.compact_once)
+                if result["changed"]:
+                    print(f"[Memory] Compaction: merged {result['merged']}, evicted {result['evicted']}")
+                    for callback in self._listeners:
+                        callback(result["changed"])
+            except Exception as e:
+                print(f"[Memory] Compaction failed: {e}")
+
+
+memory_compactor = MemoryCompactor(storage)
@@ -0,0 +1,162 @@
+import asyncio
+import time
+from typing import Dict, Set, Tuple
+from config import settings
+from services.batching import MicroBatcher
+from services.cache import ContextCache, context_cache
+from services.llm import LLMService, llm_service
+from services.storage import async_storage
+from services.topic import TopicManager, topic_manager
+
+Key = Tuple[str, str]
+
+
+class MemoryExtractor:
+    """
+    Coalesces memory extraction requests (@-mentions, judge results with
+    has_significant_info) so each user has at most one extraction in flight:
+
+    - requests for a user whose extraction is running or waiting are folded
+      into it; one more run follows if new requests came in meanwhile;
+    - runs for the same user are at least `cooldown_seconds` apart;
+    - only the user's messages newer than the last extracted one (the
+      high-water mark) are sent, so facts are not re-extracted. The mark
+      only moves when the call succeeds, so a failed call loses nothing.
+
+    With `batching`, users of the same group whose runs start within
+    `batch_wait_ms` share one LLM call (results mapped back per user).
+    """
+
+    def __init__(self, llm: LLMService, topics: TopicManager, cache: ContextCache):
+        self.llm = llm
+        self.topics = topics
+        self.cache = cache
+        self.cooldown = settings.get("memory_extraction", "cooldown_seconds", 60)
+        self.min_messages = settings.get("memory_extraction", "min_messages", 2)
+        self.max_messages = settings.get("memory_extraction", "max_messages", 10)
+        self.batching = settings.get("memory_extraction", "batching", True)
+        self.batch_wait = settings.get("memory_extraction", "batch_wait_ms", 200) / 1000
+        self.batch_size = settings.get("memory_extraction", "batch_size", 5)
+        # Timestamp of the newest message already extracted, per (group, user)
+        self._marks: Dict[Key, float] = {}
+        self._last_run: Dict[Key, float] = {}
+        self._running: Dict[Key, asyncio.Task] = {}
+        self._pending: Set[Key] = set()
+        self._batchers: Dict[str, MicroBatcher] = {}
+        # Stats of batchers already dropped by _prune
+        self._batch_totals = {"items": 0, "batches": 0, "max_batch": 0}
+        self.stats = {"requested": 0, "coalesced": 0, "runs": 0, "skipped": 0, "failed": 0, "facts": 0}
+
+    def request(self, group_id: str, user_id: str):
+        """
+        Ask for the user's new messages to be mined for memories. Returns at once.
+        """
+        key = (group_id, user_id)
+        self.stats["requested"] += 1
+        running = self._running.get(key)
+        # A finished run (its done callback not called yet) would never see the request
+        if running is not None and not running.done():
+            self._pending.add(key)
+            self.stats["coalesced"] += 1
+            return
+        task = asyncio.create_task(self._run(key))
+        self._running[key] = task
+        task.add_done_callback(lambda t, k=key: self._forget(k, t))
+
+    def _forget(self, key: Key, task: asyncio.Task):
+        # Unless a newer run of the same user has already replaced it
+        if self._running.get(key) is task:
+            del self._running[key]
+
+    async def _run(self, key: Key):
+        try:
+            while True:
+                wait = self._last_run.get(key, float("-inf")) + self.cooldown - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                # Requests made during the wait are covered by this run; ones
+                # made while it extracts get another run after the cooldown
+                self._pending.discard(key)
+                self._last_run[key] = time.monotonic()
+                await self._extract(*key)
+                if key not in self._pending:
+                    return
+        except Exception as e:
+            print(f"[MemoryExtractor] Error extracting memories for {key[1]}: {e}")
+        finally:
+            self._pending.discard(key)
+            self._prune(key)
+
+    async def _extract(self, group_id: str, user_id: str):
+        key = (group_id, user_id)
+        # Check if user exists (to ensure basic record)
+        if not await self.cache.get_user(group_id, user_id):
+            return
+        topic = await self.topics.get_current_topic(group_id)
+        if not topic:
+            return
+        messages = topic["messages"]
+        if len(messages.user_contents(user_id)) < self.min_messages:
+            return
+        new = messages.user_records_since(user_id, self._marks.get(key, 0.0))[-self.max_messages:]
+        if not new:
+            self.stats["skipped"] += 1
+            return
+
+        print(f"[MemoryExtractor] Extracting memories for user {user_id} ({len(new)} new messages)...")
+        self.stats["runs"] += 1
+        contents = [r.content for r in new]
+        if self.batching:
+            facts = await self._batcher(group_id).submit(contents)
+        else:
+            facts = (await self.llm.extract_memories_batch([contents], group_id))[0]
+        if facts is None:
+            self.stats["failed"] += 1
+            return
+
+        self._marks[key] = new[-1].timestamp
+        if facts:
+            print(f"[MemoryExtractor] Found {len(facts)} new memories for {user_id}")
+        for fact in facts:
+            async_storage.add_memory(user_id, group_id, fact)
+            self.stats["facts"] += 1
+            print(f"  + Memory: {fact}")
+
+    def _batcher(self, group_id: str) -> MicroBatcher:
+        batcher = self._batchers.get(group_id)
+        if batcher is None:
+            batcher = self._batchers[group_id] = MicroBatcher(
+                lambda users, g=group_id: self.llm.extract_memories_batch(users, g), self.batch_wait, self.batch_size
+            )
+        return batcher
+
+    def _prune(self, finished: Key, max_users: int = 10000):
+        """
+        Drop the batchers of groups with no extraction left running, and
+        forget marks of users not extracted for an hour once many are tracked
+        (their old messages have long left the topic window).
+        """
+        busy = {key[0] for key, task in self._running.items() if key != finished and not task.done()}
+        for group_id in [g for g in self._batchers if g not in busy]:
+            self._add_batch_stats(self._batch_totals, self._batchers.pop(group_id).stats)
+        if len(self._last_run) <= max_users:
+            return
+        cutoff = time.monotonic() - max(3600, self.cooldown)
+        for key in [k for k, t in self._last_run.items() if t < cutoff and k not in self._running]:
+            self._last_run.pop(key, None)
+            self._marks.pop(key, None)
+
+    def batch_stats(self) -> Dict[str, int]:
+        stats = dict(self._batch_totals)
+        for batcher in self._batchers.values():
+            self._add_batch_stats(stats, batcher.stats)
+        return stats
+
+    @staticmethod
+    def _add_batch_stats(total: Dict[str, int], stats: Dict[str, int]):
+        total["items"] += stats["items"]
+        total["batches"] += stats["batches"]
+        total["max_batch"] = max(total["max_batch"], stats["max_batch"])
+
+
+memory_extractor = MemoryExtractor(llm_service, topic_manager, context_cache)
@@ -0,0 +1,240 @@
+import sqlite3
+import time
+from typing import Callable, List, Tuple
+from services.search import to_fts_text
+
+# Ordered schema migrations. Each step runs exactly once, inside its own
+# transaction, and the applied version is recorded in `schema_version`.
+# Never edit a released step: append a new one instead.
+
+
+def _v1_baseline(conn: sqlite3.Connection):
+    # Create topics table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS topics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id TEXT,
+        start_time REAL,
+        end_time REAL,
+        summary TEXT
+    )
+    ''')
+
+    # Create messages table
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic_id INTEGER,
+        user_id TEXT,
+        nickname TEXT,
+        content TEXT,
+        timestamp REAL,
+        FOREIGN KEY(topic_id) REFERENCES topics(id)
+    )
+    ''')
+
+    # Create users table for user profiles
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id TEXT,
+        group_id TEXT,
+        nickname TEXT,
+        description TEXT,
+        interaction_count INTEGER DEFAULT 0,
+        last_active_time REAL,
+        PRIMARY KEY (user_id, group_id)
+    )
+    ''')
+
+    # 决策日志表 - 用于 Dashboard 可视化监控
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS decision_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        group_id TEXT,
+        timestamp REAL,
+        judge_model TEXT,
+        should_intervene BOOLEAN,
+        trigger_level TEXT,
+        reason TEXT,
+        context_summary TEXT
+    )
+    ''')
+
+    # 记忆表 - 用于存储用户特定的事实 (Gemini Style)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS memories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        group_id TEXT,
+        content TEXT,
+        timestamp REAL,
+        UNIQUE(user_id, content)
+    )
+    ''')
+
+    # Databases created before the nickname column existed
+    columns = [info[1] for info in conn.execute("PRAGMA table_info(messages)")]
+    if "nickname" not in columns:
+        conn.execute("ALTER TABLE messages ADD COLUMN nickname TEXT")
+
+
+def _v2_hot_path_indexes(conn: sqlite3.Connection):
+    # get_latest_active_topic / get_recent_topics: by group, newest first
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topics_group_start ON topics(group_id, start_time)")
+    # Dashboard: topics started in the last 24h
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topics_start ON topics(start_time)")
+    # get_topic_messages / get_latest_active_topic: messages of a topic in order
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_topic_ts ON messages(topic_id, timestamp)")
+    # get_memories: a user's memories, newest first
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_user_ts ON memories(user_id, timestamp)")
+    # Dashboard: today's decisions
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_decision_logs_ts ON decision_logs(timestamp)")
+
+
+def _v3_memory_compaction(conn: sqlite3.Connection):
+    # Near-duplicate folding keeps one row per fact with a hit count and the
+    # last time it was (re)extracted; simhash is filled in by the compactor
+    conn.execute("ALTER TABLE memories ADD COLUMN hit_count INTEGER DEFAULT 1")
+    conn.execute("ALTER TABLE memories ADD COLUMN last_seen REAL")
+    conn.execute("ALTER TABLE memories ADD COLUMN simhash INTEGER")
+    conn.execute("UPDATE memories SET last_seen = timestamp, hit_count = 1")
+    # get_memories now orders by last_seen
+    conn.execute("DROP INDEX IF EXISTS idx_memories_user_ts")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_memories_user_seen ON memories(user_id, last_seen)")
+    # Small key/value store for background job state (high-water marks etc.)
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS storage_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+
+
+def _v4_memory_vectors(conn: sqlite3.Connection):
+    # Sparse hashed n-gram term frequencies, filled in lazily by the retrieval index
+    conn.execute("ALTER TABLE memories ADD COLUMN vector BLOB")
+
+
+def _v5_full_text_search(conn: sqlite3.Connection):
+    # Message bodies: contentless (the text already lives in `messages`),
+    # rowid = messages.id. Rows are removed with the FTS5 'delete' command.
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, content='')")
+    # Topic summaries change over time, so this one keeps its content
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS topics_fts USING fts5(body, group_id UNINDEXED)")
+
+    cursor = conn.execute("SELECT id, content FROM messages WHERE content IS NOT NULL")
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        conn.executemany(
+            "INSERT INTO messages_fts (rowid, body) VALUES (?, ?)",
+            [(r[0], to_fts_text(r[1])) for r in rows]
+        )
+    rows = conn.execute("SELECT id, summary, group_id FROM topics WHERE summary IS NOT NULL").fetchall()
+    conn.executemany(
+        "INSERT INTO topics_fts (rowid, body, group_id) VALUES (?, ?, ?)",
+        [(r[0], to_fts_text(r[1]), r[2]) for r in rows]
+    )
+
+
+def _v6_cold_archive(conn: sqlite3.Connection):
+    # Closed topics whose messages were moved to a cold archive file keep their
+    # row (and summary) here; archive_path points at the file, relative to the
+    # archive directory
+    conn.execute("ALTER TABLE topics ADD COLUMN archive_path TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topics_unarchived_end ON topics(end_time) WHERE archive_path IS NULL")
+
+
+def _v7_messages_by_time(conn: sqlite3.Connection):
+    # Bulk warm start: topics with recent messages across all groups
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp)")
+
+
+def _v8_topic_sweeper(conn: sqlite3.Connection):
+    # Background sweeper: open topics past topic_gap, closed topics still
+    # waiting for a summary, and how often summarizing one was attempted
+    conn.execute("ALTER TABLE topics ADD COLUMN summary_attempts INTEGER DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topics_open ON topics(start_time) WHERE end_time IS NULL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_topics_unsummarized ON topics(end_time) WHERE summary IS NULL AND end_time IS NOT NULL")
+
+
+def _v9_llm_telemetry(conn: sqlite3.Connection):
+    # One row per LLM request, written by services/telemetry.py
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS llm_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        started_at REAL,
+        model TEXT,
+        kind TEXT,
+        group_id TEXT,
+        queue_ms INTEGER,
+        latency_ms INTEGER,
+        prompt_tokens INTEGER,
+        completion_tokens INTEGER,
+        outcome TEXT,
+        retries INTEGER DEFAULT 0
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_calls_time ON llm_calls(started_at)")
+
+
+def _v10_llm_call_path(conn: sqlite3.Connection):
+    # How each response was served: primary, hedge or fallback
+    conn.execute("ALTER TABLE llm_calls ADD COLUMN path TEXT DEFAULT 'primary'")
+
+
+def _v11_llm_cached_tokens(conn: sqlite3.Connection):
+    # Prompt tokens the provider served from its prompt cache
+    conn.execute("ALTER TABLE llm_calls ADD COLUMN cached_tokens INTEGER DEFAULT 0")
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "baseline tables", _v1_baseline),
+    (2, "hot path indexes", _v2_hot_path_indexes),
+    (3, "memory compaction columns", _v3_memory_compaction),
+    (4, "memory vectors", _v4_memory_vectors),
+    (5, "full-text search", _v5_full_text_search),
+    (6, "cold archive", _v6_cold_archive),
+    (7, "messages by time", _v7_messages_by_time),
+    (8, "topic sweeper", _v8_topic_sweeper),
+    (9, "llm telemetry", _v9_llm_telemetry),
+    (10, "llm call serving path", _v10_llm_call_path),
+    (11, "llm cached prompt tokens", _v11_llm_cached_tokens),
+]
+
+
+def get_version(conn: sqlite3.Connection) -> int:
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at REAL
+    )
+    ''')
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """
+    Apply every pending migration in order and return the resulting version.
+    """
+    current = get_version(conn)
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        conn.execute("BEGIN")
+        try:
+            step(conn)
+            conn.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                (version, description, time.time())
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        print(f"[Storage] Applied migration {version}: {description}")
+        current = version
+    return current
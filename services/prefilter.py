@@ -0,0 +1,113 @@
+import re
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional
+from config import settings
+
+# A rule looks at a judge context and returns a decision (same shape as the
+# judge's reply) when the case is clear-cut, or None to pass it on.
+Rule = Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]
+
+# Image/sticker placeholders produced by the core plugin
+_PLACEHOLDER = re.compile(r"\[(?:图片|表情/图片|表情)\]")
+
+RULES: Dict[str, Callable[["PreFilter"], Rule]] = {}
+
+
+def register_rule(name: str):
+    """
+    Register a rule factory under `name` (usable in [prefilter] rules).
+    The factory gets the PreFilter and returns the rule.
+    """
+    def decorator(factory: Callable[["PreFilter"], Rule]):
+        RULES[name] = factory
+        return factory
+    return decorator
+
+
+def _decision(should_intervene: bool, reason: str, trigger_level: str, has_significant_info: bool = False) -> Dict[str, Any]:
+    return {
+        "should_intervene": should_intervene,
+        "trigger_level": trigger_level,
+        "reason": reason,
+        "has_significant_info": has_significant_info,
+    }
+
+
+@register_rule("name_mention")
+def name_mention(prefilter: "PreFilter") -> Rule:
+    # 直接点名 -> always reply (like an @, including the memory extraction)
+    names = [n.lower() for n in prefilter.bot_names]
+
+    def rule(context):
+        text = (context.get("latest_message") or "").lower()
+        for name in names:
+            if name in text:
+                return _decision(True, f"直接点名 ({name})", "high", has_significant_info=True)
+        return None
+    return rule
+
+
+@register_rule("typing_burst")
+def typing_burst(prefilter: "PreFilter") -> Rule:
+    # 打断保护: the user is typing fast and clearly not done
+    def rule(context):
+        gap = context.get("time_since_last_user_message", 9999.0)
+        if gap < prefilter.typing_gap:
+            return _decision(False, f"打断保护 (间隔 {gap:.1f}s)", "none")
+        return None
+    return rule
+
+
+@register_rule("noise")
+def noise(prefilter: "PreFilter") -> Rule:
+    # 无意义: only stickers/images and punctuation. Emoji are left to the
+    # judge, they can carry the mood (求夸)
+    def rule(context):
+        text = _PLACEHOLDER.sub("", context.get("latest_message") or "")
+        if all(unicodedata.category(ch)[0] in "PZ" or ch.isspace() for ch in text):
+            return _decision(False, "纯表情/标点", "none")
+        return None
+    return rule
+
+
+class PreFilter:
+    """
+    Local rules run before the judge model. The first rule that returns a
+    decision short-circuits the judge call; rules run in [prefilter] rules order.
+    """
+
+    def __init__(self):
+        self.enabled = settings.get("prefilter", "enabled", True)
+        self.typing_gap = settings.get("prefilter", "typing_gap_seconds", 2.0)
+        extra_names = settings.get("prefilter", "names", ["柒槿年", "QJinEra"])
+        self.bot_names = [
+            n for n in dict.fromkeys([settings.get("bot", "name"), settings.get("bot", "english_name"), *extra_names]) if n
+        ]
+        self.rule_names: List[str] = []
+        for name in settings.get("prefilter", "rules", ["name_mention", "typing_burst", "noise"]):
+            if name in RULES:
+                self.rule_names.append(name)
+            else:
+                print(f"[PreFilter] Unknown rule '{name}', ignored")
+        self._rules = [(n, RULES[n](self)) for n in self.rule_names]
+        self.stats = {"checked": 0, "avoided": 0, "by_rule": {n: 0 for n in self.rule_names}}
+
+    def check(self, context: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        The decision of the first rule that fires, with "rule" set to its
+        name, or None when the judge has to decide.
+        """
+        if not self.enabled:
+            return None
+        self.stats["checked"] += 1
+        for name, rule in self._rules:
+            decision = rule(context)
+            if decision is not None:
+                self.stats["avoided"] += 1
+                self.stats["by_rule"][name] = self.stats["by_rule"].get(name, 0) + 1
+                decision["rule"] = name
+                return decision
+        return None
+
+
+prefilter = PreFilter()
@@ -0,0 +1,70 @@
+import json
+from typing import Any, Dict, List, Sequence, Tuple
+from config import settings
+
+# Context fields that change rarely, most stable first: the persona is the
+# same for every request, past topics per group, profile and memories per
+# speaker. Everything else is the volatile conversation tail.
+STABLE_FIELDS = ("persona", "past_topics", "user_profile", "user_memories")
+
+
+def _dumps(value: Any, sort_keys: bool = False) -> str:
+    return json.dumps(value, ensure_ascii=False, sort_keys=sort_keys)
+
+
+class PromptLayout:
+    """
+    Lays out judge / chat requests so that providers with prompt caching
+    can reuse a prefix: the system prompt, then one user message with the
+    stable context fields (STABLE_FIELDS, in that order), then the volatile
+    tail (recent messages, latest message, time gaps, ...) with sorted keys.
+    Same inputs give byte-identical messages; the tail never shifts the prefix.
+    Past topics and memories keep their relevance order (most relevant
+    first, as the context budget cut them), so a reranking is a cache miss.
+
+    Disabled ([prompt_layout] enabled = false): the whole context as one
+    user message, as before.
+    """
+
+    def __init__(self):
+        self.enabled = settings.get("prompt_layout", "enabled", True)
+
+    def split(self, context: Dict[str, Any]) -> Tuple[List[str], str]:
+        """
+        (prefix user messages, tail user message) for one context.
+        """
+        if not self.enabled:
+            return [], _dumps(context)
+        stable = {field: context[field] for field in STABLE_FIELDS if context.get(field)}
+        tail = {k: v for k, v in context.items() if k not in STABLE_FIELDS}
+        return ([_dumps(stable)] if stable else []), _dumps(tail, sort_keys=True)
+
+    def split_batch(self, contexts: Sequence[Dict[str, Any]]) -> Tuple[List[str], str]:
+        """
+        Batched judge request: stable fields shared by every context (the
+        persona) go into the prefix once, the rest into
+        {"requests": [{"id", "context"}]}.
+        """
+        if not self.enabled:
+            return [], _dumps({"requests": [{"id": str(i), "context": c} for i, c in enumerate(contexts)]})
+        shared = {}
+        for field in STABLE_FIELDS:
+            values = [c.get(field) for c in contexts]
+            if values[0] and all(v == values[0] for v in values):
+                shared[field] = values[0]
+        requests = [
+            {"id": str(i), "context": {k: v for k, v in c.items() if k not in shared}}
+            for i, c in enumerate(contexts)
+        ]
+        return ([_dumps(shared)] if shared else []), _dumps({"requests": requests}, sort_keys=True)
+
+
+def build_messages(system_prompt: str, prefix: Sequence[str], user_content: str) -> List[Dict[str, str]]:
+    return (
+        [{"role": "system", "content": system_prompt}]
+        + [{"role": "user", "content": part} for part in prefix]
+        + [{"role": "user", "content": user_content}]
+    )
+
+
+prompt_layout = PromptLayout()
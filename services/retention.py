@@ -0,0 +1,123 @@
+import asyncio
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from config import settings
+from services.storage import Storage, storage, async_storage
+
+
+class RetentionManager:
+    """
+    Keeps the hot database small.
+
+    - Closed topics older than `archive_after_days` have their messages moved
+      to gzip JSON-lines files, one per group per month, under archive_dir.
+      The topic row and summary stay hot (past_topics and search still see
+      them); Storage.get_topic_messages reads archived messages transparently.
+    - decision_logs older than `decision_log_days` and llm_calls older than
+      `llm_call_days` are deleted.
+    - Freed pages are returned to the filesystem a few at a time with
+      incremental vacuum. Databases created before auto_vacuum=INCREMENTAL
+      need a one-time full VACUUM first; it rewrites the whole file, so it
+      runs offline: `python -m services.retention` with the bot stopped.
+
+    Every step runs on the database thread in small batches, between the
+    write-behind flushes, so the bot never waits on it for long.
+    """
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self.archive_after_days = settings.get("retention", "archive_after_days", 30)
+        self.decision_log_days = settings.get("retention", "decision_log_days", 14)
+        self.llm_call_days = settings.get("retention", "llm_call_days", 30)
+        self.batch_topics = settings.get("retention", "batch_topics", 200)
+        self.vacuum_pages = settings.get("retention", "vacuum_pages", 500)
+        self.interval = settings.get("retention", "interval_seconds", 3600)
+        self.convert_auto_vacuum = settings.get("retention", "convert_auto_vacuum", False)
+        self.stats = {"topics_archived": 0, "messages_archived": 0, "logs_pruned": 0, "free_pages": 0}
+
+    @staticmethod
+    def archive_path(group_id: str, start_time: float) -> str:
+        return f"{group_id}/{time.strftime('%Y-%m', time.localtime(start_time))}.jsonl.gz"
+
+    def archive_batch(self, now: float = None) -> int:
+        """
+        Archive up to batch_topics topics. Returns how many were archived.
+        """
+        now = now or time.time()
+        topics = self._storage.get_archivable_topics(now - self.archive_after_days * 86400, self.batch_topics)
+        if not topics:
+            return 0
+
+        by_file: Dict[str, List[Tuple[Dict, List[Dict]]]] = defaultdict(list)
+        for topic in topics:
+            messages = self._storage.get_topic_message_rows(topic["id"])
+            by_file[self.archive_path(topic["group_id"], topic["start_time"])].append((topic, messages))
+
+        archived = []
+        for path, entries in by_file.items():
+            # File first, database second: a crash in between only means the
+            # topic is archived twice, never lost
+            self._storage.append_archive(path, [
+                {"topic": topic, "messages": [{k: m[k] for k in ("user_id", "nickname", "content", "timestamp")} for m in messages]}
+                for topic, messages in entries
+            ])
+            archived.extend((topic["id"], path, messages) for topic, messages in entries)
+        self._storage.mark_topics_archived(archived)
+
+        self.stats["topics_archived"] += len(archived)
+        self.stats["messages_archived"] += sum(len(m) for _, _, m in archived)
+        return len(archived)
+
+    def run_once(self, now: float = None) -> Dict[str, int]:
+        """
+        One retention pass. Synchronous: run it on the database thread.
+        """
+        now = now or time.time()
+        archived = self.archive_batch(now)
+        pruned = self._storage.prune_decision_logs(now - self.decision_log_days * 86400)
+        pruned += self._storage.prune_llm_calls(now - self.llm_call_days * 86400)
+        free_pages = self._storage.incremental_vacuum(self.vacuum_pages)
+        self.stats["logs_pruned"] += pruned
+        self.stats["free_pages"] = free_pages
+        return {"topics_archived": archived, "logs_pruned": pruned, "free_pages": free_pages}
+
+    async def run_forever(self):
+        try:
+            if self.convert_auto_vacuum:
+                # Blocks every read and write until done: small databases only
+                if await async_storage.call(self._storage.ensure_incremental_vacuum):
+                    print("[Retention] Database converted to incremental auto-vacuum")
+            elif not await async_storage.call(self._storage.has_incremental_vacuum):
+                print("[Retention] Free pages are not returned to the OS; stop the bot and run "
+                      "`python -m services.retention` once to enable incremental vacuum")
+        except Exception as e:
+            print(f"[Retention] auto_vacuum conversion failed: {e}")
+        last_free_pages = None
+        while True:
+            try:
+                await async_storage.flush()
+                result = await async_storage.call(self.run_once)
+                if result["topics_archived"] or result["logs_pruned"]:
+                    print(f"[Retention] {result}")
+                # Keep going in small steps while there is a backlog
+                shrinking = last_free_pages is None or result["free_pages"] < last_free_pages
+                last_free_pages = result["free_pages"]
+                if result["topics_archived"] >= self.batch_topics or (result["free_pages"] and shrinking):
+                    await asyncio.sleep(1)
+                    continue
+            except Exception as e:
+                print(f"[Retention] Pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+retention_manager = RetentionManager(storage)
+
+
+if __name__ == "__main__":
+    # Offline maintenance, with the bot stopped
+    print("Converting the database to incremental auto-vacuum (full VACUUM)...")
+    if storage.ensure_incremental_vacuum():
+        print("Done.")
+    else:
+        print("Already using incremental auto-vacuum, nothing to do.")
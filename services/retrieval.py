@@ -0,0 +1,196 @@
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from config import settings
+from services.cache import LRUCache, MISSING
+from services.memory import memory_compactor, normalize
+from services.storage import Storage, storage, async_storage
+
+# Hashed n-gram buckets as stored in the database. The in-memory index folds
+# them down to `vector_dim` (a power of two), so the dimension can change
+# without recomputing stored vectors.
+_HASH_BUCKETS = 1 << 16
+_NGRAM_SIZES = (1, 2, 3)
+
+
+def vectorize(text: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sparse term frequencies of the hashed character 1-3 grams of `text`.
+    Returns (bucket indices uint16, sublinear tf float16).
+    """
+    text = normalize(text)
+    grams = Counter(
+        text[i:i + n]
+        for n in _NGRAM_SIZES
+        for i in range(len(text) - n + 1)
+    )
+    counts: Dict[int, int] = {}
+    for gram, tf in grams.items():
+        bucket = zlib.crc32(gram.encode("utf-8")) % _HASH_BUCKETS
+        counts[bucket] = counts.get(bucket, 0) + tf
+    indices = np.fromiter(counts.keys(), dtype=np.uint16, count=len(counts))
+    values = 1 + np.log(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return indices, values.astype(np.float16)
+
+
+def pack(indices: np.ndarray, values: np.ndarray) -> bytes:
+    """
+    Compact blob: all uint16 indices followed by all float16 values (4 bytes per term).
+    """
+    return indices.astype("<u2").tobytes() + values.astype("<f2").tobytes()
+
+
+def unpack(blob: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    n = len(blob) // 4
+    indices = np.frombuffer(blob, dtype="<u2", count=n)
+    values = np.frombuffer(blob, dtype="<f2", count=n, offset=n * 2)
+    return indices, values
+
+
+class UserIndex:
+    """
+    TF-IDF matrix over one user's memories.
+    """
+
+    def __init__(self, ids: List[int], contents: List[str], last_seen: List[float],
+                 vectors: List[Tuple[np.ndarray, np.ndarray]], dim: int):
+        self.ids = ids
+        self.contents = contents
+        self.dim = dim
+        self.recency = np.argsort(-np.asarray(last_seen, dtype=np.float64)) if ids else np.empty(0, dtype=np.int64)
+
+        tf = np.zeros((len(ids), dim), dtype=np.float32)
+        for row, (indices, values) in enumerate(vectors):
+            np.add.at(tf[row], indices.astype(np.int64) % dim, values.astype(np.float32))
+
+        df = np.count_nonzero(tf, axis=0)
+        self.idf = (np.log((1 + len(ids)) / (1 + df)) + 1).astype(np.float32)
+        self.matrix = self._normalize_rows(tf * self.idf)
+
+    @staticmethod
+    def _normalize_rows(m: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return m / norms
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Queries as an (n_queries, dim) matrix in this index's TF-IDF space.
+        """
+        q = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            indices, values = vectorize(text)
+            np.add.at(q[row], indices.astype(np.int64) % self.dim, values.astype(np.float32))
+        return self._normalize_rows(q * self.idf)
+
+    def score(self, texts: Sequence[str], weights: Sequence[float]) -> np.ndarray:
+        """
+        Weighted cosine similarity of every memory against several queries at once.
+        """
+        sims = self.matrix @ self.embed(texts).T  # (n_memories, n_queries)
+        return sims @ np.asarray(weights, dtype=np.float32)
+
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.idf.nbytes
+
+
+class RetrievalEngine:
+    """
+    Relevance-ranked memory retrieval, fully local.
+
+    Each memory stores its hashed n-gram term frequencies (computed lazily
+    on first use); a per-user TF-IDF index is kept in an LRU of
+    `index_cache_users` entries and dropped whenever that user's memories
+    change (or after `index_ttl_seconds`).
+    """
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self.top_k = settings.get("memory", "retrieval_top_k", 8)
+        self.dim = settings.get("memory", "vector_dim", 1024)
+        self.min_similarity = settings.get("memory", "min_similarity", 0.05)
+        self.max_users = settings.get("memory", "index_cache_users", 256)
+        self._indexes = LRUCache(self.max_users, settings.get("memory", "index_ttl_seconds", 3600))
+        # Bumped on invalidation so an index built from pre-change rows is not cached
+        self._generations: Dict[str, int] = {}
+        self.stats = {"builds": 0, "vectorized": 0}
+
+    def invalidate(self, user_id: str, *_):
+        self._indexes.pop(user_id)
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def invalidate_many(self, user_ids: List[str]):
+        for user_id in user_ids:
+            self.invalidate(user_id)
+
+    def build_index(self, user_id: str) -> UserIndex:
+        """
+        Load (and vectorize where missing) a user's memories. Synchronous: run
+        it on the database thread.
+        """
+        rows = self._storage.get_memory_vectors(user_id)
+        vectors = []
+        missing = []
+        for memory_id, content, _, blob in rows:
+            if blob is None:
+                indices, values = vectorize(content)
+                blob = pack(indices, values)
+                missing.append((memory_id, blob))
+            vectors.append(unpack(blob))
+        if missing:
+            self._storage.set_memory_vectors(missing)
+            self.stats["vectorized"] += len(missing)
+        self.stats["builds"] += 1
+        return UserIndex(
+            [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], vectors, self.dim
+        )
+
+    async def get_index(self, user_id: str) -> UserIndex:
+        index = self._indexes.get(user_id)
+        if index is not MISSING:
+            return index
+        generation = self._generations.get(user_id, 0)
+        index = await async_storage.call(self.build_index, user_id)
+        if self._generations.get(user_id, 0) == generation:
+            self._indexes.put(user_id, index)
+        return index
+
+    def cache_stats(self) -> Dict[str, int]:
+        return dict(self._indexes.stats, size=len(self._indexes))
+
+    @staticmethod
+    def rank(index: UserIndex, scores: np.ndarray, k: int, min_similarity: float) -> List[str]:
+        """
+        Top-k by score; slots left over (weak matches) are filled with the most
+        recently seen memories so the writer still gets some background.
+        """
+        if not index.ids or k <= 0:
+            return []
+        k = min(k, len(index.ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        chosen = [int(i) for i in top if scores[i] >= min_similarity]
+        if len(chosen) < k:
+            seen = set(chosen)
+            chosen += [int(i) for i in index.recency if int(i) not in seen][:k - len(chosen)]
+        return [index.contents[i] for i in chosen]
+
+    async def search(self, user_id: str, queries: Sequence[str], weights: Optional[Sequence[float]] = None,
+                     k: Optional[int] = None) -> List[str]:
+        """
+        Memories of `user_id` most relevant to the weighted `queries`.
+        """
+        index = await self.get_index(user_id)
+        if not index.ids:
+            return []
+        pairs = [(q, w) for q, w in zip(queries, weights or [1.0] * len(queries)) if q]
+        if not pairs:
+            return self.rank(index, np.zeros(len(index.ids), dtype=np.float32), k or self.top_k, 1.0)
+        scores = index.score([q for q, _ in pairs], [w for _, w in pairs])
+        return self.rank(index, scores, k or self.top_k, self.min_similarity)
+
+
+retrieval = RetrievalEngine(storage)
+async_storage.add_listener("add_memory", retrieval.invalidate)
+memory_compactor.add_listener(retrieval.invalidate_many)
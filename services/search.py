@@ -0,0 +1,43 @@
+import re
+from typing import List
+
+# Full-text search helpers shared by Storage, the migrations and the dashboard.
+#
+# FTS5's unicode61 tokenizer treats a run of CJK characters as one token, so
+# Chinese text is indexed as overlapping character bigrams instead
+# ("菠萝披萨" -> "菠萝 萝披 披萨"). Latin words and numbers are kept whole.
+# Queries go through the same transformation, so 2-character words match.
+
+_CJK = r"㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_TOKEN = re.compile(rf"[{_CJK}]+|[^\W_]+", re.UNICODE)
+_CJK_RUN = re.compile(rf"^[{_CJK}]+$")
+
+
+def segment(text: str) -> List[str]:
+    tokens = []
+    for run in _TOKEN.findall((text or "").lower()):
+        if _CJK_RUN.match(run):
+            if len(run) == 1:
+                tokens.append(run)
+            else:
+                tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def to_fts_text(text: str) -> str:
+    """
+    Text as stored in the FTS index.
+    """
+    return " ".join(segment(text))
+
+
+def build_match_query(text: str, mode: str = "OR", max_terms: int = 32) -> str:
+    """
+    FTS5 MATCH expression for free text. "OR" ranks by overlap (recall),
+    "AND" requires every term (selective, for search boxes).
+    Returns "" when the text has no searchable terms.
+    """
+    terms = list(dict.fromkeys(segment(text)))[:max_terms]
+    return f" {mode} ".join('"' + t.replace('"', '""') + '"' for t in terms)
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from config import settings
+from services.llm import LLMService, llm_service
+from services.llm_scheduler import Priority
+from services.tokens import estimate_tokens
+
+_QUESTION_ENDINGS = ("?", "？", "吗", "呢", "么")
+
+
+class Speculation:
+    """
+    A chat generation started before the judge has answered. Messages are
+    held back until attach() hands them to the real sender; discard()
+    cancels the generation.
+    """
+
+    def __init__(self, llm: LLMService, context: Dict[str, Any], group_id: str, signal: str):
+        self.signal = signal
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.buffer: List[str] = []
+        self._sink: Optional[Callable[[str], None]] = None
+        self.prompt_tokens = estimate_tokens(str(context))
+        self.task = asyncio.create_task(llm.generate_chat(
+            # Speculative work must not jump ahead of other groups' judges
+            context, on_message=self._on_message, group_id=group_id, priority=Priority.JUDGE
+        ))
+        self.task.add_done_callback(self._done)
+
+    def _done(self, _):
+        self.finished = time.monotonic()
+
+    def _on_message(self, message: str):
+        if self._sink is None:
+            self.buffer.append(message)
+        else:
+            self._sink(message)
+
+    def attach(self, sink: Callable[[str], None]):
+        """
+        Deliver held-back messages to `sink`, and every later one directly.
+        """
+        for message in self.buffer:
+            sink(message)
+        self._sink = sink
+
+    def discard(self):
+        if self.task.done():
+            # Nobody awaits it any more; keep a failure from going unreported
+            if not self.task.cancelled():
+                self.task.exception()
+        else:
+            self.task.cancel()
+
+
+class Speculator:
+    """
+    Starts generate_chat alongside the judge when cheap signals predict a
+    reply, so a "yes" costs max(judge, chat) instead of judge + chat.
+
+    Signals ([speculation] signals, checked in order):
+    - reply_to_bot: the previous line in the group is the bot's
+    - name: the bot's name is in the latest message
+    - question: the latest message reads as a question
+    - hot_group: at least hot_min_decisions of the group's decisions in the
+      last hot_window_minutes were high-trigger replies
+    A "no" from the judge cancels the generation; the tokens it cost count
+    against wasted_tokens_per_hour, and speculation pauses once that is spent.
+    """
+
+    def __init__(self, llm: LLMService):
+        self.llm = llm
+        self.enabled = settings.get("speculation", "enabled", False)
+        self.signals = settings.get("speculation", "signals", ["reply_to_bot", "name", "question", "hot_group"])
+        self.hot_window = settings.get("speculation", "hot_window_minutes", 10) * 60
+        self.hot_min_decisions = settings.get("speculation", "hot_min_decisions", 2)
+        self.wasted_budget = settings.get("speculation", "wasted_tokens_per_hour", 20000)
+        self.bot_names = [
+            n for n in dict.fromkeys([settings.get("bot", "name"), settings.get("bot", "english_name"), "柒槿年", "QJinEra"]) if n
+        ]
+        self._hot: Dict[str, Deque[float]] = {}
+        self._wasted: Deque[Tuple[float, int]] = deque()
+        self.stats = {"started": 0, "hits": 0, "misses": 0, "cancelled": 0, "over_budget": 0,
+                      "wasted_tokens": 0, "saved_seconds": 0.0}
+
+    def signal(self, group_id: str, context: Dict[str, Any], now: float = None) -> Optional[str]:
+        """
+        The first signal that predicts a reply, or None.
+        """
+        recent = context.get("recent_messages") or []
+        latest = (context.get("latest_message") or "").strip()
+        for name in self.signals:
+            if name == "reply_to_bot":
+                if len(recent) >= 2 and any(recent[-2].startswith(f"{bot}: ") for bot in self.bot_names):
+                    return name
+            elif name == "name":
+                if any(bot.lower() in latest.lower() for bot in self.bot_names):
+                    return name
+            elif name == "question":
+                if latest.endswith(_QUESTION_ENDINGS) or "?" in latest or "？" in latest:
+                    return name
+            elif name == "hot_group":
+                if len(self._recent_hot(group_id, now or time.time())) >= self.hot_min_decisions:
+                    return name
+        return None
+
+    def _recent_hot(self, group_id: str, now: float) -> Deque[float]:
+        hot = self._hot.get(group_id)
+        if hot is None:
+            return deque()
+        while hot and hot[0] < now - self.hot_window:
+            hot.popleft()
+        if not hot:
+            del self._hot[group_id]
+            return deque()
+        return hot
+
+    def note_decision(self, group_id: str, decision: Dict[str, Any], now: float = None):
+        if decision.get("should_intervene") and decision.get("trigger_level") == "high":
+            self._hot.setdefault(group_id, deque(maxlen=16)).append(now or time.time())
+
+    def wasted_last_hour(self, now: float = None) -> int:
+        now = now or time.monotonic()
+        while self._wasted and self._wasted[0][0] < now - 3600:
+            self._wasted.popleft()
+        return sum(tokens for _, tokens in self._wasted)
+
+    def start(self, group_id: str, context: Dict[str, Any]) -> Optional[Speculation]:
+        if not self.enabled:
+            return None
+        signal = self.signal(group_id, context)
+        if signal is None:
+            return None
+        if self.wasted_last_hour() >= self.wasted_budget:
+            self.stats["over_budget"] += 1
+            return None
+        self.stats["started"] += 1
+        return Speculation(self.llm, dict(context, should_return_summary=True), group_id, signal)
+
+    def hit(self, speculation: Speculation):
+        """
+        The judge said yes: the time the generation already had is saved.
+        """
+        now = time.monotonic()
+        saved = (speculation.finished or now) - speculation.started
+        self.stats["hits"] += 1
+        self.stats["saved_seconds"] += saved
+        print(f"[Speculation] Hit ({speculation.signal}), saved {saved * 1000:.0f} ms "
+              f"(hit rate {self.hit_rate():.0%})")
+
+    def miss(self, speculation: Speculation, cancelled: bool = False):
+        """
+        The judge said no (or the group moved on): cancel and count the waste.
+        """
+        done = speculation.task.done()
+        speculation.discard()
+        wasted = speculation.prompt_tokens + (
+            self.llm.completion_estimate if done else estimate_tokens("".join(speculation.buffer))
+        )
+        self._wasted.append((time.monotonic(), wasted))
+        self.stats["cancelled" if cancelled else "misses"] += 1
+        self.stats["wasted_tokens"] += wasted
+        if not cancelled:
+            print(f"[Speculation] Miss ({speculation.signal}), ~{wasted} tokens wasted "
+                  f"(hit rate {self.hit_rate():.0%})")
+
+    def hit_rate(self) -> float:
+        decided = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / decided if decided else 0.0
+
+    def report(self) -> Dict[str, Any]:
+        hits = self.stats["hits"]
+        return {
+            **self.stats,
+            "hit_rate": self.hit_rate(),
+            "avg_saved_ms": self.stats["saved_seconds"] / hits * 1000 if hits else 0.0,
+            "wasted_last_hour": self.wasted_last_hour(),
+        }
+
+
+speculator = Speculator(llm_service)
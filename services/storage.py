@@ -1,101 +1,119 @@
+import asyncio
+import atexit
+import gzip
 import sqlite3
 import json
 import os
+import threading
 import time
-from typing import List, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, List, Dict, Any, Optional, Tuple
 from config import settings
+from services.migrations import migrate
+from services.search import build_match_query, to_fts_text
 
 class Storage:
-    def __init__(self):
-        self.db_path = settings.get("storage", "database_file", "qjinera.db")
+    def __init__(self, db_path: Optional[str] = None):
+        self.db_path = db_path or settings.get("storage", "database_file", "qjinera.db")
         self.data_dir = settings.get("storage", "data_dir", "data")
+        self.archive_dir = settings.get("retention", "archive_dir", os.path.join(self.data_dir, "archive"))
         
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
+
+        # Long-lived connections, one per thread (SQLite connections must not be
+        # shared across threads while in use). All of them are tracked so that
+        # close() can release them on shutdown.
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
             
         self._init_db()
 
-    def _init_db(self):
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Create topics table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS topics (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            group_id TEXT,
-            start_time REAL,
-            end_time REAL,
-            summary TEXT
-        )
-        ''')
-        
-        # Create messages table
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            topic_id INTEGER,
-            user_id TEXT,
-            nickname TEXT,
-            content TEXT,
-            timestamp REAL,
-            FOREIGN KEY(topic_id) REFERENCES topics(id)
-        )
-        ''')
-
-        # Create users table for user profiles
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id TEXT,
-            group_id TEXT,
-            nickname TEXT,
-            description TEXT,
-            interaction_count INTEGER DEFAULT 0,
-            last_active_time REAL,
-            PRIMARY KEY (user_id, group_id)
-        )
-        ''')
-        
-        # [新增] 决策日志表 - 用于 Dashboard 可视化监控
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS decision_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            group_id TEXT,
-            timestamp REAL,
-            judge_model TEXT,
-            should_intervene BOOLEAN,
-            trigger_level TEXT,
-            reason TEXT,
-            context_summary TEXT
-        )
-        ''')
-
-        # [新增] 记忆表 - 用于存储用户特定的事实 (Gemini Style)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS memories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            group_id TEXT,
-            content TEXT,
-            timestamp REAL,
-            UNIQUE(user_id, content)
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection with the tuned PRAGMAs from the [storage] section.
+        """
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=settings.get("storage", "busy_timeout_ms", 5000) / 1000,
+            cached_statements=settings.get("storage", "cached_statements", 256),
+            check_same_thread=False
         )
-        ''')
+        # Must come first: only takes effect before the database file is
+        # initialised. Existing databases are converted by the retention job.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute(f"PRAGMA journal_mode = {settings.get('storage', 'journal_mode', 'WAL')}")
+        conn.execute(f"PRAGMA synchronous = {settings.get('storage', 'synchronous', 'NORMAL')}")
+        # Negative cache_size is expressed in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = {-int(settings.get('storage', 'cache_size_kb', 16384))}")
+        conn.execute(f"PRAGMA mmap_size = {int(settings.get('storage', 'mmap_size_mb', 128)) * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
 
-        # Check if nickname column exists in messages (for migration)
-        cursor.execute("PRAGMA table_info(messages)")
-        columns = [info[1] for info in cursor.fetchall()]
-        if "nickname" not in columns:
+    def _conn(self) -> sqlite3.Connection:
+        """
+        Return the persistent connection owned by the calling thread.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the enclosed statements in one transaction on the thread's connection.
+        Commits on success, rolls back on error.
+        """
+        conn = self._conn()
+        if getattr(self._local, "in_batch", False):
+            # Part of an enclosing batch(), which owns the commit
+            yield conn
+            return
+        with conn:
+            yield conn
+
+    @contextmanager
+    def batch(self):
+        """
+        Group every write made inside the block into a single transaction.
+        """
+        conn = self._conn()
+        self._local.in_batch = True
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._local.in_batch = False
+
+    def close(self):
+        """
+        Close every persistent connection. Safe to call more than once.
+        """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
             try:
-                cursor.execute("ALTER TABLE messages ADD COLUMN nickname TEXT")
+                conn.close()
             except Exception as e:
-                print(f"Migration warning: {e}")
-        
-        conn.commit()
-        conn.close()
+                print(f"[Storage] Failed to close connection: {e}")
+        self._local = threading.local()
+
+    def _init_db(self):
+        migrate(self._conn())
 
     def get_connection(self):
-        return sqlite3.connect(self.db_path)
+        """
+        Open a new, independently owned connection. The caller is responsible for
+        closing it; internal operations use the persistent per-thread connection.
+        """
+        return self._connect()
 
     # JSON Operations
     def save_json(self, filename: str, data: Any):
@@ -113,48 +131,82 @@ class Storage:
         except Exception:
             return default
 
+    # Cold archive (gzip JSON lines, one file per group per month)
+    def append_archive(self, relative_path: str, records: List[Dict[str, Any]]):
+        """
+        Append records to an archive file as a new gzip member and fsync it.
+        """
+        path = os.path.join(self.archive_dir, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="ab") as f:
+                for record in records:
+                    f.write((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+
+    def read_archive(self, relative_path: str) -> List[Dict[str, Any]]:
+        path = os.path.join(self.archive_dir, relative_path)
+        if not os.path.exists(path):
+            return []
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def get_archived_topic(self, topic_id: int) -> Optional[Dict[str, Any]]:
+        """
+        A topic moved to cold storage, with all of its messages.
+        """
+        row = self._conn().execute('SELECT archive_path FROM topics WHERE id = ?', (topic_id,)).fetchone()
+        if not row or not row[0]:
+            return None
+        found = None
+        for record in self.read_archive(row[0]):
+            # A retried archive run may have written the topic twice; last one wins
+            if record["topic"]["id"] == topic_id:
+                found = record
+        return found
+
     # Database Operations
     def create_topic(self, group_id: str, start_time: float) -> int:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO topics (group_id, start_time) VALUES (?, ?)', (group_id, start_time))
-        topic_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return topic_id
+        with self._transaction() as conn:
+            cursor = conn.execute('INSERT INTO topics (group_id, start_time) VALUES (?, ?)', (group_id, start_time))
+            return cursor.lastrowid
 
     def update_topic_summary(self, topic_id: int, summary: str, end_time: float = None):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        if end_time:
-            cursor.execute('UPDATE topics SET summary = ?, end_time = ? WHERE id = ?', (summary, end_time, topic_id))
-        else:
-            cursor.execute('UPDATE topics SET summary = ? WHERE id = ?', (summary, topic_id))
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            if summary is None:
+                # Closing a topic without a summary of its own must not wipe
+                # one the background sweeper wrote in the meantime
+                if end_time:
+                    conn.execute('UPDATE topics SET end_time = ? WHERE id = ?', (end_time, topic_id))
+                return
+            if end_time:
+                conn.execute('UPDATE topics SET summary = ?, end_time = ? WHERE id = ?', (summary, end_time, topic_id))
+            else:
+                conn.execute('UPDATE topics SET summary = ? WHERE id = ?', (summary, topic_id))
+            # Keep the summary index in step
+            conn.execute('DELETE FROM topics_fts WHERE rowid = ?', (topic_id,))
+            if summary:
+                conn.execute('INSERT INTO topics_fts (rowid, body, group_id) SELECT id, ?, group_id FROM topics WHERE id = ?',
+                             (to_fts_text(summary), topic_id))
 
     def add_message(self, topic_id: int, user_id: str, content: str, timestamp: float, nickname: str = ""):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('INSERT INTO messages (topic_id, user_id, nickname, content, timestamp) VALUES (?, ?, ?, ?, ?)', 
-                       (topic_id, user_id, nickname, content, timestamp))
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            cursor = conn.execute('INSERT INTO messages (topic_id, user_id, nickname, content, timestamp) VALUES (?, ?, ?, ?, ?)', 
+                                  (topic_id, user_id, nickname, content, timestamp))
+            conn.execute('INSERT INTO messages_fts (rowid, body) VALUES (?, ?)', (cursor.lastrowid, to_fts_text(content)))
 
     def get_topic_messages(self, topic_id: int, limit: int = 50) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT user_id, nickname, content, timestamp FROM messages WHERE topic_id = ? ORDER BY timestamp ASC LIMIT ?', (topic_id, limit))
-        rows = cursor.fetchall()
-        conn.close()
+        rows = self._conn().execute('SELECT user_id, nickname, content, timestamp FROM messages WHERE topic_id = ? ORDER BY timestamp ASC LIMIT ?', (topic_id, limit)).fetchall()
+        if not rows:
+            # Transparently serve topics that were moved to the cold archive
+            archived = self.get_archived_topic(topic_id)
+            if archived:
+                return archived["messages"][:limit]
         return [{"user_id": r[0], "nickname": r[1], "content": r[2], "timestamp": r[3]} for r in rows]
 
     def get_user(self, group_id: str, user_id: str) -> Optional[Dict[str, Any]]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE group_id = ? AND user_id = ?', (group_id, user_id))
-        row = cursor.fetchone()
-        conn.close()
+        row = self._conn().execute('SELECT * FROM users WHERE group_id = ? AND user_id = ?', (group_id, user_id)).fetchone()
         
         if row:
             return {
@@ -168,135 +220,403 @@ class Storage:
         return None
 
     def update_user(self, group_id: str, user_id: str, nickname: str, timestamp: float):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        cursor.execute('SELECT interaction_count FROM users WHERE group_id = ? AND user_id = ?', (group_id, user_id))
-        row = cursor.fetchone()
-        
-        if row:
-            new_count = row[0] + 1
-            cursor.execute('''
-                UPDATE users 
-                SET nickname = ?, interaction_count = ?, last_active_time = ? 
-                WHERE group_id = ? AND user_id = ?
-            ''', (nickname, new_count, timestamp, group_id, user_id))
-        else:
-            cursor.execute('''
+        with self._transaction() as conn:
+            # Insert a fresh profile or bump the existing one in a single statement
+            conn.execute('''
                 INSERT INTO users (user_id, group_id, nickname, interaction_count, last_active_time)
                 VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT(user_id, group_id) DO UPDATE SET
+                    nickname = excluded.nickname,
+                    interaction_count = interaction_count + 1,
+                    last_active_time = excluded.last_active_time
             ''', (user_id, group_id, nickname, timestamp))
-            
-        conn.commit()
-        conn.close()
 
     def update_user_description(self, group_id: str, user_id: str, description: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET description = ? WHERE group_id = ? AND user_id = ?', (description, group_id, user_id))
-        conn.commit()
-        conn.close()
+        with self._transaction() as conn:
+            conn.execute('UPDATE users SET description = ? WHERE group_id = ? AND user_id = ?', (description, group_id, user_id))
 
-    def add_decision_log(self, group_id: str, judge_model: str, result: Dict, context_summary: Optional[str]):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def add_decision_log(self, group_id: str, judge_model: str, result: Dict, context_summary: Optional[str], timestamp: float = None):
         try:
-            cursor.execute('''
-                INSERT INTO decision_logs (group_id, timestamp, judge_model, should_intervene, trigger_level, reason, context_summary)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                group_id, 
-                time.time(), 
-                judge_model,
-                result.get("should_intervene", False),
-                result.get("trigger_level", "none"),
-                result.get("reason", ""),
-                context_summary or ""
-            ))
-            conn.commit()
+            with self._transaction() as conn:
+                conn.execute('''
+                    INSERT INTO decision_logs (group_id, timestamp, judge_model, should_intervene, trigger_level, reason, context_summary)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    group_id, 
+                    timestamp or time.time(), 
+                    judge_model,
+                    result.get("should_intervene", False),
+                    result.get("trigger_level", "none"),
+                    result.get("reason", ""),
+                    context_summary or ""
+                ))
         except Exception as e:
             print(f"[Storage] Failed to log decision: {e}")
-        finally:
-            conn.close()
 
-    def add_memory(self, user_id: str, group_id: str, content: str):
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def add_llm_call(self, started_at: float, model: str, kind: str, group_id: str, queue_ms: int, latency_ms: int,
+                     prompt_tokens: int, completion_tokens: int, outcome: str, retries: int = 0, path: str = "primary",
+                     cached_tokens: int = 0):
+        with self._transaction() as conn:
+            conn.execute('''
+                INSERT INTO llm_calls (started_at, model, kind, group_id, queue_ms, latency_ms,
+                                       prompt_tokens, completion_tokens, outcome, retries, path, cached_tokens)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (started_at, model, kind, group_id, queue_ms, latency_ms, prompt_tokens, completion_tokens, outcome,
+                  retries, path, cached_tokens))
+
+    def add_memory(self, user_id: str, group_id: str, content: str, timestamp: float = None):
+        timestamp = timestamp or time.time()
         try:
-            cursor.execute('''
-                INSERT OR IGNORE INTO memories (user_id, group_id, content, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, group_id, content, time.time()))
-            conn.commit()
+            with self._transaction() as conn:
+                # An exact repeat counts as another sighting of the same fact
+                conn.execute('''
+                    INSERT INTO memories (user_id, group_id, content, timestamp, hit_count, last_seen)
+                    VALUES (?, ?, ?, ?, 1, ?)
+                    ON CONFLICT(user_id, content) DO UPDATE SET
+                        hit_count = hit_count + 1,
+                        last_seen = excluded.last_seen
+                ''', (user_id, group_id, content, timestamp, timestamp))
         except Exception as e:
             print(f"[Storage] Failed to add memory: {e}")
-        finally:
-            conn.close()
 
     def get_memories(self, user_id: str, limit: int = 20) -> List[str]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        rows = self._conn().execute('''
             SELECT content FROM memories 
             WHERE user_id = ? 
-            ORDER BY timestamp DESC 
+            ORDER BY last_seen DESC 
             LIMIT ?
-        ''', (user_id, limit))
-        rows = cursor.fetchall()
-        conn.close()
+        ''', (user_id, limit)).fetchall()
         return [r[0] for r in rows]
 
+    def get_memory_rows(self, user_id: str) -> List[Dict[str, Any]]:
+        """
+        Every memory of a user with its compaction bookkeeping, oldest first.
+        """
+        rows = self._conn().execute('''
+            SELECT id, content, timestamp, hit_count, last_seen, simhash
+            FROM memories
+            WHERE user_id = ?
+            ORDER BY id ASC
+        ''', (user_id,)).fetchall()
+        return [
+            {"id": r[0], "content": r[1], "timestamp": r[2], "hit_count": r[3] or 1,
+             "last_seen": r[4] or r[2], "simhash": r[5]}
+            for r in rows
+        ]
+
+    def get_memory_vectors(self, user_id: str) -> List[Tuple[int, str, float, Optional[bytes]]]:
+        """
+        (id, content, last_seen, vector blob) for every memory of a user.
+        """
+        return self._conn().execute('''
+            SELECT id, content, COALESCE(last_seen, timestamp), vector
+            FROM memories
+            WHERE user_id = ?
+            ORDER BY id ASC
+        ''', (user_id,)).fetchall()
+
+    def set_memory_vectors(self, vectors: List[Tuple[int, bytes]]):
+        with self._transaction() as conn:
+            conn.executemany('UPDATE memories SET vector = ? WHERE id = ?', [(blob, i) for i, blob in vectors])
+
+    def get_memory_users_since(self, after_id: int, limit: int) -> Tuple[int, List[str]]:
+        """
+        Users owning memories with id > after_id (at most `limit` rows are looked at).
+        Returns (highest id seen, user ids).
+        """
+        rows = self._conn().execute(
+            'SELECT id, user_id FROM memories WHERE id > ? ORDER BY id ASC LIMIT ?', (after_id, limit)
+        ).fetchall()
+        if not rows:
+            return after_id, []
+        return rows[-1][0], list(dict.fromkeys(r[1] for r in rows))
+
+    def get_user_nicknames(self, user_id: str) -> List[str]:
+        rows = self._conn().execute(
+            'SELECT DISTINCT nickname FROM users WHERE user_id = ? AND nickname IS NOT NULL', (user_id,)
+        ).fetchall()
+        return [r[0] for r in rows if r[0]]
+
+    def apply_memory_compaction(self, updates: List[Dict[str, Any]], deletes: List[int]):
+        """
+        Persist the result of one compaction pass in a single transaction.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                'UPDATE memories SET hit_count = ?, last_seen = ?, timestamp = ?, simhash = ? WHERE id = ?',
+                [(u["hit_count"], u["last_seen"], u["timestamp"], u["simhash"], u["id"]) for u in updates]
+            )
+            conn.executemany('DELETE FROM memories WHERE id = ?', [(i,) for i in deletes])
+
+    # Key/value state for background jobs
+    def get_meta(self, key: str, default: Any = None) -> Any:
+        row = self._conn().execute('SELECT value FROM storage_meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key: str, value: Any):
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO storage_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value',
+                (key, json.dumps(value))
+            )
+
     def get_recent_topics(self, group_id: str, limit: int = 5) -> List[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        rows = self._conn().execute('''
             SELECT id, summary, start_time, end_time 
             FROM topics 
             WHERE group_id = ? AND summary IS NOT NULL 
             ORDER BY start_time DESC 
             LIMIT ?
-        ''', (group_id, limit))
-        rows = cursor.fetchall()
-        conn.close()
+        ''', (group_id, limit)).fetchall()
         
         return [
             {"id": r[0], "summary": r[1], "start_time": r[2], "end_time": r[3]} 
             for r in rows
         ]
 
-    def get_latest_active_topic(self, group_id: str) -> Optional[Dict]:
-        conn = self.get_connection()
-        cursor = conn.cursor()
+    def search_topics(self, group_id: str, text: str, limit: int = 5, exclude_topic_id: Optional[int] = None) -> List[Dict]:
+        """
+        Summarized topics of a group ranked by full-text match (bm25) against `text`.
+        """
+        query = build_match_query(text)
+        if not query:
+            return []
+        rows = self._conn().execute('''
+            SELECT t.id, t.summary, t.start_time, t.end_time, bm25(topics_fts) AS score
+            FROM topics_fts
+            JOIN topics t ON t.id = topics_fts.rowid
+            WHERE topics_fts MATCH ? AND topics_fts.group_id = ? AND t.id != ?
+            ORDER BY score
+            LIMIT ?
+        ''', (query, group_id, exclude_topic_id or -1, limit)).fetchall()
+        return [
+            {"id": r[0], "summary": r[1], "start_time": r[2], "end_time": r[3], "score": -r[4]}
+            for r in rows
+        ]
+
+    def search_messages(self, text: str, limit: int = 50, group_id: Optional[str] = None) -> List[Dict]:
+        """
+        Newest messages containing every term of `text`.
+        """
+        query = build_match_query(text, mode="AND")
+        if not query:
+            return []
+        rows = self._conn().execute('''
+            SELECT m.id, t.group_id, m.topic_id, m.user_id, m.nickname, m.content, m.timestamp
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN topics t ON t.id = m.topic_id
+            WHERE messages_fts MATCH ? AND (? IS NULL OR t.group_id = ?)
+            ORDER BY messages_fts.rowid DESC
+            LIMIT ?
+        ''', (query, group_id, group_id, limit)).fetchall()
+        return [
+            {"id": r[0], "group_id": r[1], "topic_id": r[2], "user_id": r[3], "nickname": r[4],
+             "content": r[5], "timestamp": r[6]}
+            for r in rows
+        ]
+
+    # Retention
+    def get_archivable_topics(self, before: float, limit: int) -> List[Dict[str, Any]]:
+        """
+        Closed topics that ended before `before` and are still in the hot tables.
+        """
+        rows = self._conn().execute('''
+            SELECT id, group_id, start_time, end_time, summary
+            FROM topics
+            WHERE archive_path IS NULL AND end_time < ?
+            ORDER BY end_time ASC
+            LIMIT ?
+        ''', (before, limit)).fetchall()
+        return [
+            {"id": r[0], "group_id": r[1], "start_time": r[2], "end_time": r[3], "summary": r[4]}
+            for r in rows
+        ]
+
+    # Topic sweeper
+    def close_expired_topics(self, before: float, limit: int) -> int:
+        """
+        Close open topics whose last message is older than `before`; end_time
+        becomes the time of that last message. Returns how many were closed.
+        """
+        with self._transaction() as conn:
+            return conn.execute('''
+                UPDATE topics
+                SET end_time = COALESCE((SELECT MAX(timestamp) FROM messages WHERE topic_id = topics.id), start_time)
+                WHERE id IN (
+                    SELECT t.id FROM topics t
+                    WHERE t.end_time IS NULL AND t.start_time < ?
+                      AND COALESCE((SELECT MAX(timestamp) FROM messages m WHERE m.topic_id = t.id), t.start_time) < ?
+                    LIMIT ?
+                )
+            ''', (before, before, limit)).rowcount
+
+    def get_unsummarized_topics(self, limit: int, max_attempts: int) -> List[Dict[str, Any]]:
+        """
+        Closed, still hot topics without a summary, most recently ended first.
+        """
+        rows = self._conn().execute('''
+            SELECT id, group_id, start_time, end_time
+            FROM topics
+            WHERE summary IS NULL AND end_time IS NOT NULL
+              AND archive_path IS NULL AND summary_attempts < ?
+            ORDER BY end_time DESC
+            LIMIT ?
+        ''', (max_attempts, limit)).fetchall()
+        return [
+            {"id": r[0], "group_id": r[1], "start_time": r[2], "end_time": r[3]}
+            for r in rows
+        ]
+
+    def add_summary_attempts(self, attempts: List[Tuple[int, int]]):
+        """
+        `attempts` is [(topic_id, attempts to add)].
+        """
+        with self._transaction() as conn:
+            conn.executemany('UPDATE topics SET summary_attempts = summary_attempts + ? WHERE id = ?',
+                             [(n, topic_id) for topic_id, n in attempts])
+
+    def get_topic_message_rows(self, topic_id: int) -> List[Dict[str, Any]]:
+        rows = self._conn().execute('''
+            SELECT id, user_id, nickname, content, timestamp
+            FROM messages WHERE topic_id = ? ORDER BY timestamp ASC
+        ''', (topic_id,)).fetchall()
+        return [
+            {"id": r[0], "user_id": r[1], "nickname": r[2], "content": r[3], "timestamp": r[4]}
+            for r in rows
+        ]
+
+    def mark_topics_archived(self, archived: List[Tuple[int, str, List[Dict[str, Any]]]]):
+        """
+        Drop the hot copies of archived topics' messages in one transaction.
+        `archived` is [(topic_id, archive_path, message rows)].
+        """
+        with self._transaction() as conn:
+            for topic_id, path, messages in archived:
+                # Contentless FTS rows are removed by replaying their indexed text
+                conn.executemany(
+                    "INSERT INTO messages_fts (messages_fts, rowid, body) VALUES ('delete', ?, ?)",
+                    [(m["id"], to_fts_text(m["content"])) for m in messages]
+                )
+                conn.execute('DELETE FROM messages WHERE topic_id = ?', (topic_id,))
+                conn.execute('UPDATE topics SET archive_path = ? WHERE id = ?', (path, topic_id))
+
+    def prune_decision_logs(self, before: float) -> int:
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM decision_logs WHERE timestamp < ?', (before,)).rowcount
+
+    def prune_llm_calls(self, before: float) -> int:
+        with self._transaction() as conn:
+            return conn.execute('DELETE FROM llm_calls WHERE started_at < ?', (before,)).rowcount
+
+    def incremental_vacuum(self, pages: int) -> int:
+        """
+        Return up to `pages` free pages to the filesystem. Returns the free pages left.
+        """
+        conn = self._conn()
+        # executescript steps the pragma to completion; execute() would free
+        # a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    def has_incremental_vacuum(self) -> bool:
+        return self._conn().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    def ensure_incremental_vacuum(self) -> bool:
+        """
+        Switch an existing database to auto_vacuum=INCREMENTAL (full VACUUM, once).
+        Returns True if a conversion was performed. Rewrites the whole file:
+        run it offline (python -m services.retention), not on the bot's
+        database thread.
+        """
+        conn = self._conn()
+        if self.has_incremental_vacuum():
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    def get_active_topics(self, since: float, window: int) -> List[Dict]:
+        """
+        Bulk warm start: for every group, its latest open topic with a message
+        at or after `since`, with only the trailing `window` messages.
+        Two queries in total, whatever the number of groups.
+        """
+        conn = self._conn()
+        topics = conn.execute('''
+            WITH recent AS (
+                SELECT topic_id, MAX(timestamp) AS last_ts
+                FROM messages
+                WHERE timestamp >= ?
+                GROUP BY topic_id
+            ), ranked AS (
+                SELECT t.id, t.group_id, t.start_time, t.summary, r.last_ts,
+                       ROW_NUMBER() OVER (PARTITION BY t.group_id ORDER BY t.start_time DESC) AS rn
+                FROM topics t
+                JOIN recent r ON r.topic_id = t.id
+                WHERE t.end_time IS NULL
+            )
+            SELECT id, group_id, start_time, summary, last_ts FROM ranked WHERE rn = 1
+        ''', (since,)).fetchall()
+        if not topics:
+            return []
+
+        placeholders = ",".join("?" * len(topics))
+        by_topic: Dict[int, List[Dict]] = {t[0]: [] for t in topics}
+        for r in conn.execute(f'''
+            SELECT topic_id, user_id, nickname, content, timestamp FROM (
+                SELECT topic_id, user_id, nickname, content, timestamp,
+                       ROW_NUMBER() OVER (PARTITION BY topic_id ORDER BY timestamp DESC) AS rn
+                FROM messages
+                WHERE topic_id IN ({placeholders})
+            )
+            WHERE rn <= ?
+            ORDER BY topic_id, timestamp ASC
+        ''', [t[0] for t in topics] + [window]):
+            by_topic[r[0]].append({"user_id": r[1], "nickname": r[2], "content": r[3], "timestamp": r[4]})
+
+        return [
+            {
+                "group_id": group_id,
+                "topic_id": topic_id,
+                "start_time": start_time,
+                "last_msg_time": last_ts,
+                "messages": by_topic[topic_id],
+                "summary": summary
+            }
+            for topic_id, group_id, start_time, summary, last_ts in topics
+        ]
+
+    def get_latest_active_topic(self, group_id: str, window: int = 50) -> Optional[Dict]:
+        conn = self._conn()
         # Find the latest topic that hasn't been "closed" (end_time is NULL or 0)
         # Or just the latest one, and we let logic decide if it's stale
-        cursor.execute('''
+        row = conn.execute('''
             SELECT id, start_time, end_time, summary 
             FROM topics 
             WHERE group_id = ? 
             ORDER BY start_time DESC 
             LIMIT 1
-        ''', (group_id,))
-        row = cursor.fetchone()
+        ''', (group_id,)).fetchone()
         
         if not row:
-            conn.close()
             return None
             
         topic_id, start_time, end_time, summary = row
         
-        # Get messages for this topic
-        cursor.execute('''
-            SELECT user_id, nickname, content, timestamp 
-            FROM messages 
-            WHERE topic_id = ? 
-            ORDER BY timestamp ASC
-        ''', (topic_id,))
+        # Get the trailing window of messages for this topic (the only part
+        # the context builder ever reads)
         messages = [
             {"user_id": r[0], "nickname": r[1], "content": r[2], "timestamp": r[3]}
-            for r in cursor.fetchall()
+            for r in conn.execute('''
+                SELECT user_id, nickname, content, timestamp 
+                FROM messages 
+                WHERE topic_id = ? 
+                ORDER BY timestamp DESC
+                LIMIT ?
+            ''', (topic_id, window))
         ]
-        conn.close()
+        messages.reverse()
         
         return {
             "topic_id": topic_id,
@@ -305,5 +625,245 @@ class Storage:
             "messages": messages,
             "summary": summary
         }
+
+
+class AsyncStorage:
+    """
+    Non-blocking facade over Storage for use from the event loop.
+
+    Every database call runs on a single dedicated thread, so the event loop
+    never waits on disk I/O. Writes are queued and committed in batched
+    transactions every `write_flush_interval_ms`, or as soon as
+    `write_batch_size` writes are pending. Reads see the writes queued before
+    them: a read that a queued write would change flushes the queue first
+    (get_topic_messages merges queued messages instead, as the active topic
+    is read for every message).
+    """
+
+    def __init__(self, storage: Storage):
+        self._storage = storage
+        self.flush_interval = settings.get("storage", "write_flush_interval_ms", 100) / 1000
+        self.batch_size = settings.get("storage", "write_batch_size", 200)
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qjinera-db")
+        # [(method, args, kwargs)] waiting for the next batch
+        self._pending: List[Tuple[Callable, tuple, dict]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+        # Batch being committed on the database thread (never cancelled, see flush)
+        self._committing: Optional[asyncio.Future] = None
+        # Writes queued so far / handed to a finished commit, in queue order
+        self._queued_total = 0
+        self._done_total = 0
+
+        self.stats = {"queued": 0, "committed": 0, "batches": 0, "failed": 0}
+
+        # {storage method name: [callback(*args)]}, run on the loop after commit
+        self._listeners: Dict[str, List[Callable]] = {}
+
+        # Last line of defence if the loop dies without close() being awaited
+        atexit.register(self._flush_sync)
+
+    # Lifecycle
+    def start(self):
+        """
+        Start the background flusher. Called lazily on the first queued write.
+        """
+        if self._closed:
+            # Restarted after close() (e.g. AliceBot restart)
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="qjinera-db")
+            self._closed = False
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._run_flusher())
+
+    async def close(self):
+        """
+        Flush every queued write and release the database thread.
+        A commit in progress is waited for, not cancelled (flush shields it).
+        """
+        if self._flusher:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+        self._closed = True
+        self._executor.shutdown(wait=True)
+
+    async def _run_flusher(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"[Storage] Write-behind flush failed: {e}")
+
+    async def flush(self):
+        """
+        Commit everything queued so far (in one transaction, after the one
+        in progress, if any).
+
+        The batch is handed to the database thread at once and the commit is
+        shielded: cancelling a caller (superseded judge, shutdown of a
+        background task) stops the wait, never the write.
+        """
+        target = self._queued_total
+        while self._done_total < target:
+            if self._committing is None or self._committing.done():
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+                self._committing = self._commit(batch)
+            await asyncio.shield(self._committing)
+
+    def _commit(self, batch: List[Tuple[Callable, tuple, dict]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._apply_batch, batch)
+
+        def done(f: asyncio.Future):
+            self._done_total += len(batch)
+            if not f.cancelled() and f.exception() is None:
+                self._notify(batch)
+
+        future.add_done_callback(done)
+        return future
+
+    def add_listener(self, method: str, callback: Callable):
+        """
+        Call `callback(*args)` once a queued `method` write has been committed.
+        Used by in-memory caches that derive from those rows.
+        """
+        self._listeners.setdefault(method, []).append(callback)
+
+    def _notify(self, batch: List[Tuple[Callable, tuple, dict]]):
+        for func, args, kwargs in batch:
+            for callback in self._listeners.get(func.__name__, ()):
+                try:
+                    callback(*args, **kwargs)
+                except Exception as e:
+                    print(f"[Storage] Listener for {func.__name__} failed: {e}")
+
+    def _apply_batch(self, batch: List[Tuple[Callable, tuple, dict]]):
+        with self._storage.batch():
+            for func, args, kwargs in batch:
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"[Storage] Queued {func.__name__} failed: {e}")
+        self.stats["committed"] += len(batch)
+        self.stats["batches"] += 1
+
+    def _flush_sync(self):
+        if self._pending and not self._closed:
+            batch, self._pending = self._pending, []
+            self._apply_batch(batch)
+
+    async def call(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run a synchronous Storage call on the database thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def _enqueue(self, func: Callable, *args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (scripts, tests): write straight through
+            func(*args, **kwargs)
+            self._notify([(func, args, kwargs)])
+            return
+        self._pending.append((func, args, kwargs))
+        self._queued_total += 1
+        self.stats["queued"] += 1
+        self.start()
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    @property
+    def pending_writes(self) -> int:
+        return len(self._pending)
+
+    # Queued writes (return immediately)
+    def add_message(self, topic_id: int, user_id: str, content: str, timestamp: float, nickname: str = ""):
+        self._enqueue(self._storage.add_message, topic_id, user_id, content, timestamp, nickname)
+
+    def update_user(self, group_id: str, user_id: str, nickname: str, timestamp: float):
+        self._enqueue(self._storage.update_user, group_id, user_id, nickname, timestamp)
+
+    def update_user_description(self, group_id: str, user_id: str, description: str):
+        self._enqueue(self._storage.update_user_description, group_id, user_id, description)
+
+    def update_topic_summary(self, topic_id: int, summary: str, end_time: float = None):
+        self._enqueue(self._storage.update_topic_summary, topic_id, summary, end_time)
+
+    def add_decision_log(self, group_id: str, judge_model: str, result: Dict, context_summary: Optional[str]):
+        self._enqueue(self._storage.add_decision_log, group_id, judge_model, result, context_summary, time.time())
+
+    def add_llm_call(self, started_at: float, model: str, kind: str, group_id: str, queue_ms: int, latency_ms: int,
+                     prompt_tokens: int, completion_tokens: int, outcome: str, retries: int = 0, path: str = "primary",
+                     cached_tokens: int = 0):
+        self._enqueue(self._storage.add_llm_call, started_at, model, kind, group_id, queue_ms, latency_ms,
+                      prompt_tokens, completion_tokens, outcome, retries, path, cached_tokens)
+
+    def add_memory(self, user_id: str, group_id: str, content: str):
+        self._enqueue(self._storage.add_memory, user_id, group_id, content, time.time())
+
+    # Calls that need a result
+    async def create_topic(self, group_id: str, start_time: float) -> int:
+        return await self.call(self._storage.create_topic, group_id, start_time)
+
+    async def get_user(self, group_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+        await self._flush_for((self._storage.update_user, self._storage.update_user_description), group_id, user_id)
+        return await self.call(self._storage.get_user, group_id, user_id)
+
+    async def get_memories(self, user_id: str, limit: int = 20) -> List[str]:
+        await self._flush_for((self._storage.add_memory,), user_id)
+        return await self.call(self._storage.get_memories, user_id, limit)
+
+    async def get_recent_topics(self, group_id: str, limit: int = 5) -> List[Dict]:
+        await self._flush_for((self._storage.update_topic_summary,))
+        return await self.call(self._storage.get_recent_topics, group_id, limit)
+
+    async def search_topics(self, group_id: str, text: str, limit: int = 5, exclude_topic_id: Optional[int] = None) -> List[Dict]:
+        await self._flush_for((self._storage.update_topic_summary,))
+        return await self.call(self._storage.search_topics, group_id, text, limit, exclude_topic_id)
+
+    async def _flush_for(self, funcs: Tuple[Callable, ...], *key):
+        """
+        Flush first if a write of `funcs` whose leading arguments are `key` is queued.
+        """
+        if any(func in funcs and args[:len(key)] == key for func, args, _ in self._pending):
+            await self.flush()
+
+    async def get_topic_messages(self, topic_id: int, limit: int = 50) -> List[Dict]:
+        # Queued messages of this topic are not in the database yet; merge them in
+        queued = [
+            {"user_id": args[1], "nickname": args[4], "content": args[2], "timestamp": args[3]}
+            for func, args, _ in self._pending
+            if func == self._storage.add_message and args[0] == topic_id
+        ]
+        messages = await self.call(self._storage.get_topic_messages, topic_id, limit)
+        if queued:
+            messages = sorted(messages + queued, key=lambda m: m["timestamp"])[:limit]
+        return messages
+
+    async def get_latest_active_topic(self, group_id: str, window: int = 50) -> Optional[Dict]:
+        await self.flush()
+        return await self.call(self._storage.get_latest_active_topic, group_id, window)
+
+    async def get_active_topics(self, since: float, window: int) -> List[Dict]:
+        await self.flush()
+        return await self.call(self._storage.get_active_topics, since, window)
+
         
 storage = Storage()
+async_storage = AsyncStorage(storage)
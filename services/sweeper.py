@@ -0,0 +1,129 @@
+import asyncio
+import time
+from typing import Dict, List, Tuple
+from config import settings
+from services.cache import context_cache
+from services.llm import LLMService, llm_service
+from services.storage import Storage, storage, async_storage
+from services.tokens import estimate_tokens
+
+
+class TopicSweeper:
+    """
+    Closes expired topics and writes summaries for the ones nobody summarized.
+
+    Topics used to be closed only when the group's next message arrived, and
+    summarized only when the bot itself spoke, so quiet topics stayed open and
+    topics the bot never joined had no summary (invisible to past_topics).
+    This runs in the background across all groups:
+    - open topics whose last message is older than topic_gap are closed;
+    - closed topics without a summary are sent to the small model
+      `batch_size` at a time, at most `max_concurrency` calls in flight and
+      `max_topics_per_pass` topics per pass.
+    Topics shorter than `min_messages` are not worth a call and are skipped
+    for good; failed topics are retried up to `max_attempts` passes.
+    """
+
+    def __init__(self, storage: Storage, llm: LLMService):
+        self._storage = storage
+        self.llm = llm
+        self.topic_gap = settings.get("topic", "topic_gap_minutes", 10) * 60
+        self.interval = settings.get("sweeper", "interval_seconds", 120)
+        self.batch_size = settings.get("sweeper", "batch_size", 8)
+        self.max_concurrency = settings.get("sweeper", "max_concurrency", 2)
+        self.max_topics_per_pass = settings.get("sweeper", "max_topics_per_pass", 64)
+        self.min_messages = settings.get("sweeper", "min_messages", 3)
+        self.max_attempts = settings.get("sweeper", "max_attempts", 3)
+        self.max_tokens_per_topic = settings.get("sweeper", "max_tokens_per_topic", 800)
+        self.stats = {"closed": 0, "summarized": 0, "skipped": 0, "failed_batches": 0}
+
+    def transcript(self, messages: List[Dict]) -> List[str]:
+        """
+        "nickname: content" lines, trimmed from the front to max_tokens_per_topic.
+        """
+        lines = []
+        used = 0
+        for m in reversed(messages):
+            line = f"{m['nickname'] or m['user_id']}: {m['content']}"
+            used += estimate_tokens(line)
+            if used > self.max_tokens_per_topic and lines:
+                break
+            lines.append(line)
+        lines.reverse()
+        return lines
+
+    def collect(self, now: float = None) -> Tuple[int, List[Dict]]:
+        """
+        Close expired topics and load the next topics to summarize.
+        Synchronous: run it on the database thread.
+        Returns (topics closed, [{"id", "group_id", "messages": [lines]}]).
+        """
+        now = now or time.time()
+        closed = self._storage.close_expired_topics(now - self.topic_gap, self.max_topics_per_pass * 4)
+
+        pending = []
+        attempts = []
+        for topic in self._storage.get_unsummarized_topics(self.max_topics_per_pass, self.max_attempts):
+            messages = self._storage.get_topic_message_rows(topic["id"])
+            if len(messages) < self.min_messages:
+                attempts.append((topic["id"], self.max_attempts))
+                self.stats["skipped"] += 1
+                continue
+            # Counted up front: a topic that keeps failing is eventually dropped
+            attempts.append((topic["id"], 1))
+            pending.append({"id": topic["id"], "group_id": topic["group_id"], "messages": self.transcript(messages)})
+        if attempts:
+            self._storage.add_summary_attempts(attempts)
+
+        self.stats["closed"] += closed
+        return closed, pending
+
+    async def summarize(self, topics: List[Dict]) -> Dict[int, str]:
+        """
+        Summaries for `topics`, batch_size topics per call, max_concurrency calls at a time.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def run_batch(batch: List[Dict]) -> Dict[int, str]:
+            async with semaphore:
+                try:
+                    return await self.llm.summarize_topics([{"id": t["id"], "messages": t["messages"]} for t in batch])
+                except Exception as e:
+                    self.stats["failed_batches"] += 1
+                    print(f"[Sweeper] Summary batch failed: {e}")
+                    return {}
+
+        batches = [topics[i:i + self.batch_size] for i in range(0, len(topics), self.batch_size)]
+        summaries: Dict[int, str] = {}
+        for result in await asyncio.gather(*(run_batch(b) for b in batches)):
+            summaries.update(result)
+        return summaries
+
+    async def run_once(self, now: float = None) -> Dict[str, int]:
+        await async_storage.flush()
+        closed, topics = await async_storage.call(self.collect, now)
+        summaries = await self.summarize(topics) if topics else {}
+        for topic in topics:
+            summary = summaries.get(topic["id"])
+            if summary:
+                context_cache.note_topic(topic["id"], topic["group_id"])
+                async_storage.update_topic_summary(topic["id"], summary)
+        self.stats["summarized"] += len(summaries)
+        return {"closed": closed, "summarized": len(summaries), "pending": len(topics)}
+
+    async def run_forever(self):
+        while True:
+            try:
+                result = await self.run_once()
+                if result["closed"] or result["pending"]:
+                    print(f"[Sweeper] {result}")
+                # Work through a backlog without waiting a full interval
+                if result["pending"] >= self.max_topics_per_pass:
+                    await asyncio.sleep(5)
+                    continue
+            except Exception as e:
+                print(f"[Sweeper] Pass failed: {e}")
+            await asyncio.sleep(self.interval)
+
+
+topic_sweeper = TopicSweeper(storage, llm_service)
@@ -0,0 +1,93 @@
+import time
+from typing import Dict, Optional
+from config import settings
+from services.storage import async_storage
+
+
+class LLMCall:
+    """
+    One LLM request being timed. `queue_ms` is the wait for a scheduler slot,
+    `latency_ms` the request itself (including retries). `model` ends up as
+    the model that answered and `path` as how it was reached: primary,
+    hedge (second request sent after the p95) or fallback (next model).
+    `cached_tokens` is the part of the prompt the provider served from its
+    prompt cache (when it reports it).
+    """
+    __slots__ = ("model", "kind", "group_id", "started_at", "prompt_tokens", "completion_tokens",
+                 "cached_tokens", "retries", "path", "_start", "_sent")
+
+    def __init__(self, model: str, kind: str, group_id: str, prompt_tokens: int):
+        self.model = model
+        self.kind = kind
+        self.group_id = group_id
+        self.started_at = time.time()
+        # Estimates until the response reports its usage
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.retries = 0
+        self.path = "primary"
+        self._start = time.monotonic()
+        self._sent: Optional[float] = None
+
+    def sent(self):
+        """
+        Mark the end of queueing (the request is about to go out).
+        """
+        if self._sent is None:
+            self._sent = time.monotonic()
+
+    def usage(self, usage):
+        """
+        Take token counts from an OpenAI `usage` object, if there is one.
+        """
+        if usage is not None:
+            self.prompt_tokens = usage.prompt_tokens or self.prompt_tokens
+            self.completion_tokens = usage.completion_tokens or 0
+            details = getattr(usage, "prompt_tokens_details", None)
+            self.cached_tokens = getattr(details, "cached_tokens", None) or 0
+
+
+class LLMTelemetry:
+    """
+    Records every LLM call (model, kind, group, queue wait, latency, tokens,
+    outcome, retries, serving path) into llm_calls through the write-behind
+    queue, so the hot path never waits on the database.
+
+    Outcomes: ok, parse_error, error, timeout, shed (dropped by the
+    scheduler), cancelled, partial (stream broke after some messages were sent).
+    """
+
+    def __init__(self):
+        self.enabled = settings.get("telemetry", "enabled", True)
+        self.stats: Dict[str, int] = {}
+        self.tokens = {"prompt": 0, "cached": 0}
+
+    def cache_hit_rate(self) -> float:
+        """
+        Share of prompt tokens served from the provider's prompt cache.
+        """
+        return self.tokens["cached"] / self.tokens["prompt"] if self.tokens["prompt"] else 0.0
+
+    def start(self, model: str, kind: str, group_id: str = "", prompt_tokens: int = 0) -> LLMCall:
+        return LLMCall(model, kind, group_id or "", prompt_tokens)
+
+    def finish(self, call: LLMCall, outcome: str):
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+        self.tokens["prompt"] += call.prompt_tokens
+        self.tokens["cached"] += call.cached_tokens
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        sent = call._sent if call._sent is not None else now
+        try:
+            async_storage.add_llm_call(
+                call.started_at, call.model, call.kind, call.group_id,
+                int((sent - call._start) * 1000), int((now - sent) * 1000),
+                call.prompt_tokens, call.completion_tokens, outcome, call.retries, call.path, call.cached_tokens
+            )
+        except Exception as e:
+            print(f"[Telemetry] Failed to record call: {e}")
+
+
+telemetry = LLMTelemetry()
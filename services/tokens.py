@@ -0,0 +1,28 @@
+import re
+
+# Rough, local token estimate for prompt budgeting. CJK characters cost about
+# one token each in current OpenAI/Gemini tokenizers; other text about one
+# token per four characters.
+_CJK_CHAR = re.compile(r"[　-〿぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK_CHAR.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_tokens(text: str, max_tokens: int, marker: str = "…") -> str:
+    """
+    `text` cut to about `max_tokens` (same estimate as above), with `marker`
+    appended when something was cut.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 1.0 if _CJK_CHAR.match(ch) else 0.25
+        if used > max_tokens:
+            return text[:i] + marker
+    return text
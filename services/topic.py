@@ -1,166 +1,385 @@
+import asyncio
+import sys
 import time
-from typing import List, Dict, Optional
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
 from config import settings
-from services.storage import storage
+from services.cache import context_cache
+from services.context_budget import context_budget
+from services.retrieval import retrieval
+from services.storage import async_storage
+from services.tokens import estimate_tokens
+
+
+class MessageRecord(NamedTuple):
+    user_id: str
+    nickname: str
+    content: str
+    timestamp: float
+    # When this user last spoke before this message (None: first time in topic)
+    user_prev_ts: Optional[float]
+    # "nickname: content", rendered once at append time
+    line: str
+
+
+class MessageRing:
+    """
+    Bounded window of a topic's most recent messages.
+
+    Old messages fall off the front once `capacity` is reached (they are in
+    the database already). A per-user last-seen index keeps
+    time_since_last_user_message O(1), and each record carries its rendered
+    context line so building recent_messages is a slice, not a re-render.
+    """
+
+    __slots__ = ("_records", "_last_seen", "_bytes")
+
+    def __init__(self, capacity: int, messages: Iterable[Dict] = ()):
+        self._records: deque = deque(maxlen=capacity)
+        self._last_seen: Dict[str, float] = {}
+        # Running size of the records held, kept up to date on append
+        self._bytes = 0
+        for m in messages:
+            self.append(m["user_id"], m.get("nickname") or "", m["content"], m["timestamp"])
+
+    def append(self, user_id: str, nickname: str, content: str, timestamp: float) -> MessageRecord:
+        # Use nickname if available, otherwise fallback to user_id
+        record = MessageRecord(
+            user_id, nickname, content, timestamp,
+            self._last_seen.get(user_id),
+            f"{nickname or user_id}: {content}"
+        )
+        if len(self._records) == self._records.maxlen:
+            self._bytes -= self._record_size(self._records[0])
+        self._records.append(record)
+        self._bytes += self._record_size(record)
+        self._last_seen[user_id] = timestamp
+        return record
+
+    @staticmethod
+    def _record_size(record: MessageRecord) -> int:
+        return sys.getsizeof(record) + sys.getsizeof(record.content) + sys.getsizeof(record.line)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[MessageRecord]:
+        return iter(self._records)
+
+    def __getitem__(self, index: int) -> MessageRecord:
+        return self._records[index]
+
+    def tail(self, n: int) -> List[MessageRecord]:
+        """
+        The last n records, oldest first, without copying the whole ring.
+        """
+        n = min(n, len(self._records))
+        tail = list(islice(reversed(self._records), n))
+        tail.reverse()
+        return tail
+
+    def lines(self, n: int) -> List[str]:
+        return [r.line for r in self.tail(n)]
+
+    def last_seen(self, user_id: str) -> Optional[float]:
+        return self._last_seen.get(user_id)
+
+    def user_contents(self, user_id: str) -> List[str]:
+        return [r.content for r in self._records if r.user_id == user_id]
+
+    def user_records_since(self, user_id: str, since: float) -> List[MessageRecord]:
+        return [r for r in self._records if r.user_id == user_id and r.timestamp > since]
+
+    def approx_bytes(self) -> int:
+        """
+        Rough resident size of the ring (records, their strings, the index). O(1).
+        """
+        return self._bytes + sys.getsizeof(self._records) + sys.getsizeof(self._last_seen)
+
 
 class TopicManager:
     def __init__(self):
         self.topic_gap = settings.get("topic", "topic_gap_minutes", 10) * 60
         self.continue_gap = settings.get("topic", "continue_gap_seconds", 20)
+        self.past_topics_token_budget = settings.get("topic", "past_topics_token_budget", 400)
+        # Contexts are built to the writer's budget; the judge trims further if its own is smaller
+        self.context_model = settings.get("llm", "chat_model", "gpt-4")
+        # Trailing messages restored per topic after a restart
+        self.restore_window = settings.get("topic", "restore_window", 50)
+        # Messages kept in memory per active topic
+        self.max_messages = max(settings.get("topic", "max_messages_in_memory", 200), self.restore_window)
         
         # In-memory cache for current topic per group
-        # {group_id: {"topic_id": int, "last_msg_time": float, "messages": []}}
+        # {group_id: {"topic_id": int, "last_msg_time": float, "messages": MessageRing}}
         self.active_topics: Dict[str, Dict] = {}
         
         # Track last activity time for all groups to support active speaking
         # {group_id: float_timestamp}
         self.group_last_activity: Dict[str, float] = {}
+
+        # Serializes topic restore/creation per group across awaits
+        self._group_locks: Dict[str, asyncio.Lock] = {}
+
+        # Eviction of cold groups (see evict()). Evicted groups are restored
+        # from the database on their next message.
+        self.idle_evict_seconds = settings.get("topic", "idle_evict_minutes", 30) * 60
+        self.max_resident_groups = settings.get("topic", "max_resident_groups", 500)
+        self.memory_budget_bytes = settings.get("topic", "memory_budget_mb", 64) * 1024 * 1024
+        self.eviction_interval = settings.get("topic", "eviction_interval_seconds", 60)
+        self.stats = {"archived": 0, "evicted_idle": 0, "evicted_budget": 0, "restored": 0}
         
-        # Restore active topics from DB
-        self._restore_active_topics()
-
-    def _restore_active_topics(self):
-        # This is a bit tricky since we don't know all group_ids.
-        # But we can just load lazily or query distinct group_ids from topics.
-        # For now, let's just rely on lazy loading or simple check when handle_message is called?
-        # Actually, handle_message checks self.active_topics. If empty, it starts new.
-        # We should try to load from DB if memory is empty.
-        pass
-
-    def get_current_topic(self, group_id: str) -> Dict:
+        # Active topics are restored from DB in bulk by warm_start() at bot
+        # startup; groups it missed are still restored lazily on first message
+
+    async def warm_start(self) -> int:
+        """
+        Restore every still-fresh topic (last message within topic_gap) in a
+        single pass, with only the trailing restore_window messages each.
+        """
+        start = time.perf_counter()
+        topics = await async_storage.get_active_topics(time.time() - self.topic_gap, self.restore_window)
+        restored = 0
+        for topic in topics:
+            group_id = topic.pop("group_id")
+            if group_id in self.active_topics:
+                continue
+            topic["messages"] = MessageRing(self.max_messages, topic["messages"])
+            self.active_topics[group_id] = topic
+            self.group_last_activity[group_id] = max(
+                self.group_last_activity.get(group_id, 0), topic["last_msg_time"]
+            )
+            restored += 1
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"[TopicManager] Warm start: restored {restored} active topics in {elapsed:.1f} ms")
+        return restored
+
+    def _lock(self, group_id: str) -> asyncio.Lock:
+        lock = self._group_locks.get(group_id)
+        if lock is None:
+            lock = self._group_locks[group_id] = asyncio.Lock()
+        return lock
+
+    async def get_current_topic(self, group_id: str) -> Dict:
         if group_id not in self.active_topics:
-            self._try_restore_topic(group_id)
+            async with self._lock(group_id):
+                if group_id not in self.active_topics:
+                    await self._try_restore_topic(group_id)
         return self.active_topics.get(group_id)
 
-    def _try_restore_topic(self, group_id: str):
+    async def _try_restore_topic(self, group_id: str):
         # Try to load the latest topic from DB
-        topic = storage.get_latest_active_topic(group_id)
+        topic = await async_storage.get_latest_active_topic(group_id, self.restore_window)
         if topic:
             # Check if it's stale
             now = time.time()
             if now - topic["last_msg_time"] <= self.topic_gap:
+                topic["messages"] = MessageRing(self.max_messages, topic["messages"])
                 self.active_topics[group_id] = topic
                 self.group_last_activity[group_id] = topic["last_msg_time"]
+                self.stats["restored"] += 1
                 print(f"[TopicManager] Restored active topic for group {group_id}")
 
-    def get_latest_context(self, group_id: str) -> Optional[Dict]:
-        if group_id not in self.active_topics:
-            self._try_restore_topic(group_id)
-            
-        topic = self.active_topics.get(group_id)
+    async def get_latest_context(self, group_id: str) -> Optional[Dict]:
+        topic = await self.get_current_topic(group_id)
         if not topic or not topic["messages"]:
             return None
             
         last_msg = topic["messages"][-1]
-        return self._build_context(
+        return await self._build_context(
             group_id, 
-            last_msg["user_id"], 
-            last_msg["content"], 
-            last_msg["timestamp"]
+            last_msg.user_id, 
+            last_msg.content, 
+            last_msg.timestamp
         )
 
-    def handle_message(self, group_id: str, user_id: str, content: str, nickname: str = "") -> Dict:
+    async def handle_message(self, group_id: str, user_id: str, content: str, nickname: str = "",
+                             build_context: bool = True) -> Optional[Dict]:
         """
         Process a new message and determine if it belongs to the current topic or starts a new one.
-        Returns the context for the LLM.
+        Returns the context for the LLM (None with build_context=False).
         """
         now = time.time()
         
-        # Update user info
-        storage.update_user(group_id, user_id, nickname, now)
+        # Update user info (queued, committed by the write-behind flusher)
+        async_storage.update_user(group_id, user_id, nickname, now)
         
-        if group_id not in self.active_topics:
-            self._try_restore_topic(group_id)
+        async with self._lock(group_id):
+            if group_id not in self.active_topics:
+                await self._try_restore_topic(group_id)
+                
+            current_topic = self.active_topics.get(group_id)
             
-        current_topic = self.active_topics.get(group_id)
-        
-        is_new_topic = False
-        
-        if not current_topic:
-            is_new_topic = True
-        else:
-            last_time = current_topic["last_msg_time"]
-            if now - last_time > self.topic_gap:
-                # Topic expired, archive it
-                self._archive_topic(group_id)
+            is_new_topic = False
+            
+            if not current_topic:
                 is_new_topic = True
+            else:
+                last_time = current_topic["last_msg_time"]
+                if now - last_time > self.topic_gap:
+                    # Topic expired, archive it
+                    self._archive_topic(group_id)
+                    is_new_topic = True
+            
+            if is_new_topic:
+                topic_id = await async_storage.create_topic(group_id, now)
+                current_topic = {
+                    "topic_id": topic_id,
+                    "last_msg_time": now,
+                    "messages": MessageRing(self.max_messages),
+                    "summary": None
+                }
+                self.active_topics[group_id] = current_topic
+            
+            # Update current topic
+            current_topic["last_msg_time"] = now
+            current_topic["messages"].append(user_id, nickname, content, now)
+            
+            # Save message to DB
+            async_storage.add_message(current_topic["topic_id"], user_id, content, now, nickname)
+            
+            self.group_last_activity[group_id] = now
         
-        if is_new_topic:
-            topic_id = storage.create_topic(group_id, now)
-            current_topic = {
-                "topic_id": topic_id,
-                "last_msg_time": now,
-                "messages": [],
-                "summary": None
-            }
-            self.active_topics[group_id] = current_topic
-        
-        # Update current topic
-        current_topic["last_msg_time"] = now
-        current_topic["messages"].append({
-            "user_id": user_id,
-            "nickname": nickname,
-            "content": content,
-            "timestamp": now
-        })
-        
-        # Save message to DB
-        storage.add_message(current_topic["topic_id"], user_id, content, now, nickname)
-        
-        self.group_last_activity[group_id] = now
-        
-        return self._build_context(group_id, user_id, content, now)
+        if not build_context:
+            return None
+        return await self._build_context(group_id, user_id, content, now)
 
-    def add_bot_message(self, group_id: str, content: str, bot_id: str, nickname: str = "QJinEra"):
+    async def add_bot_message(self, group_id: str, content: str, bot_id: str, nickname: str = "QJinEra"):
         """
         Record a message sent by the bot itself.
         """
         now = time.time()
-        current_topic = self.active_topics.get(group_id)
         
         # If no active topic (rare, but possible if bot initiates), create one
-        if not current_topic:
+        async with self._lock(group_id):
             if group_id not in self.active_topics:
-                self._try_restore_topic(group_id)
+                await self._try_restore_topic(group_id)
             current_topic = self.active_topics.get(group_id)
             
             if not current_topic:
-                topic_id = storage.create_topic(group_id, now)
+                topic_id = await async_storage.create_topic(group_id, now)
                 current_topic = {
                     "topic_id": topic_id,
                     "last_msg_time": now,
-                    "messages": [],
+                    "messages": MessageRing(self.max_messages),
                     "summary": None
                 }
                 self.active_topics[group_id] = current_topic
             
         # Update current topic
         current_topic["last_msg_time"] = now
-        current_topic["messages"].append({
-            "user_id": bot_id,
-            "nickname": nickname,
-            "content": content,
-            "timestamp": now
-        })
+        current_topic["messages"].append(bot_id, nickname, content, now)
         
         # Save message to DB
-        storage.add_message(current_topic["topic_id"], bot_id, content, now, nickname)
+        async_storage.add_message(current_topic["topic_id"], bot_id, content, now, nickname)
         self.group_last_activity[group_id] = now
 
     def _archive_topic(self, group_id: str):
         topic = self.active_topics.get(group_id)
         if topic:
-            storage.update_topic_summary(topic["topic_id"], topic.get("summary"), topic["last_msg_time"])
-            del self.active_topics[group_id]
+            context_cache.note_topic(topic["topic_id"], group_id)
+            async_storage.update_topic_summary(topic["topic_id"], topic.get("summary"), topic["last_msg_time"])
+            self._drop(group_id)
+
+    def gauges(self) -> Dict[str, int]:
+        return {
+            "resident_groups": len(self.active_topics),
+            "resident_messages": sum(len(t["messages"]) for t in self.active_topics.values()),
+            "approx_bytes": sum(t["messages"].approx_bytes() for t in self.active_topics.values()),
+            "tracked_groups": len(self.group_last_activity),
+        }
+
+    def evict(self, now: Optional[float] = None) -> Dict[str, int]:
+        """
+        Drop cold groups from memory:
+        - topics idle longer than topic_gap are closed (end time + summary
+          written) exactly as the next message would have done;
+        - groups idle longer than idle_evict_minutes are dropped, their topic
+          stays open in the database;
+        - then the least recently active groups are dropped until at most
+          max_resident_groups remain and their messages fit memory_budget_mb.
+        Groups with a restore/creation in flight are skipped.
+        group_last_activity is kept (one float per group) because the
+        proactive-chat scheduler relies on it for quiet groups.
+        """
+        now = now or time.time()
+        result = {"archived": 0, "evicted_idle": 0, "evicted_budget": 0}
+
+        by_age = sorted(self.active_topics.items(), key=lambda kv: kv[1]["last_msg_time"])
+        resident = []
+        for group_id, topic in by_age:
+            if self._lock(group_id).locked():
+                resident.append((group_id, topic))
+                continue
+            idle = now - topic["last_msg_time"]
+            if idle > self.topic_gap:
+                self._archive_topic(group_id)
+                result["archived"] += 1
+            elif idle > self.idle_evict_seconds:
+                self._drop(group_id)
+                result["evicted_idle"] += 1
+            else:
+                resident.append((group_id, topic))
+
+        total = sum(t["messages"].approx_bytes() for _, t in resident)
+        for group_id, topic in resident:
+            if len(self.active_topics) <= self.max_resident_groups and total <= self.memory_budget_bytes:
+                break
+            if self._lock(group_id).locked():
+                continue
+            total -= topic["messages"].approx_bytes()
+            self._drop(group_id)
+            result["evicted_budget"] += 1
+
+        for key, value in result.items():
+            self.stats[key] += value
+        return result
+
+    def _drop(self, group_id: str):
+        self.active_topics.pop(group_id, None)
+        lock = self._group_locks.get(group_id)
+        if lock is not None and not lock.locked():
+            del self._group_locks[group_id]
+
+    async def evict_forever(self):
+        while True:
+            await asyncio.sleep(self.eviction_interval)
+            try:
+                result = self.evict()
+                if any(result.values()):
+                    print(f"[TopicManager] Eviction: {result}, now {self.gauges()}")
+            except Exception as e:
+                print(f"[TopicManager] Eviction failed: {e}")
 
     def update_summary(self, group_id: str, summary: str):
         if group_id in self.active_topics:
             topic = self.active_topics[group_id]
             topic["summary"] = summary
             # [新增] 立即持久化到数据库
-            storage.update_topic_summary(topic["topic_id"], summary)
+            context_cache.note_topic(topic["topic_id"], group_id)
+            async_storage.update_topic_summary(topic["topic_id"], summary)
+
+    def _select_past_topics(self, current_topic_id: int, relevant: List[Dict], recent: List[Dict]) -> str:
+        """
+        Past topic summaries, best full-text matches first, then the most recent
+        ones, until past_topics_token_budget is used up.
+        """
+        lines = []
+        used = 0
+        seen = {current_topic_id}
+        for t in relevant + recent:
+            if t["id"] in seen or not t["summary"]:
+                continue
+            seen.add(t["id"])
+            line = f"- {t['summary']}"
+            cost = estimate_tokens(line)
+            if used + cost > self.past_topics_token_budget:
+                break
+            lines.append(line)
+            used += cost
+        return "\n".join(lines)
 
-    def _build_context(self, group_id: str, user_id: str, content: str, now: float) -> Dict:
+    async def _build_context(self, group_id: str, user_id: str, content: str, now: float) -> Dict:
         topic = self.active_topics.get(group_id)
         messages = topic["messages"]
         
@@ -169,38 +388,47 @@ class TopicManager:
         time_since_last_user = 9999.0
         
         if len(messages) > 1:
-            time_since_last_group = now - messages[-2]["timestamp"]
+            time_since_last_group = now - messages[-2].timestamp
             
-            # Find last message from same user
-            for msg in reversed(messages[:-1]):
-                if msg["user_id"] == user_id:
-                    time_since_last_user = now - msg["timestamp"]
-                    break
+            # Previous message from the same user, from the last-seen index
+            last = messages[-1]
+            prev = last.user_prev_ts if last.user_id == user_id else messages.last_seen(user_id)
+            if prev is not None:
+                time_since_last_user = now - prev
         
-        # Get recent messages (last 10)
-        # Use nickname if available, otherwise fallback to user_id
-        recent_msgs = []
-        for m in messages[-10:]:
-            sender_name = m.get("nickname") or m["user_id"]
-            recent_msgs.append(f"{sender_name}: {m['content']}")
+        # Get recent messages (last 10), pre-rendered as "nickname: content"
+        recent_msgs = messages.lines(10)
             
-        # Get Long-term memory (recent topics)
-        past_topics = storage.get_recent_topics(group_id, limit=5)
-        past_topics_summary = "\n".join([f"- {t['summary']}" for t in past_topics if t['summary']])
+        # Long-term memory (relevant + recent topics), user profile and memories
+        # come from the topic index, context_cache and the retrieval index (in memory once warm;
+        # misses are fetched together off the event loop). Past topics and
+        # memories are ranked by relevance to the latest message and the recent window.
+        query_text = "\n".join([content] + [m.content for m in messages.tail(5)[:-1]])
+        relevant_topics, past_topics, user_profile, memories = await asyncio.gather(
+            async_storage.search_topics(group_id, query_text, limit=5, exclude_topic_id=topic["topic_id"]),
+            context_cache.get_recent_topics(group_id, limit=5),
+            context_cache.get_user(group_id, user_id),
+            retrieval.search(
+                user_id,
+                [content, "\n".join(recent_msgs[-5:]), topic.get("summary") or ""],
+                weights=[0.6, 0.25, 0.15]
+            )
+        )
+        past_topics_summary = self._select_past_topics(topic["topic_id"], relevant_topics, past_topics)
         
         # Get User Profile
-        user_profile = storage.get_user(group_id, user_id)
         user_desc = ""
         if user_profile and user_profile.get("description"):
             user_desc = f"Current Speaker ({user_profile['nickname']}): {user_profile['description']}"
         
         # [新增] Get User Memories (Gemini Style)
-        memories = storage.get_memories(user_id, limit=20)
         memory_section = ""
         if memories:
-            memory_section = "User Memories:\n" + "\n".join([f"- {m}" for m in memories])
+            memory_section = "User Memories:\n" + "\n".join([f"- {' '.join(m.split())}" for m in memories])
 
-        return {
+        # Long messages are truncated and the lowest-ranked memories / topics
+        # dropped so that one wall of text cannot inflate every prompt
+        return context_budget.fit({
             "persona": settings.get("prompts", "persona"),
             "recent_messages": recent_msgs,
             "topic_summary": topic.get("summary"),
@@ -211,6 +439,6 @@ class TopicManager:
             "time_since_last_group_message": time_since_last_group,
             "time_since_last_user_message": time_since_last_user,
             "is_at_mentioned": False # This will be overridden by the plugin
-        }
+        }, self.context_model)
 
 topic_manager = TopicManager()
@@ -0,0 +1,73 @@
+import asyncio
+import os
+import services.cache as cache_module
+from services.cache import MISSING, ContextCache, LRUCache
+from services.storage import AsyncStorage, Storage
+
+
+def test_lru_cache_size_and_ttl():
+    now = [0.0]
+    cache = LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.put("a", 1)
+    cache.put("b", None)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    cache.put("c", 3)  # "b" is least recently used
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    now[0] = 11
+    assert cache.get("a") is MISSING
+    assert cache.stats == {"hits": 3, "misses": 2, "evictions": 1, "expired": 1}
+
+
+def test_context_cache_invalidated_by_writes(tmp_path, monkeypatch):
+    s = Storage(os.path.join(tmp_path, "test.db"))
+    aio = AsyncStorage(s)
+    monkeypatch.setattr(cache_module, "async_storage", aio)
+    cache = ContextCache()
+    aio.add_listener("update_topic_summary", cache.on_topic_summary)
+    aio.add_listener("update_user_description", cache.invalidate_user)
+    aio.add_listener("update_user", cache.on_user_activity)
+    topic_reads = []
+    get_recent_topics = aio.get_recent_topics
+
+    async def counted_get_recent_topics(*args):
+        topic_reads.append(args)
+        return await get_recent_topics(*args)
+
+    monkeypatch.setattr(aio, "get_recent_topics", counted_get_recent_topics)
+
+    async def scenario():
+        aio.start()
+        t1 = await aio.create_topic("g1", 1.0)
+        aio.update_user("g1", "u1", "Alice", 1.0)
+        await aio.flush()
+
+        assert await cache.get_recent_topics("g1") == []
+        profile = await cache.get_user("g1", "u1")
+        assert profile["description"] is None
+        # Served from memory from now on, though the group has fewer topics
+        # than asked for; a larger limit than the one fetched goes to storage
+        await cache.get_recent_topics("g1")
+        await cache.get_recent_topics("g1", limit=3)
+        await cache.get_user("g1", "u1")
+        assert len(topic_reads) == 1 and cache.profiles.stats["hits"] == 1
+        await cache.get_recent_topics("g1", limit=10)
+        assert topic_reads[-1] == ("g1", 10)
+
+        # Message activity is written through, not dropped
+        aio.update_user("g1", "u1", "Alice2", 2.0)
+        await aio.flush()
+        assert (await cache.get_user("g1", "u1"))["nickname"] == "Alice2"
+        assert cache.profiles.stats["misses"] == 1
+
+        aio.update_user_description("g1", "u1", "likes cats")
+        cache.note_topic(t1, "g1")
+        aio.update_topic_summary(t1, "cats")
+        await aio.flush()
+        assert (await cache.get_user("g1", "u1"))["description"] == "likes cats"
+        assert [t["summary"] for t in await cache.get_recent_topics("g1")] == ["cats"]
+        assert len(topic_reads) == 3
+        await aio.close()
+
+    asyncio.run(scenario())
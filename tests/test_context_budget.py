@@ -0,0 +1,46 @@
+from services.context_budget import ContextBudget
+from services.tokens import estimate_tokens, truncate_tokens
+
+
+def make_context(n_messages=10, n_memories=20, n_topics=5):
+    return {
+        "persona": "柒槿年",
+        "recent_messages": [f"user{i}: 消息{i}" for i in range(n_messages)],
+        "topic_summary": "在聊天",
+        "past_topics": "\n".join(f"- 话题摘要{i}" * 3 for i in range(n_topics)),
+        "user_profile": "Current Speaker (a): 喜欢猫",
+        "user_memories": "User Memories:\n" + "\n".join(f"- 记忆{i}" * 4 for i in range(n_memories)),
+        "latest_message": "消息9",
+        "time_since_last_group_message": 1.0,
+        "time_since_last_user_message": 9999.0,
+        "is_at_mentioned": False,
+    }
+
+
+def test_truncate_tokens_is_cjk_aware():
+    assert truncate_tokens("短", 5) == "短"
+    assert truncate_tokens("一二三四五六", 3) == "一二三…"
+    assert estimate_tokens(truncate_tokens("abcd" * 100, 10)) <= 11
+
+
+def test_fit_truncates_and_drops_lowest_ranked_first():
+    budget = ContextBudget()
+    budget.model_budgets = {"small": 300}
+    context = make_context()
+    context["recent_messages"][-2] = "wall: " + "刷屏" * 2000
+
+    roomy = budget.fit(context, "big")
+    # Within the default budget only the wall of text is cut
+    assert len(roomy["recent_messages"][-2]) < 200
+    assert roomy["user_memories"] == context["user_memories"]
+    assert context["recent_messages"][-2].startswith("wall: 刷屏刷屏刷屏刷屏")  # input untouched
+
+    tight = budget.fit(context, "small")
+    assert ContextBudget.count(tight) <= 300
+    memories = tight["user_memories"].split("\n")
+    # Best-ranked memories survive, the tail goes
+    assert memories[:2] == ["User Memories:", "- 记忆0- 记忆0- 记忆0- 记忆0"]
+    assert len(memories) - 1 <= 5
+    # Newest messages and the never-dropped fields are kept
+    assert tight["recent_messages"][-1] == "user9: 消息9"
+    assert tight["latest_message"] == "消息9" and tight["persona"] == "柒槿年"
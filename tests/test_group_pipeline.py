@@ -0,0 +1,97 @@
+import asyncio
+from services.group_pipeline import GroupPipeline
+
+
+class Recorder:
+    def __init__(self, judge_time=0.0):
+        self.log = []
+        self.judge_time = judge_time
+        self.active = {}
+        self.max_active = {}
+
+    async def accept(self, group_id, event):
+        await asyncio.sleep(0.001 * (len(event) % 3))
+        self.log.append(("accept", group_id, event))
+        return {"latest_message": event} if event.startswith("@") else None
+
+    async def judge_and_reply(self, group_id, event):
+        self.log.append(("judge", group_id, event))
+        await asyncio.sleep(self.judge_time)
+        self.log.append(("judged", group_id, event))
+
+    async def reply(self, group_id, context, event):
+        self.active[group_id] = self.active.get(group_id, 0) + 1
+        self.max_active[group_id] = max(self.max_active.get(group_id, 0), self.active[group_id])
+        self.log.append(("reply", group_id, event))
+        await asyncio.sleep(self.judge_time)
+        self.active[group_id] -= 1
+
+
+def make_pipeline(debounce=0.05):
+    pipeline = GroupPipeline()
+    pipeline.debounce = debounce
+    pipeline.idle_seconds = 0.1
+    return pipeline
+
+
+def test_messages_are_accepted_in_order_and_debounced_once():
+    handler = Recorder()
+
+    async def scenario():
+        pipeline = make_pipeline()
+        for event in ["a", "bb", "ccc"]:
+            pipeline.post("g", event, handler)
+            await asyncio.sleep(0.01)
+        assert pipeline.depth("g") == 0 and pipeline.busy()
+        await asyncio.sleep(0.3)
+        # Idle workers exit
+        assert pipeline.gauges()["workers"] == 0
+        return pipeline
+
+    pipeline = asyncio.run(scenario())
+    assert handler.log == [
+        ("accept", "g", "a"), ("accept", "g", "bb"), ("accept", "g", "ccc"),
+        ("judge", "g", "ccc"), ("judged", "g", "ccc"),
+    ]
+    assert pipeline.stats["judge_jobs"] == 1
+
+
+def test_newer_messages_supersede_and_mentions_preempt_the_judge():
+    handler = Recorder(judge_time=0.1)
+
+    async def scenario():
+        pipeline = make_pipeline(debounce=0.02)
+        pipeline.post("g", "a", handler)
+        await asyncio.sleep(0.05)
+        # The judge for "a" is running; "b" makes it outdated
+        pipeline.post("g", "b", handler)
+        await asyncio.sleep(0.05)
+        # A mention replaces the judge for "b"
+        pipeline.post("g", "@bot", handler)
+        await asyncio.sleep(0.05)
+        return pipeline
+
+    pipeline = asyncio.run(scenario())
+    assert ("judged", "g", "a") not in handler.log and ("judged", "g", "b") not in handler.log
+    assert handler.log[-1] == ("reply", "g", "@bot")
+    assert pipeline.stats["superseded"] == 1 and pipeline.stats["preempted"] == 1
+
+
+def test_a_flooding_group_holds_one_job_slot_at_most():
+    handler = Recorder(judge_time=0.05)
+
+    async def scenario():
+        pipeline = make_pipeline(debounce=0.0)
+        pipeline._slots = asyncio.Semaphore(2)
+        for i in range(20):
+            pipeline.post("flood", f"@{i}", handler)
+        pipeline.post("quiet", "hi", handler)
+        await asyncio.sleep(0.3)
+        return pipeline
+
+    pipeline = asyncio.run(scenario())
+    replies = [i for i, entry in enumerate(handler.log) if entry[0] == "reply"]
+    # The quiet group is served while the flood is still being answered
+    assert handler.log.index(("judged", "quiet", "hi")) < replies[-1]
+    assert handler.max_active["flood"] == 1
+    assert len(replies) == 3 and pipeline.stats["dropped_mentions"] == 17
@@ -0,0 +1,56 @@
+import asyncio
+from services.judge_cache import JudgeCache, fingerprint
+
+BOT = ["柒槿年"]
+
+
+def context(lines, gap=10.0, at=False):
+    return {
+        "recent_messages": lines,
+        "latest_message": lines[-1].partition(": ")[2],
+        "time_since_last_user_message": gap,
+        "time_since_last_group_message": gap,
+        "is_at_mentioned": at,
+        "user_memories": "ignored",
+    }
+
+
+def test_fingerprint_ignores_noise_but_not_meaning():
+    base = fingerprint(context(["A: 在吗", "B: [图片]", "B: 哈哈哈哈哈"]), BOT)
+    # Sticker placeholder variants, laughter length, speaker names, exact gap
+    assert fingerprint(context(["C: 在吗", "D: [表情/图片]", "D: 哈哈哈"], gap=20.0), BOT) == base
+    # 复读 chains collapse at three
+    chain = fingerprint(context(["A: 666", "B: 666", "C: 666"]), BOT)
+    assert fingerprint(context(["A: 666", "B: 666", "C: 666", "D: 666", "E: 666"]), BOT) == chain
+
+    assert fingerprint(context(["A: 在吗", "B: [图片]", "B: 哈哈哈哈哈"], gap=1.0), BOT) != base
+    assert fingerprint(context(["A: 在吗", "B: [图片]", "B: 哈哈哈哈哈"], at=True), BOT) != base
+    assert fingerprint(context(["A: 在吗", "柒槿年: [图片]", "B: 哈哈哈哈哈"]), BOT) != base
+    assert fingerprint(context(["A: 在吗", "B: [图片]", "B: 笑死"]), BOT) != base
+
+
+def test_judge_cache_reuses_and_joins_calls():
+    cache = JudgeCache()
+    calls = []
+
+    async def judge():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"should_intervene": True}
+
+    async def scenario():
+        ctx = context(["A: 666", "B: 666"])
+        first, joined = await asyncio.gather(cache.get_or_call(ctx, 100, judge), cache.get_or_call(ctx, 100, judge))
+        assert first == joined == {"should_intervene": True}
+        assert await cache.get_or_call(context(["X: 666", "Y: 666"]), 100, judge) == first
+
+        # A waiter cancelled mid-call does not throw the decision away
+        waiter = asyncio.ensure_future(cache.get_or_call(context(["A: new"]), 100, judge))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0.05)
+        assert await cache.get_or_call(context(["A: new"]), 100, judge) == first
+
+    asyncio.run(scenario())
+    assert len(calls) == 2
+    assert cache.stats == {"calls": 2, "hits": 2, "joined": 1, "saved_tokens": 300}
@@ -0,0 +1,219 @@
+import asyncio
+import json
+from types import SimpleNamespace
+from services.batching import MicroBatcher
+from services.llm import LLMService
+
+
+def test_micro_batcher_groups_and_fans_out():
+    batches = []
+
+    async def handler(items):
+        batches.append(items)
+        return [item * 10 for item in items]
+
+    async def scenario():
+        batcher = MicroBatcher(handler, max_wait=0.02, max_size=3)
+        # Four at once: one full batch immediately, the rest after max_wait
+        results = await asyncio.gather(*(batcher.submit(i) for i in range(4)))
+        assert results == [0, 10, 20, 30]
+
+    asyncio.run(scenario())
+    assert batches == [[0, 1, 2], [3]]
+
+
+def test_batched_judge_falls_back_per_missing_decision():
+    llm = LLMService()
+    requests = []
+
+    async def fake_call(model, system_prompt, user_content, json_mode=True, **kwargs):
+        payload = json.loads(user_content)
+        requests.append(payload)
+        if "requests" in payload:
+            # Answers only the first request (and one junk entry)
+            return {"decisions": [{"id": "0", "should_intervene": True}, {"id": "7", "should_intervene": True}]}
+        return {"should_intervene": False, "reason": payload["latest_message"]}
+
+    llm._call_llm = fake_call
+    contexts = [({"latest_message": f"m{i}"}, None, f"g{i}") for i in range(3)]
+    # The group of this one moved on before the batch went out
+    contexts.append(({"latest_message": "old"}, lambda: True, "g3"))
+    decisions = asyncio.run(llm._judge_many(contexts))
+
+    assert decisions == [
+        {"should_intervene": True},
+        {"should_intervene": False, "reason": "m1"},
+        {"should_intervene": False, "reason": "m2"},
+        {},
+    ]
+    assert len(requests) == 3
+    assert llm.judge_stats == {"batched_calls": 1, "single_calls": 2, "fallbacks": 2, "stale": 1}
+
+
+def test_topic_summaries_ignore_malformed_replies():
+    llm = LLMService()
+    replies = [
+        {"summaries": [{"id": 1, "summary": " 爬山 "}, {"id": 9, "summary": "x"}, {"summary": "no id"}]},
+        ["not", "an", "object"],
+        "text",
+    ]
+
+    async def fake_call(model, system_prompt, user_content, json_mode=True, **kwargs):
+        return replies.pop(0)
+
+    llm._call_llm = fake_call
+    topics = [{"id": 1, "messages": ["小明: 周末爬山"]}, {"id": 2, "messages": ["小红: 好"]}]
+    assert asyncio.run(llm.summarize_topics(topics)) == {1: "爬山"}
+    assert asyncio.run(llm.summarize_topics(topics)) == {}
+    assert asyncio.run(llm.summarize_topics(topics)) == {}
+
+
+def test_json_array_streamer_emits_items_as_they_close():
+    from services.json_stream import JSONArrayStreamer
+
+    text = '```json\n{"thought": "a \\"b\\"", "messages": ["你好", "x\\ny", "[1, {2}]"], "summary": "s", "extra": {"messages": ["no"]}}'
+    streamer = JSONArrayStreamer("messages")
+    emitted = []
+    # Split at every possible point, three characters at a time
+    for i in range(0, len(text), 3):
+        emitted.append(streamer.feed(text[i:i + 3]))
+    assert [m for chunk in emitted for m in chunk] == ["你好", "x\ny", "[1, {2}]"]
+    # Each item came out as soon as its closing quote arrived, not at the end
+    assert emitted.index(["你好"]) < len(text) // 3 - 10
+
+
+class _FakeStreamClient:
+    def __init__(self, chunks, fail_after=None):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        assert kwargs["stream"] is True
+
+        async def gen():
+            for i, text in enumerate(self.chunks):
+                if self.fail_after is not None and i == self.fail_after:
+                    raise ConnectionError("reset")
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+        return gen()
+
+
+def test_generate_chat_streams_messages_once():
+    llm = LLMService()
+    llm.chat_streaming = True
+    llm.client = _FakeStreamClient(['{"messages": ["a', '", "b"', ', "c"], "summary": "s"}'])
+    delivered = []
+    result = asyncio.run(llm.generate_chat({"latest_message": "hi"}, on_message=delivered.append))
+    assert delivered == ["a", "b", "c"]
+    assert result["summary"] == "s"
+
+    # Broken stream after the first message: keep it, do not resend it
+    llm.client = _FakeStreamClient(['{"messages": ["a"', ', "b"'], fail_after=1)
+    delivered = []
+    result = asyncio.run(llm.generate_chat({"latest_message": "hi"}, on_message=delivered.append))
+    assert delivered == ["a"] and result == {"messages": ["a"]}
+
+
+def test_generate_chat_falls_back_when_stream_fails_early():
+    llm = LLMService()
+    llm.chat_streaming = True
+    llm.client = _FakeStreamClient(['{"messages": ['], fail_after=0)
+
+    async def fake_call(model, system_prompt, user_content, json_mode=True, **kwargs):
+        return {"messages": ["x", "y"]}
+
+    llm._call_llm = fake_call
+    delivered = []
+    asyncio.run(llm.generate_chat({"latest_message": "hi"}, on_message=delivered.append))
+    assert delivered == ["x", "y"]
+
+
+def test_every_call_is_recorded_with_outcome_and_usage(monkeypatch):
+    import services.telemetry as telemetry_module
+
+    rows = []
+    monkeypatch.setattr(telemetry_module.async_storage, "add_llm_call", lambda *args: rows.append(args))
+    replies = iter(['{"should_intervene": true}', "not json"])
+
+    async def create(**kwargs):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=next(replies)))],
+            usage=SimpleNamespace(prompt_tokens=120, completion_tokens=8, total_tokens=128),
+        )
+
+    llm = LLMService()
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    assert asyncio.run(llm._judge_one("sys", "{}", group_id="g1")) == {"should_intervene": True}
+    assert asyncio.run(llm.extract_memories(["hi"], group_id="g2")) == []
+
+    # (started_at, model, kind, group, queue_ms, latency_ms, prompt, completion, outcome, retries, path)
+    assert [(r[2], r[3], r[6], r[7], r[8], r[9], r[10]) for r in rows] == [
+        ("judge", "g1", 120, 8, "ok", 0, "primary"),
+        ("extraction", "g2", 120, 8, "parse_error", 0, "primary"),
+    ]
+    assert all(r[4] >= 0 and r[5] >= 0 for r in rows)
+
+
+def _reply(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def _resilient_llm(create, monkeypatch):
+    import services.telemetry as telemetry_module
+
+    rows = []
+    monkeypatch.setattr(telemetry_module.async_storage, "add_llm_call", lambda *args: rows.append(args))
+    llm = LLMService()
+    llm.client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    llm.resilience.backoff_base = llm.resilience.backoff_max = 0.001
+    return llm, rows
+
+
+def test_retries_then_falls_back_to_next_model(monkeypatch):
+    import openai
+
+    sent = []
+
+    async def create(model, **kwargs):
+        sent.append(model)
+        if model == "big":
+            if len(sent) == 1:
+                raise openai.APIConnectionError(request=None)
+            await asyncio.sleep(1)  # hangs past the timeout
+        return _reply('{"messages": ["ok"]}')
+
+    llm, rows = _resilient_llm(create, monkeypatch)
+    llm.resilience.fallbacks = {"big": ["small"]}
+    llm.resilience.timeouts["chat"] = 0.05
+    result = asyncio.run(llm._call_llm("big", "sys", "{}", kind="chat", group_id="g"))
+
+    assert result == {"messages": ["ok"]}
+    # Connection error retried once, the timeout moved on to the fallback
+    assert sent == ["big", "big", "small"]
+    assert [(r[1], r[8], r[9], r[10]) for r in rows] == [("small", "ok", 1, "fallback")]
+
+
+def test_hedged_request_wins_when_first_is_slow(monkeypatch):
+    calls = []
+
+    async def create(model, **kwargs):
+        calls.append(model)
+        await asyncio.sleep(1 if len(calls) == 1 else 0.01)
+        return _reply('{"should_intervene": false}')
+
+    llm, rows = _resilient_llm(create, monkeypatch)
+    llm.resilience.hedge_kinds = {"judge"}
+    llm.resilience.hedge_min_delay = 0.02
+    for _ in range(llm.resilience.hedge_min_samples):
+        llm.resilience.latencies.add(llm.judge_model, "judge", 0.02)
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        result = await llm._judge_one("sys", "{}")
+        return result, asyncio.get_running_loop().time() - started
+
+    result, elapsed = asyncio.run(scenario())
+    assert result == {"should_intervene": False}
+    assert len(calls) == 2 and elapsed < 0.5
+    assert rows[-1][10] == "hedge" and llm.resilience_stats["hedged"] == 1
@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+from services.llm_scheduler import LLMScheduler, LLMShed, Priority, TokenBucket
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(60, clock=lambda: now[0])  # one per second
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+    now[0] = 0.5
+    assert bucket.wait_time(1) == pytest.approx(0.5)
+    # Larger than the bucket: wait for a full bucket, not forever
+    assert bucket.wait_time(1000) == pytest.approx(59.5)
+    # Refunding an overestimate never overfills the bucket
+    now[0] = 120.0
+    bucket.take(-500)
+    assert bucket.tokens == 60
+
+
+def test_priorities_deadlines_and_shedding():
+    scheduler = LLMScheduler()
+    scheduler.default_concurrency = 1
+    order = []
+
+    async def request(name, priority, **kwargs):
+        try:
+            async with scheduler.slot("m", priority, **kwargs):
+                order.append(name)
+                await asyncio.sleep(0.01)
+        except LLMShed:
+            order.append(f"shed:{name}")
+
+    async def scenario():
+        stale = {"value": False}
+        first = asyncio.create_task(request("first", Priority.BACKGROUND))
+        await asyncio.sleep(0)
+        # Queued behind "first" in arbitrary order, served by priority
+        await asyncio.gather(
+            first,
+            request("proactive", Priority.PROACTIVE),
+            request("expired", Priority.EXTRACTION, deadline=0.005),
+            request("judge", Priority.JUDGE, stale=lambda: stale["value"]),
+            request("stale-judge", Priority.JUDGE, stale=lambda: True),
+            request("mention", Priority.MENTION),
+        )
+
+    asyncio.run(scenario())
+    assert order == ["first", "mention", "judge", "shed:stale-judge", "shed:expired", "proactive"]
+    metrics = scheduler.metrics()
+    assert metrics["granted"] == 4 and metrics["stale"] == 1 and metrics["expired"] == 1
+    assert metrics["models"]["m"] == {"in_flight": 0, "queued": 0, "queued_by_priority": {p.name: 0 for p in Priority}}
+    assert metrics["wait"]["PROACTIVE"]["count"] == 1
@@ -0,0 +1,99 @@
+import os
+import time
+from services.memory import MemoryCompactor, normalize
+from services.retrieval import RetrievalEngine
+from services.storage import Storage
+
+
+def make_storage(tmp_path) -> Storage:
+    return Storage(os.path.join(tmp_path, "test.db"))
+
+
+def test_normalize_folds_paraphrases():
+    assert normalize("用户喜欢菠萝披萨") == normalize("用户爱吃菠萝披萨")
+    assert normalize("LeNotFound喜欢猫!", ["LeNotFound"]) == "喜欢猫"
+    assert normalize("喜欢猫") != normalize("喜欢狗")
+
+
+def test_compaction_merges_near_duplicates(tmp_path):
+    s = make_storage(tmp_path)
+    s.update_user("g1", "u1", "LeNotFound", 1.0)
+    s.add_memory("u1", "g1", "用户喜欢菠萝披萨", 100.0)
+    s.add_memory("u1", "g1", "用户爱吃菠萝披萨", 200.0)
+    s.add_memory("u1", "g1", "LeNotFound刚刚调整了项目的数据库表结构", 300.0)
+    s.add_memory("u1", "g1", "LeNotFound调整了数据库表结构", 400.0)
+    s.add_memory("u1", "g1", "LeNotFound喜欢猫", 500.0)
+    s.add_memory("u1", "g1", "LeNotFound喜欢狗", 600.0)
+    # Exact repeat bumps the hit count instead of inserting
+    s.add_memory("u1", "g1", "LeNotFound喜欢猫", 700.0)
+
+    compactor = MemoryCompactor(s)
+    result = compactor.compact_once()
+    assert result["merged"] == 2
+
+    rows = {r["content"]: r for r in s.get_memory_rows("u1")}
+    assert set(rows) == {
+        "用户喜欢菠萝披萨",
+        "LeNotFound刚刚调整了项目的数据库表结构",
+        "LeNotFound喜欢猫",
+        "LeNotFound喜欢狗",
+    }
+    assert rows["用户喜欢菠萝披萨"]["hit_count"] == 2
+    assert rows["用户喜欢菠萝披萨"]["last_seen"] == 200.0
+    assert rows["LeNotFound喜欢猫"]["hit_count"] == 2
+
+    # Nothing new since the last pass
+    assert compactor.compact_once()["users"] == 0
+    s.close()
+
+
+def test_cap_evicts_stale_rarely_seen_facts(tmp_path):
+    s = make_storage(tmp_path)
+    now = time.time()
+    topics = ["原神", "编程", "跑步", "摄影", "咖啡", "猫咪"]
+    for i, topic in enumerate(topics):
+        s.add_memory("u1", "g1", f"用户最近沉迷{topic}第{i}季", now - (len(topics) - i) * 86400 * 30)
+    # The oldest fact keeps coming back, so it survives despite its age
+    for _ in range(5):
+        s.add_memory("u1", "g1", "用户最近沉迷原神第0季", now - 86400 * 10)
+
+    compactor = MemoryCompactor(s)
+    compactor.max_per_user = 3
+    result = compactor.compact_once()
+    assert result["evicted"] == 3
+
+    contents = {r["content"] for r in s.get_memory_rows("u1")}
+    assert "用户最近沉迷原神第0季" in contents
+    assert "用户最近沉迷猫咪第5季" in contents
+    assert "用户最近沉迷咖啡第4季" in contents
+    s.close()
+
+
+def test_retrieval_ranks_by_relevance(tmp_path):
+    s = make_storage(tmp_path)
+    facts = [
+        "用户喜欢菠萝披萨",
+        "用户最近在熬夜重构代码",
+        "用户养了一只橘猫叫大黄",
+        "用户周末喜欢去爬山",
+        "用户是计算机系大学生",
+    ]
+    for i, fact in enumerate(facts):
+        s.add_memory("u1", "g1", fact, 1000.0 + i)
+
+    engine = RetrievalEngine(s)
+    index = engine.build_index("u1")
+    assert index.ids and all(blob is not None for *_, blob in s.get_memory_vectors("u1"))
+
+    scores = index.score(["今天大黄又把猫粮打翻了"], [1.0])
+    assert engine.rank(index, scores, 1, 0.05) == ["用户养了一只橘猫叫大黄"]
+
+    # Batch path: one matmul for several queries, weighted
+    scores = index.score(["晚饭吃披萨", "代码重构好累"], [0.5, 0.5])
+    top2 = engine.rank(index, scores, 2, 0.05)
+    assert set(top2) == {"用户喜欢菠萝披萨", "用户最近在熬夜重构代码"}
+
+    # No match strong enough: fall back to the most recently seen facts
+    scores = index.score(["zzz"], [1.0])
+    assert engine.rank(index, scores, 2, 1.01) == ["用户是计算机系大学生", "用户周末喜欢去爬山"]
+    s.close()
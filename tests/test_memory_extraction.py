@@ -0,0 +1,106 @@
+import asyncio
+import services.memory_extraction as memory_extraction
+from services.memory_extraction import MemoryExtractor
+from services.topic import MessageRing
+
+
+class FakeLLM:
+    def __init__(self):
+        self.calls = []
+        self.fail = False
+
+    async def extract_memories_batch(self, users, group_id=""):
+        self.calls.append(users)
+        await asyncio.sleep(0.01)
+        if self.fail:
+            return [None] * len(users)
+        return [[f"fact:{messages[-1]}"] for messages in users]
+
+
+class FakeTopics:
+    def __init__(self):
+        self.ring = MessageRing(50)
+
+    async def get_current_topic(self, group_id):
+        return {"messages": self.ring}
+
+
+class FakeCache:
+    async def get_user(self, group_id, user_id):
+        return {"user_id": user_id}
+
+
+def make_extractor(monkeypatch, **overrides):
+    saved = []
+    monkeypatch.setattr(memory_extraction.async_storage, "add_memory", lambda *args: saved.append(args))
+    llm, topics = FakeLLM(), FakeTopics()
+    extractor = MemoryExtractor(llm, topics, FakeCache())
+    extractor.cooldown, extractor.batching, extractor.batch_wait = 0.05, False, 0.02
+    for name, value in overrides.items():
+        setattr(extractor, name, value)
+    return extractor, llm, topics, saved
+
+
+def test_requests_coalesce_and_only_new_messages_are_sent(monkeypatch):
+    extractor, llm, topics, saved = make_extractor(monkeypatch)
+
+    async def scenario():
+        for i, text in enumerate(["我养了猫", "叫咪咪"]):
+            topics.ring.append("u1", "小明", text, 100.0 + i)
+        for _ in range(3):
+            extractor.request("g", "u1")
+        await asyncio.sleep(0.02)
+        topics.ring.append("u1", "小明", "下周搬家", 103.0)
+        extractor.request("g", "u1")
+        await asyncio.sleep(0.15)
+
+    asyncio.run(scenario())
+    assert llm.calls == [[["我养了猫", "叫咪咪"]], [["下周搬家"]]]
+    assert [fact for _, _, fact in saved] == ["fact:叫咪咪", "fact:下周搬家"]
+    assert extractor.stats["coalesced"] == 2
+
+
+def test_failed_extraction_keeps_messages_and_batches_users(monkeypatch):
+    extractor, llm, topics, saved = make_extractor(monkeypatch, batching=True)
+
+    async def scenario():
+        for i, user in enumerate(["u1", "u2", "u1", "u2"]):
+            topics.ring.append(user, user, f"{user}-{i}", 100.0 + i)
+        llm.fail = True
+        extractor.request("g", "u1")
+        await asyncio.sleep(0.1)
+        llm.fail = False
+        extractor.request("g", "u1")
+        extractor.request("g", "u2")
+        await asyncio.sleep(0.15)
+
+    asyncio.run(scenario())
+    # Nothing lost by the failure; both users answered by one call
+    assert llm.calls[-1] == [["u1-0", "u1-2"], ["u2-1", "u2-3"]]
+    assert len(llm.calls) == 2
+    assert sorted(user for user, _, _ in saved) == ["u1", "u2"]
+    assert extractor.stats["failed"] == 1
+    # The group's batcher is dropped once idle; its stats are kept
+    assert extractor._batchers == {} and extractor.batch_stats()["max_batch"] == 2
+
+
+def test_request_right_after_a_run_ends_starts_a_new_run(monkeypatch):
+    extractor, llm, topics, saved = make_extractor(monkeypatch, cooldown=0)
+
+    async def scenario():
+        for i, text in enumerate(["我养了猫", "叫咪咪"]):
+            topics.ring.append("u1", "小明", text, 100.0 + i)
+        extractor.request("g", "u1")
+        task = extractor._running[("g", "u1")]
+        while not task.done():
+            await asyncio.sleep(0)
+        # Finished, but its done callback has not removed it yet
+        assert extractor._running[("g", "u1")] is task
+        topics.ring.append("u1", "小明", "下周搬家", 103.0)
+        extractor.request("g", "u1")
+        assert extractor._running[("g", "u1")] is not task
+        await asyncio.sleep(0.1)
+
+    asyncio.run(scenario())
+    assert llm.calls == [[["我养了猫", "叫咪咪"]], [["下周搬家"]]]
+    assert extractor.stats["coalesced"] == 0 and extractor._running == {}
@@ -0,0 +1,37 @@
+from services.prefilter import PreFilter, RULES, register_rule
+
+
+def context(message, gap=10.0):
+    return {"latest_message": message, "time_since_last_user_message": gap}
+
+
+def test_rules_short_circuit_clear_cut_cases():
+    prefilter = PreFilter()
+    prefilter.enabled = True
+
+    assert prefilter.check(context("qjinera 你怎么看", gap=0.5))["should_intervene"] is True
+    assert prefilter.check(context("然后呢", gap=1.0))["rule"] == "typing_burst"
+    decision = prefilter.check(context(" [图片] ？？！ [表情/图片]"))
+    assert decision["rule"] == "noise" and decision["should_intervene"] is False
+    # Left to the judge: real text, and emoji (they can carry the mood)
+    assert prefilter.check(context("今天把甲方怼回去了")) is None
+    assert prefilter.check(context("😋")) is None
+
+    assert prefilter.stats["checked"] == 5
+    assert prefilter.stats["avoided"] == 3
+    assert prefilter.stats["by_rule"] == {"name_mention": 1, "typing_burst": 1, "noise": 1}
+
+
+def test_custom_rules_plug_in_by_name():
+    @register_rule("test_keyword")
+    def keyword(prefilter):
+        return lambda ctx: {"should_intervene": True, "reason": "kw"} if "求助" in ctx["latest_message"] else None
+
+    try:
+        prefilter = PreFilter()
+        prefilter.enabled = True
+        prefilter._rules = [(name, RULES[name](prefilter)) for name in ("test_keyword", "noise")]
+        assert prefilter.check(context("求助！"))["rule"] == "test_keyword"
+        assert prefilter.check(context("！"))["rule"] == "noise"
+    finally:
+        RULES.pop("test_keyword")
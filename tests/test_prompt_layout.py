@@ -0,0 +1,45 @@
+import json
+from services.prompt_layout import PromptLayout, build_messages
+
+
+def context(latest, gap, memories):
+    return {
+        "latest_message": latest,
+        "time_since_last_user_message": gap,
+        "recent_messages": ["小明: 早", f"小明: {latest}"],
+        "persona": "柒槿年，一个普通群友" * 50,
+        "user_memories": "User Memories:\n" + "\n".join(f"- {m}" for m in memories),
+        "past_topics": "- 周末爬山\n- 期末考试",
+        "topic_summary": "闲聊",
+        "is_at_mentioned": False,
+    }
+
+
+def test_stable_fields_form_a_byte_identical_prefix():
+    layout = PromptLayout()
+    layout.enabled = True
+    first = build_messages("sys", *layout.split(context("今天好累", 3.2, ["养了猫", "在读研"])))
+    # Later message, other time gaps, same memories
+    second = build_messages("sys", *layout.split(context("项目还没做完", 12.0, ["养了猫", "在读研"])))
+    # Memories ranked differently keep their ranked order (the prefix changes)
+    reranked = build_messages("sys", *layout.split(context("项目还没做完", 12.0, ["在读研", "养了猫"])))
+
+    assert first[:-1] == second[:-1]
+    assert json.loads(reranked[1]["content"])["user_memories"] == "User Memories:\n- 在读研\n- 养了猫"
+    assert list(json.loads(first[1]["content"])) == ["persona", "past_topics", "user_memories"]
+    tail = json.loads(first[-1]["content"])
+    assert tail["latest_message"] == "今天好累" and "persona" not in tail
+    assert list(tail) == sorted(tail)
+
+
+def test_batch_shares_the_persona_and_layout_can_be_disabled():
+    layout = PromptLayout()
+    layout.enabled = True
+    contexts = [context("a", 1.0, ["x"]), context("b", 2.0, ["y"])]
+    prefix, tail = layout.split_batch(contexts)
+    assert list(json.loads(prefix[0])) == ["persona", "past_topics"]
+    requests = json.loads(tail)["requests"]
+    assert [r["context"]["user_memories"] for r in requests] == ["User Memories:\n- x", "User Memories:\n- y"]
+
+    layout.enabled = False
+    assert layout.split(contexts[0]) == ([], json.dumps(contexts[0], ensure_ascii=False))
@@ -0,0 +1,71 @@
+import asyncio
+from services.speculation import Speculator
+
+
+class FakeLLM:
+    completion_estimate = 100
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.calls = []
+
+    async def generate_chat(self, context, on_message=None, group_id="", priority=None):
+        self.calls.append(priority)
+        on_message("第一句")
+        await asyncio.sleep(self.delay)
+        on_message("第二句")
+        return {"messages": ["第一句", "第二句"], "summary": "s"}
+
+
+def context(message, recent=()):
+    return {"latest_message": message, "recent_messages": [*recent, f"小明: {message}"]}
+
+
+def make_speculator(llm):
+    speculator = Speculator(llm)
+    speculator.enabled = True
+    speculator.bot_names = ["柒槿年"]
+    return speculator
+
+
+def test_signals_predict_replies():
+    speculator = make_speculator(FakeLLM())
+    assert speculator.signal("g", context("对吧", ["柒槿年: 今天好冷"])) == "reply_to_bot"
+    assert speculator.signal("g", context("这个怎么弄？")) == "question"
+    assert speculator.signal("g", context("哈哈哈")) is None
+
+    for now in (1000.0, 1001.0):
+        speculator.note_decision("g", {"should_intervene": True, "trigger_level": "high"}, now=now)
+    assert speculator.signal("g", context("哈哈哈"), now=1002.0) == "hot_group"
+    assert speculator.signal("g", context("哈哈哈"), now=1000.0 + speculator.hot_window + 5) is None
+
+
+def test_hit_hands_over_buffered_messages_and_miss_counts_waste():
+    async def run():
+        llm = FakeLLM()
+        speculator = make_speculator(llm)
+
+        speculation = speculator.start("g", context("怎么办？"))
+        await asyncio.sleep(0)
+        speculator.hit(speculation)
+        sent = []
+        speculation.attach(sent.append)
+        result = await speculation.task
+        assert sent == ["第一句", "第二句"] and result["summary"] == "s"
+        assert speculator.stats["hits"] == 1 and speculator.stats["saved_seconds"] > 0
+
+        speculation = speculator.start("g", context("谁知道？"))
+        await asyncio.sleep(0)
+        speculator.miss(speculation)
+        await asyncio.sleep(0)
+        assert speculation.task.cancelled()
+        assert speculator.stats["misses"] == 1 and speculator.stats["wasted_tokens"] > 0
+        assert speculator.hit_rate() == 0.5
+
+        # Once the wasted-token budget is spent, no more speculation
+        speculator.wasted_budget = speculator.stats["wasted_tokens"]
+        assert speculator.start("g", context("还有人吗？")) is None
+        assert speculator.stats["over_budget"] == 1
+        assert len(llm.calls) == 2
+
+    asyncio.run(run())
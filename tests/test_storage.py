@@ -0,0 +1,224 @@
+import asyncio
+import os
+import time
+from services.migrations import MIGRATIONS, get_version, migrate
+from services.retention import RetentionManager
+from services.storage import AsyncStorage, Storage
+
+
+def make_storage(tmp_path) -> Storage:
+    return Storage(os.path.join(tmp_path, "test.db"))
+
+
+def test_connection_is_reused_and_tuned(tmp_path):
+    s = make_storage(tmp_path)
+    conn = s._conn()
+    assert s._conn() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+    # synchronous = NORMAL
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    s.close()
+
+
+def test_basic_roundtrip(tmp_path):
+    s = make_storage(tmp_path)
+    topic_id = s.create_topic("g1", 1000.0)
+    s.add_message(topic_id, "u1", "hello", 1001.0, "Alice")
+    s.update_user("g1", "u1", "Alice", 1001.0)
+    s.update_user("g1", "u1", "Alice2", 1002.0)
+
+    msgs = s.get_topic_messages(topic_id)
+    assert [m["content"] for m in msgs] == ["hello"]
+
+    user = s.get_user("g1", "u1")
+    assert user["nickname"] == "Alice2"
+    assert user["interaction_count"] == 2
+    s.close()
+
+
+def test_write_behind_batches_and_flushes_on_close(tmp_path):
+    s = make_storage(tmp_path)
+    aio = AsyncStorage(s)
+
+    async def scenario():
+        topic_id = await aio.create_topic("g1", 1000.0)
+        for i in range(5):
+            aio.add_message(topic_id, "u1", f"m{i}", 1001.0 + i, "Alice")
+        aio.update_user("g1", "u1", "Alice", 1005.0)
+
+        # Queued, not committed yet, but visible through the async read path
+        assert aio.pending_writes == 6
+        assert len(s.get_topic_messages(topic_id)) == 0
+        msgs = await aio.get_topic_messages(topic_id)
+        assert [m["content"] for m in msgs] == [f"m{i}" for i in range(5)]
+
+        # Other reads flush first when a queued write would change them
+        assert await aio.get_user("g1", "u2") is None
+        assert aio.pending_writes == 6
+        assert (await aio.get_user("g1", "u1"))["nickname"] == "Alice"
+        assert aio.pending_writes == 0
+        await aio.close()
+        return topic_id
+
+    topic_id = asyncio.run(scenario())
+    assert aio.pending_writes == 0
+    assert aio.stats["batches"] == 1
+    assert len(s.get_topic_messages(topic_id)) == 5
+    assert s.get_user("g1", "u1")["interaction_count"] == 1
+    s.close()
+
+
+def test_cancelled_flush_still_commits_and_close_waits_for_it(tmp_path):
+    s = make_storage(tmp_path)
+    aio = AsyncStorage(s)
+
+    async def scenario():
+        topic_id = await aio.create_topic("g1", 1000.0)
+        for i in range(3):
+            aio.add_message(topic_id, "u1", f"m{i}", 1001.0 + i, "Alice")
+        # The database thread is busy, so the batch waits behind a slow read
+        busy = asyncio.create_task(aio.call(time.sleep, 0.05))
+        await asyncio.sleep(0)
+        # E.g. a superseded judge cancelled while reading through flush()
+        flush = asyncio.create_task(aio.flush())
+        await asyncio.sleep(0.01)
+        flush.cancel()
+        aio.add_message(topic_id, "u1", "m3", 1004.0, "Alice")
+        await aio.close()
+        await busy
+        return topic_id
+
+    topic_id = asyncio.run(scenario())
+    assert [m["content"] for m in s.get_topic_messages(topic_id)] == ["m0", "m1", "m2", "m3"]
+    assert aio.pending_writes == 0
+    s.close()
+
+
+def test_migrations_are_versioned_and_idempotent(tmp_path):
+    s = make_storage(tmp_path)
+    conn = s._conn()
+    latest = MIGRATIONS[-1][0]
+    assert get_version(conn) == latest
+    # Re-running is a no-op
+    assert migrate(conn) == latest
+    versions = [r[0] for r in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [v for v, _, _ in MIGRATIONS]
+    s.close()
+
+
+HOT_QUERIES = [
+    # get_latest_active_topic
+    ("SELECT id, start_time, end_time, summary FROM topics WHERE group_id = ? ORDER BY start_time DESC LIMIT 1", ("g",)),
+    ("SELECT user_id, nickname, content, timestamp FROM messages WHERE topic_id = ? ORDER BY timestamp ASC", (1,)),
+    # get_topic_messages
+    ("SELECT user_id, nickname, content, timestamp FROM messages WHERE topic_id = ? ORDER BY timestamp ASC LIMIT ?", (1, 50)),
+    # get_recent_topics
+    ("SELECT id, summary, start_time, end_time FROM topics WHERE group_id = ? AND summary IS NOT NULL ORDER BY start_time DESC LIMIT ?", ("g", 5)),
+    # get_memories
+    ("SELECT content FROM memories WHERE user_id = ? ORDER BY last_seen DESC LIMIT ?", ("u", 20)),
+    # get_user
+    ("SELECT * FROM users WHERE group_id = ? AND user_id = ?", ("g", "u")),
+    # topic sweeper
+    ("SELECT id, group_id, start_time, end_time FROM topics WHERE summary IS NULL AND end_time IS NOT NULL AND archive_path IS NULL AND summary_attempts < ? ORDER BY end_time DESC LIMIT ?", (3, 64)),
+    ("SELECT t.id FROM topics t WHERE t.end_time IS NULL AND t.start_time < ? AND COALESCE((SELECT MAX(timestamp) FROM messages m WHERE m.topic_id = t.id), t.start_time) < ? LIMIT ?", (1.0, 1.0, 10)),
+    # dashboard metrics
+    ("SELECT should_intervene FROM decision_logs WHERE timestamp > strftime('%s', 'now', 'start of day')", ()),
+    ("SELECT count(*) as cnt FROM topics WHERE start_time > strftime('%s', 'now', '-1 day')", ()),
+    ("SELECT started_at, model, kind, queue_ms, latency_ms, prompt_tokens, completion_tokens, outcome, retries, path, cached_tokens FROM llm_calls WHERE started_at > ?", (1.0,)),
+]
+
+
+def test_hot_queries_do_not_scan(tmp_path):
+    s = make_storage(tmp_path)
+    conn = s._conn()
+    for sql, params in HOT_QUERIES:
+        plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        scans = [step for step in plan if step.startswith("SCAN")]
+        assert not scans, f"{sql} -> {plan}"
+        # Ordering must come from the index, not a temp B-tree sort
+        assert not any("TEMP B-TREE" in step for step in plan), f"{sql} -> {plan}"
+    s.close()
+
+
+def test_full_text_search_over_topics_and_messages(tmp_path):
+    s = make_storage(tmp_path)
+    t1 = s.create_topic("g1", 1000.0)
+    t2 = s.create_topic("g1", 2000.0)
+    t3 = s.create_topic("g2", 3000.0)
+    s.update_topic_summary(t1, "大家在讨论周末去哪里爬山")
+    s.update_topic_summary(t2, "群友分享了菠萝披萨的做法")
+    s.update_topic_summary(t3, "另一个群也在聊菠萝披萨")
+    # Summaries can be rewritten; the index follows
+    s.update_topic_summary(t1, "大家在讨论周末去哪里露营")
+
+    s.add_message(t2, "u1", "菠萝披萨到底好不好吃", 2001.0, "Alice")
+    s.add_message(t2, "u2", "I love pineapple pizza", 2002.0, "Bob")
+
+    hits = s.search_topics("g1", "今晚想吃披萨")
+    assert [h["id"] for h in hits] == [t2]
+    assert [h["id"] for h in s.search_topics("g1", "露营装备")] == [t1]
+    assert s.search_topics("g1", "爬山") == []
+    assert s.search_topics("g1", "今晚想吃披萨", exclude_topic_id=t2) == []
+
+    assert [m["content"] for m in s.search_messages("披萨")] == ["菠萝披萨到底好不好吃"]
+    assert [m["nickname"] for m in s.search_messages("Pineapple")] == ["Bob"]
+    s.close()
+
+
+def test_retention_archives_old_topics_and_reads_them_back(tmp_path):
+    s = make_storage(tmp_path)
+    s.archive_dir = os.path.join(tmp_path, "archive")
+    assert s._conn().execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    now = 100 * 86400.0
+    old = s.create_topic("g1", now - 40 * 86400)
+    s.add_message(old, "u1", "很久以前的菠萝披萨", now - 40 * 86400 + 1, "Alice")
+    s.update_topic_summary(old, "聊了菠萝披萨", now - 40 * 86400 + 60)
+    fresh = s.create_topic("g1", now - 86400)
+    s.add_message(fresh, "u1", "昨天的消息", now - 86400 + 1, "Alice")
+    s.update_topic_summary(fresh, "昨天的话题", now - 86400 + 60)
+    s.add_decision_log("g1", "judge", {"should_intervene": False}, "", timestamp=now - 30 * 86400)
+    s.add_decision_log("g1", "judge", {"should_intervene": True}, "", timestamp=now - 60)
+
+    manager = RetentionManager(s)
+    result = manager.run_once(now)
+    assert result["topics_archived"] == 1
+    assert result["logs_pruned"] == 1
+    assert manager.run_once(now)["topics_archived"] == 0
+
+    conn = s._conn()
+    assert conn.execute("SELECT COUNT(*) FROM messages WHERE topic_id = ?", (old,)).fetchone()[0] == 0
+    assert s.search_messages("菠萝披萨") == []
+    # Summary stays hot; messages come back from the archive transparently
+    assert [t["id"] for t in s.search_topics("g1", "披萨")] == [old]
+    assert [m["content"] for m in s.get_topic_messages(old)] == ["很久以前的菠萝披萨"]
+    assert [m["content"] for m in s.get_topic_messages(fresh)] == ["昨天的消息"]
+    s.close()
+
+
+def test_bulk_warm_start_loads_trailing_window(tmp_path):
+    s = make_storage(tmp_path)
+    now = 10000.0
+    # g1: long, still-fresh topic
+    t1 = s.create_topic("g1", now - 5000)
+    for i in range(200):
+        s.add_message(t1, "u1", f"m{i}", now - 200 + i, "Alice")
+    # g2: an older topic, then a fresh one
+    old = s.create_topic("g2", now - 9000)
+    s.add_message(old, "u2", "old", now - 8999, "Bob")
+    t2 = s.create_topic("g2", now - 100)
+    s.add_message(t2, "u2", "fresh", now - 50, "Bob")
+    # g3: stale
+    t3 = s.create_topic("g3", now - 5000)
+    s.add_message(t3, "u3", "stale", now - 4000, "Carol")
+
+    topics = {t["group_id"]: t for t in s.get_active_topics(now - 600, 10)}
+    assert set(topics) == {"g1", "g2"}
+    assert topics["g1"]["topic_id"] == t1
+    assert [m["content"] for m in topics["g1"]["messages"]] == [f"m{i}" for i in range(190, 200)]
+    assert topics["g1"]["last_msg_time"] == now - 1
+    assert topics["g2"]["topic_id"] == t2
+
+    latest = s.get_latest_active_topic("g1", window=3)
+    assert [m["content"] for m in latest["messages"]] == ["m197", "m198", "m199"]
+    s.close()
@@ -0,0 +1,98 @@
+import asyncio
+import os
+from services.storage import Storage
+from services.sweeper import TopicSweeper
+from services.topic import MessageRing, TopicManager
+
+
+def test_message_ring_bounded_with_last_seen_index():
+    ring = MessageRing(3)
+    ring.append("u1", "Alice", "hi", 1.0)
+    ring.append("u2", "", "hello", 2.0)
+    ring.append("u1", "Alice", "again", 3.0)
+    ring.append("u3", "Carol", "yo", 4.0)
+    ring.append("u1", "Alice", "last", 5.0)
+
+    assert len(ring) == 3
+    assert [m.content for m in ring] == ["again", "yo", "last"]
+    # Lines are rendered once, falling back to user_id without nickname
+    assert ring.lines(10) == ["Alice: again", "Carol: yo", "Alice: last"]
+    assert ring.lines(1) == ["Alice: last"]
+    # The speaker's previous message is known even after older ones fell off
+    assert ring[-1].user_prev_ts == 3.0
+    assert ring.last_seen("u2") == 2.0
+    assert ring.last_seen("nobody") is None
+    assert ring.user_contents("u1") == ["again", "last"]
+
+
+def test_message_ring_from_rows():
+    rows = [{"user_id": "u1", "nickname": None, "content": f"m{i}", "timestamp": float(i)} for i in range(5)]
+    ring = MessageRing(10, rows)
+    assert ring.lines(2) == ["u1: m3", "u1: m4"]
+    assert ring[-1].user_prev_ts == 3.0
+
+
+def test_evict_cold_groups():
+    manager = TopicManager()
+    manager.max_resident_groups = 2
+    now = 10000.0
+    for i, age in enumerate([5, 60, 120, 3600]):
+        ring = MessageRing(10)
+        ring.append("u1", "", "hi", now - age)
+        manager.active_topics[f"g{i}"] = {"topic_id": i, "last_msg_time": now - age, "messages": ring, "summary": None}
+
+    closed = []
+    manager._archive_topic = lambda group_id: (closed.append(group_id), manager._drop(group_id))
+    result = manager.evict(now)
+
+    # g3 passed topic_gap and is closed; g2 is the least recently active of the rest
+    assert closed == ["g3"]
+    assert result == {"archived": 1, "evicted_idle": 0, "evicted_budget": 1}
+    assert sorted(manager.active_topics) == ["g0", "g1"]
+    assert manager.gauges()["resident_groups"] == 2
+
+    manager.memory_budget_bytes = 0
+    manager.evict(now)
+    assert manager.active_topics == {}
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    async def summarize_topics(self, topics):
+        self.calls.append([t["id"] for t in topics])
+        return {t["id"]: f"summary of {t['messages'][0]}" for t in topics}
+
+
+def test_sweeper_closes_and_batch_summarizes(tmp_path):
+    s = Storage(os.path.join(tmp_path, "test.db"))
+    now = 100000.0
+    topics = []
+    for i in range(5):
+        t = s.create_topic(f"g{i}", now - 3600)
+        for j in range(3):
+            s.add_message(t, "u1", f"t{i}m{j}", now - 3600 + j, "Alice")
+        topics.append(t)
+    short = s.create_topic("g9", now - 3600)
+    s.add_message(short, "u1", "hi", now - 3600, "Alice")
+    fresh = s.create_topic("g5", now - 60)
+    s.add_message(fresh, "u1", "still talking", now - 30, "Alice")
+
+    llm = FakeSummarizer()
+    sweeper = TopicSweeper(s, llm)
+    sweeper.batch_size = 2
+    closed, pending = sweeper.collect(now)
+    assert closed == 6
+    assert sorted(t["id"] for t in pending) == topics
+    summaries = asyncio.run(sweeper.summarize(pending))
+    assert sorted(len(c) for c in llm.calls) == [1, 2, 2]
+    assert summaries[topics[0]] == "summary of Alice: t0m0"
+
+    for topic_id, summary in summaries.items():
+        s.update_topic_summary(topic_id, summary)
+    # Closing again without a summary keeps the one written by the sweeper
+    s.update_topic_summary(topics[0], None, now)
+    assert s.get_recent_topics("g0")[0]["summary"] == "summary of Alice: t0m0"
+    # Nothing left: summarized, the short topic skipped for good, the fresh one still open
+    assert sweeper.collect(now) == (0, [])
@@ -1,7 +1,7 @@
 import asyncio
 from unittest.mock import MagicMock, patch
 from config import settings
-from services.storage import storage
+from services.storage import storage, async_storage
 from services.topic import topic_manager
 from services.llm import llm_service
 
@@ -29,9 +29,9 @@ async def verify_flow():
         # First call: Judge (should intervene)
         # Second call: Chat (response)
         
-        async def side_effect(model, system, user, json_mode=True):
-            # Check for keywords in the system prompt to distinguish models
-            if "插话" in system or "judge" in model:
+        async def side_effect(model, system, user, json_mode=True, **kwargs):
+            # The call kind tells the judge from the chat request
+            if kwargs.get("kind") == "judge":
                 return {"should_intervene": True, "reason": "Test"}
             else:
                 return {
@@ -47,7 +47,7 @@ async def verify_flow():
         user_id = "user_test"
         content = "Hello QJinEra"
         
-        context = topic_manager.handle_message(group_id, user_id, content)
+        context = await topic_manager.handle_message(group_id, user_id, content)
         print("Context built:", context.keys())
         
         # Simulate Plugin Logic (simplified)
@@ -61,10 +61,15 @@ async def verify_flow():
             # Verify summary update
             if chat_result.get("summary"):
                 topic_manager.update_summary(group_id, chat_result["summary"])
-                t = topic_manager.get_current_topic(group_id)
+                t = await topic_manager.get_current_topic(group_id)
                 assert t["summary"] == "User said hello."
                 print("[PASS] Topic summary updated.")
 
+    # Queued writes must reach the database on shutdown
+    await async_storage.close()
+    assert async_storage.pending_writes == 0
+    print("[PASS] Write-behind queue flushed.")
+
     print("=== Verification Completed Successfully ===")
 
 if __name__ == "__main__":